@@ -4,6 +4,7 @@ from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
 import os
 import asyncio
+import logging
 
 
 
@@ -21,8 +22,20 @@ def create_app():
     app.config.from_object('config.Config')
     db.init_app(app)
 
+    # The app's modules log under the "app" logger.  Messages below LOG_LEVEL are dropped before they are formatted
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger(__name__).setLevel(app.config["LOG_LEVEL"])
+
+    # Count and time database queries and OpenFGA calls per request
+    from . import metrics
+    metrics.init_app(app)
+
     oauth.init_app(app)
 
+    # Keep sessions on the server so the session cookie only holds an id
+    from . import sessions
+    sessions.init_app(app)
+
     # Configure and initialize the Auth0 Client
     oauth.register(
         "auth0",
@@ -39,12 +52,45 @@ def create_app():
     from .routes import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
-    # Create our database schema if it doesn't exist
+    # Create our database schema if it doesn't exist.  Indexes added to existing tables are created by
+    # the "flask upgrade-db" command
     with app.app_context():
         db.create_all()
 
+    # Create the file search index
+    from . import search
+    search.init_app(app)
+
+    from . import schema, sharing, autocomplete, content
+    schema.register_commands(app)
+    sessions.register_commands(app)
+    content.register_commands(app)
+    sharing.register_commands(app)
+    autocomplete.register_commands(app)
+    search.register_commands(app)
+
+    if not app.config["FGA_START_AFTER_FORK"]:
+        start_fga(app)
+
     
 
     return app
 
+def start_fga(app):
+    # Connect to OpenFGA and start the outbox worker for this process.  Under gunicorn with --preload this runs in
+    # each worker after it is forked instead of in create_app(), see gunicorn.conf.py
+    from .routes import initialize_fga_clients, fga_write_tuples
+
+    if app.config["FGA_EAGER_INIT"]:
+        try:
+            initialize_fga_clients()
+        except Exception as e:
+            # Requests will retry connecting when they first need OpenFGA
+            logging.getLogger(__name__).warning("Unable to initialize the OpenFGA clients: %s", e)
+
+    # Start the background worker that writes queued tuples from the outbox to OpenFGA
+    if app.config["FGA_OUTBOX_WORKER"]:
+        from .outbox import start_outbox_worker
+        start_outbox_worker(app, fga_write_tuples)
+
 __all__ = ['oauth']
\ No newline at end of file
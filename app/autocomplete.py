@@ -0,0 +1,125 @@
+from app import db
+from app.models import User, Group, AutocompleteEntry, prefix_filter
+from app.cache import DecisionCache
+from sqlalchemy import delete, insert, select
+import click
+import os
+import unicodedata
+
+# The user and group autocompletes search the autocomplete_entry table, which holds each user's email and each
+# group's name normalized to a case-insensitive key.  Entries are added when users register and groups are
+# created.  Group matches are filtered to the groups the caller can view a page at a time until enough are found,
+# and results are cached for a few seconds per prefix so each keystroke doesn't repeat the same lookups.
+
+AUTOCOMPLETE_LIMIT = 8
+
+# Group candidates are fetched and permission filtered this many at a time, for at most this many pages
+CANDIDATE_PAGE_SIZE = 50
+MAX_CANDIDATE_PAGES = 10
+
+_results = DecisionCache(
+    max_entries=int(os.getenv('AUTOCOMPLETE_CACHE_SIZE', 2000)),
+    ttl=float(os.getenv('AUTOCOMPLETE_CACHE_TTL', 5)),
+)
+
+
+def normalize_key(value):
+    # Fold case and compatibility characters and collapse whitespace so "Ann@Example.com" and "ann@example.com",
+    # or "Ｅｎｇ  Team" and "eng team", produce the same key
+    value = unicodedata.normalize("NFKC", value or "").casefold()
+    return " ".join(value.split())[:255]
+
+
+def index_user(user):
+    # Add a user to the autocomplete index in the current session.  The user must have been flushed
+    db.session.add(AutocompleteEntry(kind="user", key=normalize_key(user.email), ref_id=user.id))
+    _results.invalidate_type("user")
+
+
+def index_group(group):
+    # Add a group to the autocomplete index in the current session.  The group must have been flushed
+    db.session.add(AutocompleteEntry(kind="group", key=normalize_key(group.name), ref_id=group.id))
+    _results.invalidate_type("group")
+
+
+def _candidates(model, kind, key, after, limit):
+    # Returns up to limit rows of model whose key starts with key, ordered by key, starting after the
+    # (key, ref_id) position given
+    query = (
+        db.session.query(model, AutocompleteEntry.key)
+        .join(AutocompleteEntry, AutocompleteEntry.ref_id == model.id)
+        .filter(AutocompleteEntry.kind == kind, prefix_filter(AutocompleteEntry.key, key))
+    )
+    if after is not None:
+        after_key, after_id = after
+        query = query.filter(
+            db.or_(AutocompleteEntry.key > after_key, db.and_(AutocompleteEntry.key == after_key, AutocompleteEntry.ref_id > after_id))
+        )
+    return query.order_by(AutocompleteEntry.key, AutocompleteEntry.ref_id).limit(limit).all()
+
+
+def search_users(prefix, exclude_user_id=None):
+    # Returns up to AUTOCOMPLETE_LIMIT users whose email starts with prefix, ignoring case
+    key = normalize_key(prefix)
+    hit, users = _results.get(("users", key))
+    if not hit:
+        # Fetch one extra so the caller can be left out and still fill the list
+        rows = _candidates(User, "user", key, None, AUTOCOMPLETE_LIMIT + 1)
+        users = tuple(
+            {"id": user.id, "name": user.name, "email": user.email, "uuid": user.uuid, "image": user.image}
+            for user, user_key in rows
+        )
+        _results.set(("users", key), users, None, "user")
+    return [user for user in users if user["id"] != exclude_user_id][:AUTOCOMPLETE_LIMIT]
+
+
+def search_groups(prefix, user_uuid, viewable):
+    # Returns up to AUTOCOMPLETE_LIMIT groups whose name starts with prefix, ignoring case, that the user can
+    # view.  viewable(group_uuids) returns the set of the given group uuids the user can view.
+    key = normalize_key(prefix)
+    cache_key = ("groups", str(user_uuid), key)
+    hit, groups = _results.get(cache_key)
+    if hit:
+        return list(groups)
+
+    groups = []
+    after = None
+    for page in range(MAX_CANDIDATE_PAGES):
+        rows = _candidates(Group, "group", key, after, CANDIDATE_PAGE_SIZE)
+        if not rows:
+            break
+        allowed = viewable([group.uuid for group, group_key in rows])
+        groups.extend({"name": group.name, "uuid": group.uuid} for group, group_key in rows if group.uuid in allowed)
+        if len(groups) >= AUTOCOMPLETE_LIMIT or len(rows) < CANDIDATE_PAGE_SIZE:
+            break
+        last_group, last_key = rows[-1]
+        after = (last_key, last_group.id)
+
+    groups = tuple(groups[:AUTOCOMPLETE_LIMIT])
+    _results.set(cache_key, groups, f"user:{user_uuid}", "group")
+    return list(groups)
+
+
+def rebuild_autocomplete_index():
+    # Rebuild the autocomplete index from the user and group tables.  Returns the number of entries
+    db.session.execute(delete(AutocompleteEntry))
+    count = 0
+    for kind, model, column in (("user", User, User.email), ("group", Group, Group.name)):
+        rows = [
+            {"kind": kind, "key": normalize_key(value), "ref_id": ref_id}
+            for ref_id, value in db.session.execute(select(model.id, column))
+        ]
+        if rows:
+            db.session.execute(insert(AutocompleteEntry), rows)
+        count += len(rows)
+    db.session.commit()
+    _results.clear()
+    return count
+
+
+def register_commands(app):
+    @app.cli.command("rebuild-autocomplete-index")
+    def rebuild_autocomplete_index_command():
+        """Rebuild the user and group autocomplete index."""
+        count = rebuild_autocomplete_index()
+        click.echo(f"Indexed {count} users and groups")
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+
+# An in-process cache for OpenFGA decisions.  Entries expire after a fixed TTL and the least recently used
+# entries are evicted once the cache is full so memory use stays bounded.  Each entry is indexed by the user,
+# object and object type it describes so writes can invalidate only the decisions they affect.  generation counts
+# invalidations, so a decision fetched while a write was being invalidated isn't stored over the invalidation.
+
+class DecisionCache:
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._by_object = {}
+        self._by_type = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Returns a (hit, value) pair.  Expired entries are removed and count as a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, user, object_type, object=None, generation=None):
+        # Store a decision.  user, object_type and object are the index terms used for invalidation.  generation is
+        # the cache's generation read before the decision was fetched.  If anything was invalidated since then the
+        # decision may predate the write, so it isn't stored
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, user, object_type, object)
+            self._by_user.setdefault(user, set()).add(key)
+            self._by_type.setdefault(object_type, set()).add(key)
+            if object is not None:
+                self._by_object.setdefault(object, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user):
+        with self._lock:
+            self.generation += 1
+            for key in list(self._by_user.get(user, ())):
+                self._remove(key)
+
+    def invalidate_object(self, object, kind=None):
+        with self._lock:
+            self.generation += 1
+            for key in list(self._by_object.get(object, ())):
+                if kind is None or key[0] == kind:
+                    self._remove(key)
+
+    def invalidate_type(self, object_type, kind=None):
+        # Drop decisions about an object type.  kind limits this to one kind of entry, e.g. only "list" results
+        with self._lock:
+            self.generation += 1
+            for key in list(self._by_type.get(object_type, ())):
+                if kind is None or key[0] == kind:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._by_user.clear()
+            self._by_object.clear()
+            self._by_type.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        # Callers must hold the lock
+        value, expires, user, object_type, object = self._entries.pop(key)
+        self._discard(self._by_user, user, key)
+        self._discard(self._by_type, object_type, key)
+        if object is not None:
+            self._discard(self._by_object, object, key)
+
+    @staticmethod
+    def _discard(index, term, key):
+        keys = index.get(term)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[term]
@@ -0,0 +1,259 @@
+from app import db
+from app.models import File, FileBlob
+from app.queries import chunked
+from flask import current_app
+from sqlalchemy import LargeBinary, cast, delete, func, insert, select
+import click
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+# File bodies are kept out of the rows that listings read.  File.text_content is deferred so it is only loaded on
+# request, and when FILE_BLOB_DIR is set bodies are written to a content addressed blob store on disk instead,
+# named by the SHA-256 of their contents so identical bodies are stored once.  FileBlob maps each file to its
+# blob.  Bodies larger than FILE_STREAM_THRESHOLD bytes are streamed to the client in chunks.  Blobs are read from
+# disk a chunk at a time, while bodies kept in the database are read with one query so the stream is a consistent
+# version of the file, and are then sent in chunks.  Large bodies only stay out of memory with the blob store.
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        # Store data and return its digest.  Data that is already stored isn't written again, but its modified
+        # time is updated so prune_blobs doesn't remove it before the new reference commits
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temporary file and rename it so readers never see a partly written blob
+            fd, temporary = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        return digest
+
+    def open(self, digest):
+        return open(self.path(digest), encoding="utf-8", newline="")
+
+    def digests(self):
+        # Yields (digest, modified time) for every stored blob
+        for directory, subdirectories, names in os.walk(self.root):
+            for name in names:
+                if len(name) == 64:
+                    yield name, os.path.getmtime(os.path.join(directory, name))
+
+    def remove(self, digest, older_than=None):
+        # Remove a blob, unless older_than is given and it was stored or reused since then
+        path = self.path(digest)
+        try:
+            if older_than is None or os.path.getmtime(path) < older_than:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def blob_store():
+    # Returns the BlobStore, or None if file bodies are kept in the database
+    root = current_app.config["FILE_BLOB_DIR"]
+    return BlobStore(root) if root else None
+
+
+class FileContent:
+    # Where a file's body is kept and its size in bytes, found without reading the body.  digest is None for
+    # bodies kept in File.text_content
+    def __init__(self, file_id, digest, size):
+        self.file_id = file_id
+        self.digest = digest
+        self.size = size or 0
+
+    @property
+    def stream(self):
+        return self.size > current_app.config["FILE_STREAM_THRESHOLD"]
+
+    def read(self):
+        if self.digest is None:
+            return db.session.scalar(select(File.text_content).where(File.id == self.file_id)) or ""
+        with BlobStore(current_app.config["FILE_BLOB_DIR"]).open(self.digest) as f:
+            return f.read()
+
+    def chunks(self, size=READ_CHUNK_SIZE):
+        # Yields the body in pieces of at most size characters.  A body in the database is read whole, since
+        # reading it a piece per query could mix two versions of a file saved mid stream
+        if self.digest is None:
+            body = self.read()
+            for start in range(0, len(body), size):
+                yield body[start:start + size]
+            return
+        with BlobStore(current_app.config["FILE_BLOB_DIR"]).open(self.digest) as f:
+            while True:
+                chunk = f.read(size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+def blob_digest(file):
+    # Returns the digest of a file's body in the blob store, or None if the body is kept in the database.  Unlike
+    # file_content this doesn't touch File.text_content, so it is cheap enough to build an ETag before the body
+    # is needed
+    return db.session.scalar(select(FileBlob.digest).where(FileBlob.file_id == file.id))
+
+
+def text_size(column):
+    # Returns an expression for the size in bytes of a text column's UTF-8 value.  length() counts characters on
+    # SQLite and PostgreSQL
+    if db.engine.dialect.name == "sqlite":
+        return func.length(cast(column, LargeBinary))
+    return func.octet_length(column)
+
+
+def file_content(file):
+    # Returns the FileContent of a file with one query
+    digest, blob_size, body_size = db.session.execute(
+        select(FileBlob.digest, FileBlob.size, text_size(File.text_content))
+        .select_from(File)
+        .outerjoin(FileBlob, FileBlob.file_id == File.id)
+        .where(File.id == file.id)
+    ).one()
+    if digest is not None:
+        return FileContent(file.id, digest, blob_size)
+    return FileContent(file.id, None, body_size)
+
+
+def stream_json(fields, name, chunks):
+    # Yields the JSON encoding of fields plus a string member called name whose value is produced from chunks,
+    # so a large body can be sent without building the whole response in memory
+    head = json.dumps(fields)
+    yield head[:-1] + (", " if fields else "") + json.dumps(name) + ': "'
+    for chunk in chunks:
+        yield json.dumps(chunk)[1:-1]
+    yield '"}'
+
+
+def set_file_content(file, content):
+    # Set the body of a file in the current session, in the blob store if one is configured.  The file must have
+    # been flushed so it has an id
+    store = blob_store()
+    blob = FileBlob.query.filter_by(file_id=file.id).first()
+    if store is None:
+        file.text_content = content
+        if blob is not None:
+            db.session.delete(blob)
+        return
+
+    data = content.encode("utf-8")
+    digest = store.put(data)
+    if blob is None:
+        blob = FileBlob(file_id=file.id)
+        db.session.add(blob)
+    blob.digest = digest
+    blob.size = len(data)
+    file.text_content = None
+
+
+def insert_files(files):
+    # Insert many new files with their bodies in the current session using bulk inserts.  files is a list of dicts
+    # of File column values with the body under "content".  Bodies go to the blob store if one is configured.
+    # Returns a dict of the new files' uuids to their ids
+    store = blob_store()
+    rows = []
+    blobs = {}
+    for file in files:
+        row = dict(file)
+        content = row.pop("content")
+        if store is None:
+            row["text_content"] = content
+        else:
+            data = content.encode("utf-8")
+            blobs[row["uuid"]] = (store.put(data), len(data))
+        rows.append(row)
+    if not rows:
+        return {}
+    db.session.execute(insert(File), rows)
+
+    ids = {}
+    for chunk in chunked(row["uuid"] for row in rows):
+        ids.update(db.session.execute(select(File.uuid, File.id).where(File.uuid.in_(chunk))).all())
+    if blobs:
+        db.session.execute(insert(FileBlob), [
+            {"file_id": ids[file_uuid], "digest": digest, "size": size}
+            for file_uuid, (digest, size) in blobs.items()
+        ])
+    return ids
+
+
+def remove_file_content(file_ids):
+    # Remove the blob references of deleted files in the current session.  The blobs themselves may be shared
+    # with other files and are removed by prune_blobs
+    for chunk in chunked(file_ids):
+        db.session.execute(delete(FileBlob).where(FileBlob.file_id.in_(chunk)))
+
+
+def move_file_content_to_blobs(batch_size=100):
+    # Move bodies kept in File.text_content into the blob store.  Returns the number of files moved
+    store = blob_store()
+    if store is None:
+        raise click.ClickException("FILE_BLOB_DIR is not set")
+    moved = 0
+    while True:
+        rows = db.session.execute(
+            select(File.id, File.text_content).where(File.text_content.is_not(None)).order_by(File.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return moved
+        for file_id, content in rows:
+            data = content.encode("utf-8")
+            digest = store.put(data)
+            blob = FileBlob.query.filter_by(file_id=file_id).first() or FileBlob(file_id=file_id)
+            blob.digest = digest
+            blob.size = len(data)
+            db.session.add(blob)
+            db.session.execute(db.update(File).where(File.id == file_id).values(text_content=None))
+        db.session.commit()
+        moved += len(rows)
+
+
+def prune_blobs(min_age=3600):
+    # Remove blobs no file refers to.  Blobs younger than min_age seconds are kept because the transaction that
+    # stored them may not have committed yet.  Returns the number of blobs removed
+    store = blob_store()
+    if store is None:
+        return 0
+    cutoff = datetime.datetime.now().timestamp() - min_age
+    candidates = [digest for digest, modified in store.digests() if modified < cutoff]
+    removed = 0
+    for chunk in chunked(candidates):
+        referenced = set(db.session.scalars(select(FileBlob.digest).where(FileBlob.digest.in_(chunk))))
+        for digest in chunk:
+            if digest not in referenced:
+                store.remove(digest, older_than=cutoff)
+                removed += 1
+    return removed
+
+
+def register_commands(app):
+    @app.cli.command("move-file-content")
+    def move_file_content_command():
+        """Move file bodies stored in the database into the blob store."""
+        click.echo(f"Moved {move_file_content_to_blobs()} files to {app.config['FILE_BLOB_DIR']}")
+
+    @app.cli.command("prune-blobs")
+    def prune_blobs_command():
+        """Remove blobs that no file refers to."""
+        click.echo(f"Removed {prune_blobs()} unreferenced blobs")
@@ -0,0 +1,38 @@
+from flask import Response, request
+import hashlib
+
+# Strong ETags for file and folder responses.  An ETag has the form "<version>.<access>", where version changes
+# whenever the resource changes and access is a digest of the caller's permissions on it, so a user whose access
+# changes gets a new representation even when the resource didn't.  If-Match on writes only compares the version
+# part, since permissions are checked separately.
+
+
+def digest(*parts):
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:20]
+
+
+def make_etag(version, *access):
+    return f"{version}.{digest(*access)}"
+
+
+def file_version(file, blob_digest):
+    # The version of a file's metadata and body.  blob_digest identifies bodies in the blob store and is None for
+    # bodies kept in the database, which are versioned by the file's save counter, so the body doesn't have to be
+    # read or measured
+    return digest(str(file.uuid), file.name, file.version, blob_digest)
+
+
+def not_modified(etag):
+    # Returns a 304 response if the request's If-None-Match matches etag, otherwise None
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def precondition_failed(version):
+    # Returns True if the request has an If-Match header and none of its ETags are of the current version
+    if not request.if_match or request.if_match.star_tag:
+        return False
+    return not any(etag.split(".", 1)[0] == version for etag in request.if_match.as_set())
@@ -0,0 +1,167 @@
+from app import db
+from app.content import FileContent, text_size
+from app.models import File, FileBlob, Folder
+from app.queries import folder_subtree
+from sqlalchemy import func, select, tuple_
+import datetime
+import os
+import threading
+import zipfile
+
+# /api/export streams a folder and everything beneath it to the client as a zip archive.  The archive is written
+# by zipfile to an output that can't seek, so each file is compressed as it is read and sent on in pieces, and
+# memory use doesn't grow with the size of the folder.  Files are read a page at a time in folder and name order,
+# and each page is checked for can_read with one batch check.  Each process runs at most EXPORT_MAX_CONCURRENT
+# exports at once.
+
+# Exports running at the same time in one process
+EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', 4))
+
+# Files read and permission checked together
+EXPORT_PAGE_SIZE = 200
+
+# Zip archives can't record times before 1980
+ZIP_EPOCH = datetime.datetime(1980, 1, 1)
+
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+def acquire_export_slot():
+    # Returns True if an export may start now.  The slot must be released with release_export_slot
+    return _export_slots.acquire(blocking=False)
+
+
+def release_export_slot():
+    _export_slots.release()
+
+
+class _ZipOutput:
+    # A file object that collects what zipfile writes until it is taken.  It can tell but not seek, so zipfile
+    # writes each file's sizes after its data instead of going back to fill them in
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _safe_name(name):
+    # Folder and file names may contain characters that would change the archive's structure
+    name = (name or "").replace("/", "_").replace("\\", "_")
+    return name if name not in ("", ".", "..") else "_"
+
+
+def _unique_name(name, used):
+    # Names aren't unique within a folder, so later duplicates are numbered like "notes (2).txt"
+    if name not in used:
+        used.add(name)
+        return name
+    stem, dot, extension = name.rpartition(".")
+    if not stem:
+        stem, dot, extension = name, "", ""
+    number = 2
+    while f"{stem} ({number}){dot}{extension}" in used:
+        number += 1
+    name = f"{stem} ({number}){dot}{extension}"
+    used.add(name)
+    return name
+
+
+def folder_paths(folder):
+    # Returns (paths, used) for a folder and every folder beneath it.  paths is a dict of folder uuid to its path
+    # in the archive, parents before their children, and used a dict of folder uuid to the names its subfolders
+    # took.  The folder itself is the archive's top level directory
+    tree = folder_subtree(folder.id)
+    rows = db.session.execute(
+        select(Folder.uuid, Folder.parent, Folder.name)
+        .join(tree, Folder.id == tree.c.id)
+        .order_by(tree.c.depth, Folder.name, Folder.id)
+    ).all()
+    paths = {}
+    used = {}
+    for folder_uuid, parent, name in rows:
+        if not paths:
+            paths[folder_uuid] = _safe_name(name)
+            continue
+        name = _unique_name(_safe_name(name), used.setdefault(parent, set()))
+        paths[folder_uuid] = f"{paths[parent]}/{name}"
+    return paths, used
+
+
+def _file_pages(folder):
+    # Yields the files beneath a folder in pages of EXPORT_PAGE_SIZE rows, ordered by folder and name, with where
+    # their bodies are kept.  Pages continue from the last row of the previous page
+    tree = folder_subtree(folder.id)
+    name = func.coalesce(File.name, "")
+    after = None
+    while True:
+        query = (
+            select(File.id, File.uuid, File.folder, File.name, File.updated,
+                   FileBlob.digest, FileBlob.size, text_size(File.text_content))
+            .outerjoin(FileBlob, FileBlob.file_id == File.id)
+            .where(File.folder.in_(select(tree.c.uuid)))
+            .order_by(File.folder, name, File.id)
+            .limit(EXPORT_PAGE_SIZE)
+        )
+        if after is not None:
+            query = query.where(tuple_(File.folder, name, File.id) > tuple_(*after))
+        page = db.session.execute(query).all()
+        if not page:
+            return
+        yield page
+        last = page[-1]
+        after = (last.folder, last.name or "", last.id)
+
+
+def export_zip(folder, can_read):
+    # Yields a zip archive of a folder and everything beneath it in pieces.  can_read is called with a list of
+    # file uuids and returns a list of booleans saying which of them to include
+    paths, folder_names = folder_paths(folder)
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for path in paths.values():
+            archive.writestr(zipfile.ZipInfo(f"{path}/", ZIP_EPOCH.timetuple()[:6]), b"")
+        yield output.take()
+
+        # Files share each folder's names with its subfolders, since a file and a directory can't have the same
+        # path in the archive
+        used = {}
+        for page in _file_pages(folder):
+            allowed = can_read([row.uuid for row in page])
+            for row, include in zip(page, allowed):
+                if not include:
+                    continue
+                if row.folder not in used:
+                    used[row.folder] = set(folder_names.get(row.folder, ()))
+                name = _unique_name(_safe_name(row.name), used[row.folder])
+                if len(used) > 1:
+                    # Rows come in folder order, so names used in earlier folders are no longer needed
+                    used = {row.folder: used[row.folder]}
+                info = zipfile.ZipInfo(f"{paths[row.folder]}/{name}", max(row.updated or ZIP_EPOCH, ZIP_EPOCH).timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                if row.digest is not None:
+                    content = FileContent(row.id, row.digest, row.size)
+                else:
+                    content = FileContent(row.id, None, row[7])
+                with archive.open(info, "w") as body:
+                    for chunk in content.chunks():
+                        body.write(chunk.encode("utf-8"))
+                        data = output.take()
+                        if data:
+                            yield data
+                yield output.take()
+    yield output.take()
@@ -0,0 +1,86 @@
+from openfga_sdk.client import OpenFgaClient
+from app import fga_resilience
+import asyncio
+import atexit
+import threading
+
+# Flask runs each async view in a new event loop, but the SDK's async client keeps an aiohttp session that is
+# bound to the loop it was created on.  The async client is therefore owned by one long running event loop in a
+# daemon thread, and async views await its calls through call(), so connections are reused across requests and
+# many checks from one request can be in flight at once.
+
+_loop = None
+_client = None
+_limit = None
+_lock = threading.Lock()
+
+# The parent's loop and client, kept alive in a forked child.  If they were garbage collected the child would
+# unregister the parent's sockets from the epoll instance both processes share and close its connections
+_inherited = []
+
+
+def start(configuration, max_parallel_requests):
+    # Start the FGA event loop and create the async client on it if that hasn't happened yet in this process
+    global _loop, _client, _limit
+    with _lock:
+        if _client is not None:
+            return _client
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="fga-async", daemon=True).start()
+
+        async def create_client():
+            client = OpenFgaClient(configuration)
+            await client.read_authorization_models()
+            return client, asyncio.Semaphore(max_parallel_requests)
+
+        try:
+            _client, _limit = asyncio.run_coroutine_threadsafe(create_client(), loop).result()
+        except Exception:
+            loop.call_soon_threadsafe(loop.stop)
+            raise
+        _loop = loop
+        atexit.register(stop)
+        return _client
+
+
+def stop():
+    # Close the async client's connections and stop the FGA event loop
+    global _loop, _client, _limit
+    with _lock:
+        if _client is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(_client.close(), _loop).result(timeout=5)
+        finally:
+            _loop.call_soon_threadsafe(_loop.stop)
+            _loop = _client = _limit = None
+
+
+def reset_after_fork():
+    # Forget the parent's loop and client in a forked child.  The parent's loop thread doesn't exist in the child
+    # and its lock may have been held at the time of the fork
+    global _loop, _client, _limit, _lock
+    if _client is not None:
+        _inherited.append((_loop, _client, _limit))
+    _loop = _client = _limit = None
+    _lock = threading.Lock()
+
+
+def is_started():
+    return _client is not None
+
+
+async def call(method, *args, **kwargs):
+    # Call an OpenFGA client method on the FGA event loop and wait for the result from the caller's loop.
+    # At most max_parallel_requests calls are sent to OpenFGA at the same time.  The call is timed and given its
+    # deadline from the caller's side, so time spent waiting for a free slot counts towards both.  Abandoning the
+    # wait cancels the call on the FGA event loop.
+    async def limited():
+        async with _limit:
+            return await getattr(_client, method)(*args, **kwargs)
+
+    def attempt():
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(limited(), _loop))
+
+    return await fga_resilience.call_async(method, attempt, read=method != "write")
@@ -0,0 +1,261 @@
+from app import metrics
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
+from openfga_sdk.exceptions import FgaValidationException, NotFoundException, ValidationException
+import asyncio
+import logging
+import os
+import threading
+import time
+
+# Every call to OpenFGA goes through call() or call_async(), which give it a deadline and route it through a
+# circuit breaker.  When too many recent calls fail or are slow the breaker opens and calls are rejected at once
+# with CircuitOpenError instead of tying up worker threads, until a probe call after FGA_BREAKER_OPEN_SECONDS
+# succeeds.  Failed calls raise FgaUnavailable, except for client errors such as validation errors.  Read calls can
+# also be hedged: if the first attempt hasn't answered after FGA_HEDGE_AFTER_MS a second one is sent and whichever
+# answers first is used.  The fga_* helpers in app/routes.py fall back to the last known decision when a read
+# raises FgaUnavailable, and queue writes in the outbox.
+
+logger = logging.getLogger(__name__)
+
+# Calls are abandoned after these many milliseconds, including the SDK's own retries
+READ_DEADLINE = int(os.getenv('FGA_READ_DEADLINE_MS', 2000)) / 1000
+WRITE_DEADLINE = int(os.getenv('FGA_WRITE_DEADLINE_MS', 5000)) / 1000
+
+# Reads still unanswered after this many milliseconds are sent a second time.  0 turns hedging off
+HEDGE_AFTER = int(os.getenv('FGA_HEDGE_AFTER_MS', 0)) / 1000
+
+# Synchronous calls run on this many threads, the same as the size of the sync client's connection pool, so a
+# stalled OpenFGA can hold at most this many threads rather than every request thread
+CALL_THREADS = int(os.getenv('FGA_POOL_SIZE', 20))
+
+# Errors that mean the request was wrong rather than that OpenFGA is unhealthy
+CLIENT_ERRORS = (FgaValidationException, ValidationException, NotFoundException)
+
+
+class FgaUnavailable(Exception):
+    pass
+
+
+class CircuitOpenError(FgaUnavailable):
+    pass
+
+
+class DeadlineExceeded(FgaUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    # Tracks the outcome of the calls made in the last window seconds.  Once at least min_calls were made and
+    # error_rate of them failed, or slow_rate of them took longer than slow_call seconds, the breaker opens for
+    # open_for seconds.  The first call after that is let through as a probe and closes the breaker if it succeeds
+    # quickly, otherwise the breaker opens again.
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window=30, min_calls=20, error_rate=0.5, slow_call=1.0, slow_rate=0.8, open_for=10):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.state = self.CLOSED
+        self._calls = deque()
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        # Returns True if a call may be made now
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.open_for:
+                self.state = self.HALF_OPEN
+                logger.info("OpenFGA circuit breaker half open, sending a probe call")
+                return True
+            return False
+
+    def record(self, succeeded, elapsed):
+        slow = elapsed >= self.slow_call
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if succeeded and not slow:
+                    self._close()
+                else:
+                    self._open()
+                return
+            now = time.monotonic()
+            self._calls.append((now, not succeeded, slow))
+            self._failures += not succeeded
+            self._slow += slow
+            while self._calls and now - self._calls[0][0] > self.window:
+                expired, failed, was_slow = self._calls.popleft()
+                self._failures -= failed
+                self._slow -= was_slow
+            calls = len(self._calls)
+            if self.state == self.CLOSED and calls >= self.min_calls and (
+                self._failures >= calls * self.error_rate or self._slow >= calls * self.slow_rate
+            ):
+                self._open()
+
+    def release(self):
+        # Called for a call that ended without an outcome, e.g. one that was cancelled.  If it was the probe, the
+        # next call is let through as the probe instead
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def _open(self):
+        logger.warning("OpenFGA circuit breaker open for %ss after %s failed and %s slow of %s calls",
+                       self.open_for, self._failures, self._slow, len(self._calls))
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+
+    def _close(self):
+        logger.info("OpenFGA circuit breaker closed")
+        self.state = self.CLOSED
+        self._calls.clear()
+        self._failures = 0
+        self._slow = 0
+
+
+breaker = CircuitBreaker(
+    window=float(os.getenv('FGA_BREAKER_WINDOW', 30)),
+    min_calls=int(os.getenv('FGA_BREAKER_MIN_CALLS', 20)),
+    error_rate=float(os.getenv('FGA_BREAKER_ERROR_RATE', 0.5)),
+    slow_call=int(os.getenv('FGA_BREAKER_SLOW_CALL_MS', 1000)) / 1000,
+    slow_rate=float(os.getenv('FGA_BREAKER_SLOW_RATE', 0.8)),
+    open_for=float(os.getenv('FGA_BREAKER_OPEN_SECONDS', 10)),
+)
+
+rejected_calls = metrics.Counter(
+    "app_fga_rejected_calls_total", "OpenFGA calls rejected because the circuit breaker was open.", ("operation",))
+deadline_exceeded = metrics.Counter(
+    "app_fga_deadline_exceeded_total", "OpenFGA calls abandoned at their deadline.", ("operation",))
+hedged_calls = metrics.Counter(
+    "app_fga_hedged_calls_total", "OpenFGA reads sent a second time because the first was slow.", ("operation",))
+stale_decisions = metrics.Counter(
+    "app_fga_stale_decisions_total", "Last known decisions used because OpenFGA was unavailable.", ("operation",))
+metrics.Gauge(
+    "app_fga_circuit_open", "1 while the OpenFGA circuit breaker is rejecting calls.", lambda: int(breaker.state == CircuitBreaker.OPEN))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _call_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CALL_THREADS, thread_name_prefix="fga-call")
+        return _executor
+
+
+def _reset_after_fork():
+    # The executor's threads don't exist in a forked child
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+    breaker._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _start(operation):
+    if not breaker.allow():
+        rejected_calls.inc(operation)
+        raise CircuitOpenError(f"OpenFGA circuit breaker is open, {operation} call rejected")
+    return time.perf_counter()
+
+
+def _finish(operation, start, error=None):
+    # Record the outcome of a call and return the error to raise for it, if any.  Failures other than client
+    # errors, e.g. timeouts, connection errors and 5xx responses, are raised as FgaUnavailable
+    breaker.record(error is None or isinstance(error, CLIENT_ERRORS), time.perf_counter() - start)
+    if isinstance(error, DeadlineExceeded):
+        deadline_exceeded.inc(operation)
+    if error is None or isinstance(error, (FgaUnavailable,) + CLIENT_ERRORS):
+        return error
+    unavailable = FgaUnavailable(f"OpenFGA {operation} call failed: {error}")
+    unavailable.__cause__ = error
+    return unavailable
+
+
+def call(operation, fn, *args, read=True):
+    # Call fn(*args), a synchronous OpenFGA client method, with a deadline and through the circuit breaker
+    start = _start(operation)
+    deadline = start + (READ_DEADLINE if read else WRITE_DEADLINE)
+    executor = _call_executor()
+    with metrics.fga_call(operation):
+        try:
+            pending = {executor.submit(fn, *args)}
+            hedge_at = start + HEDGE_AFTER if read and HEDGE_AFTER else None
+            error = None
+            while pending:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                wait_until = min(deadline, hedge_at) if hedge_at else deadline
+                done, pending = wait(pending, timeout=wait_until - now, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        _finish(operation, start)
+                        return future.result()
+                    error = future.exception()
+                if hedge_at and time.perf_counter() >= hedge_at:
+                    hedge_at = None
+                    if pending:
+                        hedged_calls.inc(operation)
+                        pending.add(executor.submit(fn, *args))
+            if error is None or pending:
+                error = DeadlineExceeded(f"OpenFGA {operation} call did not finish within its deadline")
+        except Exception as e:
+            error = e
+        raise _finish(operation, start, error)
+
+
+async def call_async(operation, attempt, read=True):
+    # Await attempt(), a function returning a new awaitable OpenFGA call each time it is called, with a deadline
+    # and through the circuit breaker.  Attempts still running at the deadline or after another attempt answered
+    # are cancelled
+    start = _start(operation)
+    deadline = start + (READ_DEADLINE if read else WRITE_DEADLINE)
+    with metrics.fga_call(operation):
+        pending = {asyncio.ensure_future(attempt())}
+        try:
+            hedge_at = start + HEDGE_AFTER if read and HEDGE_AFTER else None
+            error = None
+            while pending:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                wait_until = min(deadline, hedge_at) if hedge_at else deadline
+                done, pending = await asyncio.wait(pending, timeout=wait_until - now, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        _finish(operation, start)
+                        return task.result()
+                    error = task.exception()
+                if hedge_at and time.perf_counter() >= hedge_at:
+                    hedge_at = None
+                    if pending:
+                        hedged_calls.inc(operation)
+                        pending.add(asyncio.ensure_future(attempt()))
+            if error is None or pending:
+                error = DeadlineExceeded(f"OpenFGA {operation} call did not finish within its deadline")
+        except asyncio.CancelledError:
+            # The caller gave up on the call, so OpenFGA's health is unknown
+            breaker.release()
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            for task in pending:
+                task.cancel()
+        raise _finish(operation, start, error)
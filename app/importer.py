@@ -0,0 +1,272 @@
+from app import db
+from app.content import insert_files
+from app.models import Folder
+from app.outbox import enqueue_tuples
+from app.search import index_files
+from sqlalchemy import insert
+import logging
+import os
+import tarfile
+import tempfile
+import uuid
+import zipfile
+import zlib
+
+# Archives uploaded to /api/import are unpacked into a folder without holding the upload in memory.  Tar archives,
+# compressed or not, are read one member at a time straight from the request body.  Zip archives keep their index
+# at the end, so an upload that can't seek is first copied to a temporary file, which only stays in memory while
+# it is small.  Folders and files are added with bulk inserts and their owner and parent tuples queued in the
+# tuple outbox, which writes them to OpenFGA in multi-tuple writes.  Each batch is committed, so a large import
+# doesn't hold a long write transaction.
+
+logger = logging.getLogger(__name__)
+
+# An import stops after this many folders and files
+IMPORT_MAX_ENTRIES = int(os.getenv('IMPORT_MAX_ENTRIES', 10000))
+
+# Files larger than this many bytes are skipped
+IMPORT_MAX_FILE_SIZE = int(os.getenv('IMPORT_MAX_FILE_SIZE', 10 * 1024 * 1024))
+
+# An import stops once the files it has imported add up to this many bytes, and zip uploads that can't seek are
+# refused if they are larger than this
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 256 * 1024 * 1024))
+
+# A batch is committed once it holds this many folders and files or this many bytes of file bodies
+IMPORT_BATCH_SIZE = 500
+IMPORT_BATCH_BYTES = 8 * 1024 * 1024
+
+# Uploads are kept in memory up to this size while being spooled for a zip archive
+SPOOL_MEMORY_SIZE = 1024 * 1024
+
+# Folder and file names are at most this long
+MAX_NAME_LENGTH = 128
+
+# At most this many skipped entries are listed in the result
+MAX_SKIPPED_LISTED = 100
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _PrefixedStream:
+    # A stream that returns prefix before the rest of stream, so the start of an upload that can't seek can be
+    # inspected and then read again
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def _read_limited(member):
+    # Returns the body of a member, reading at most one byte more than IMPORT_MAX_FILE_SIZE
+    with member:
+        return member.read(IMPORT_MAX_FILE_SIZE + 1)
+
+
+def _copy_limited(source, destination, limit, chunk_size=64 * 1024):
+    # Copy source to destination, raising ArchiveError if it holds more than limit bytes
+    copied = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise ArchiveError(f"Zip archives larger than {limit} bytes can't be imported")
+        destination.write(chunk)
+
+
+def _zip_members(stream):
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE) as spool:
+        if not stream.seekable():
+            _copy_limited(stream, spool, IMPORT_MAX_BYTES)
+            spool.seek(0)
+            stream = spool
+        try:
+            archive = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Not a valid zip archive: {e}")
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    yield info.filename, True, None
+                else:
+                    yield info.filename, False, lambda info=info: _read_limited(archive.open(info))
+
+
+def _tar_members(stream):
+    try:
+        archive = tarfile.open(fileobj=stream, mode="r|*")
+        with archive:
+            for member in archive:
+                if member.isdir():
+                    yield member.name, True, None
+                elif member.isfile():
+                    yield member.name, False, lambda member=member: _read_limited(archive.extractfile(member))
+                else:
+                    # Links and devices have no body to import
+                    yield member.name, None, None
+    except tarfile.TarError as e:
+        raise ArchiveError(f"Not a valid zip or tar archive: {e}")
+
+
+def archive_members(stream):
+    # Yields (path, is_dir, read) for each member of a zip or tar archive read from stream.  read() returns the
+    # body of a file.  is_dir is None for members that are neither files nor directories
+    if getattr(stream, "seekable", lambda: False)():
+        head = stream.read(4)
+        stream.seek(0)
+    else:
+        head = stream.read(4)
+        stream = _PrefixedStream(head, stream)
+    if head.startswith(b"PK\x03\x04") or head.startswith(b"PK\x05\x06"):
+        return _zip_members(stream)
+    return _tar_members(stream)
+
+
+def _split_path(name):
+    # Returns the folder and file names of a member path, or None if the path climbs out of the archive
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if ".." in parts:
+        return None
+    return parts
+
+
+class ArchiveImport:
+    # Creates the folders and files of an archive beneath the folder parent_uuid, owned by user
+
+    def __init__(self, parent_uuid, user):
+        self.user = user
+        # Path of each folder created, as a tuple of names, to its uuid.  The empty path is the target folder
+        self.folders = {(): parent_uuid}
+        self.folder_rows = []
+        self.file_rows = []
+        self.tuples = []
+        self.pending_bytes = 0
+        self.imported_bytes = 0
+        self.folder_count = 0
+        self.file_count = 0
+        self.skipped = []
+        self.skipped_count = 0
+        self.truncated = False
+
+    def folder(self, parts):
+        # Returns the uuid of the folder at the path parts, creating it and its parents if needed
+        parts = tuple(parts)
+        folder_uuid = self.folders.get(parts)
+        if folder_uuid is None:
+            parent_uuid = self.folder(parts[:-1])
+            folder_uuid = self.folders[parts] = uuid.uuid4()
+            self.folder_rows.append({
+                "uuid": folder_uuid, "parent": parent_uuid, "creator": self.user.id, "name": parts[-1], "default_folder": False,
+            })
+            self.tuples.append((f"user:{self.user.uuid}", "owner", f"folder:{folder_uuid}"))
+            self.tuples.append((f"folder:{parent_uuid}", "parent", f"folder:{folder_uuid}"))
+            self.folder_count += 1
+        return folder_uuid
+
+    def add_file(self, parts, content):
+        parent_uuid = self.folder(parts[:-1])
+        file_uuid = uuid.uuid4()
+        self.file_rows.append({"uuid": file_uuid, "folder": parent_uuid, "creator": self.user.id, "name": parts[-1], "content": content})
+        self.tuples.append((f"user:{self.user.uuid}", "owner", f"file:{file_uuid}"))
+        self.tuples.append((f"folder:{parent_uuid}", "parent", f"file:{file_uuid}"))
+        self.file_count += 1
+        self.pending_bytes += len(content)
+
+    def skip(self, path, reason):
+        self.skipped_count += 1
+        if len(self.skipped) < MAX_SKIPPED_LISTED:
+            self.skipped.append({"path": path, "reason": reason})
+
+    def flush(self):
+        # Insert the pending folders and files and queue their tuples, then commit
+        if self.folder_rows:
+            db.session.execute(insert(Folder), self.folder_rows)
+        ids = insert_files(self.file_rows)
+        index_files([(ids[row["uuid"]], row["name"], row["content"]) for row in self.file_rows])
+        enqueue_tuples(self.tuples)
+        db.session.commit()
+        self.folder_rows = []
+        self.file_rows = []
+        self.tuples = []
+        self.pending_bytes = 0
+
+    def run(self, members):
+        # Import every member yielded by archive_members.  Returns a summary of what was imported.  If the archive
+        # turns out to be damaged, what was read before the damage is kept and ArchiveError is raised
+        try:
+            for path, is_dir, read in members:
+                parts = _split_path(path)
+                if parts is None:
+                    self.skip(path, "Path outside the archive")
+                    continue
+                if not parts or parts[0] == "__MACOSX":
+                    # The archive root and macOS resource forks
+                    continue
+                if is_dir is None:
+                    self.skip(path, "Not a regular file")
+                    continue
+                if any(len(part) > MAX_NAME_LENGTH for part in parts):
+                    self.skip(path, f"Name longer than {MAX_NAME_LENGTH} characters")
+                    continue
+                if self.folder_count + self.file_count >= IMPORT_MAX_ENTRIES:
+                    self.truncated = True
+                    break
+
+                if is_dir:
+                    self.folder(parts)
+                else:
+                    try:
+                        data = read()
+                    except (RuntimeError, NotImplementedError) as e:
+                        # Encrypted zip members and unsupported compression methods
+                        self.skip(path, str(e))
+                        continue
+                    if len(data) > IMPORT_MAX_FILE_SIZE:
+                        self.skip(path, f"Larger than {IMPORT_MAX_FILE_SIZE} bytes")
+                        continue
+                    if self.imported_bytes + len(data) > IMPORT_MAX_BYTES:
+                        self.truncated = True
+                        break
+                    self.imported_bytes += len(data)
+                    try:
+                        content = data.decode("utf-8")
+                    except UnicodeDecodeError:
+                        self.skip(path, "Not UTF-8 text")
+                        continue
+                    self.add_file(parts, content)
+
+                if len(self.folder_rows) + len(self.file_rows) >= IMPORT_BATCH_SIZE or self.pending_bytes >= IMPORT_BATCH_BYTES:
+                    self.flush()
+        except (ArchiveError, zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+            # zlib.error and EOFError come from corrupt compressed members and truncated gzip streams
+            self.flush()
+            raise ArchiveError(str(e) if isinstance(e, ArchiveError) else f"Archive could not be read: {e}")
+        self.flush()
+
+        logger.info("Imported %s folders and %s files, skipped %s", self.folder_count, self.file_count, self.skipped_count)
+        return self.summary()
+
+    def summary(self):
+        return {
+            "folders": self.folder_count,
+            "files": self.file_count,
+            "skipped_count": self.skipped_count,
+            "skipped": self.skipped,
+            "truncated": self.truncated,
+        }
@@ -0,0 +1,120 @@
+from app import db
+from app.models import Job
+from flask import current_app
+import datetime
+import logging
+import os
+import threading
+import uuid
+
+# Runs long operations in a background thread so the request that starts them can return immediately.  Each job
+# has a row in the job table that the work updates as it progresses and that clients poll through /api/jobs.
+# Jobs run inside a web worker and die with it when the worker is restarted, so a running job touches its row's
+# updated time every JOB_HEARTBEAT_INTERVAL seconds and a job that hasn't for JOB_STALE_AFTER seconds is reported
+# as failed.  Job functions commit their work in one transaction, so an interrupted job leaves nothing half done
+# and can simply be started again.
+
+logger = logging.getLogger(__name__)
+
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_STALE_AFTER = float(os.getenv('JOB_STALE_AFTER', 60))
+
+
+class JobProgress:
+    # Passed to the job function to report progress.  Updates are committed at most every interval seconds so
+    # progress reporting doesn't dominate the work
+    def __init__(self, job_id, interval=1.0):
+        self.job_id = job_id
+        self.interval = interval
+        self.done = 0
+        self.total = 0
+        self._last_update = None
+
+    def __call__(self, done=None, total=None, message=None, force=False):
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        now = datetime.datetime.utcnow()
+        if not force and self._last_update is not None and (now - self._last_update).total_seconds() < self.interval:
+            return
+        self._last_update = now
+        _update(self.job_id, done=self.done, total=self.total, message=message)
+
+
+def _update(job_id, **values):
+    # Job updates are written on their own connection so they are visible while the job's work is uncommitted
+    values["updated"] = datetime.datetime.utcnow()
+    values = {name: value for name, value in values.items() if value is not None}
+    with db.engine.begin() as connection:
+        connection.execute(db.update(Job).where(Job.id == job_id).values(**values))
+
+
+def _heartbeat(app, job_id, stopped):
+    with app.app_context():
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                _update(job_id)
+            except Exception:
+                logger.warning("Unable to record the heartbeat of job %s", job_id, exc_info=True)
+
+
+def _run(app, job_id, fn, args):
+    with app.app_context():
+        progress = JobProgress(job_id)
+        _update(job_id, status="running")
+        stopped = threading.Event()
+        threading.Thread(target=_heartbeat, args=(app, job_id, stopped), name=f"job-{job_id}-heartbeat", daemon=True).start()
+        try:
+            message = fn(*args, progress=progress)
+            _update(job_id, status="complete", done=progress.total or progress.done, total=progress.total, message=message)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Job %s failed", job_id)
+            _update(job_id, status="failed", message=str(e))
+        finally:
+            stopped.set()
+            db.session.remove()
+
+
+def start_job(kind, user_id, fn, *args):
+    # Create a job and run fn(*args, progress=...) in a background thread.  fn's return value is stored as the
+    # job's message.  Returns the Job
+    job = Job(uuid=uuid.uuid4(), kind=kind, user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    threading.Thread(target=_run, args=(app, job.id, fn, args), name=f"job-{job.uuid}", daemon=True).start()
+    return job
+
+
+def fail_if_interrupted(job):
+    # Mark a pending or running job whose heartbeat stopped as failed, e.g. because the worker running it was
+    # restarted.  Returns the job, refreshed if it was changed
+    if job.status not in ("pending", "running"):
+        return job
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=JOB_STALE_AFTER)
+    if job.updated is not None and job.updated >= cutoff:
+        return job
+    result = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job.id, Job.status.in_(("pending", "running")), Job.updated < cutoff)
+        .values(status="failed", message="The job was interrupted before it finished.  Nothing was changed, start it again", updated=datetime.datetime.utcnow())
+    )
+    db.session.commit()
+    if result.rowcount:
+        logger.warning("Job %s stopped sending heartbeats and was marked failed", job.id)
+    db.session.refresh(job)
+    return job
+
+
+def job_status(job):
+    return {
+        "job_uuid": str(job.uuid),
+        "kind": job.kind,
+        "status": job.status,
+        "done": job.done,
+        "total": job.total,
+        "message": job.message,
+    }
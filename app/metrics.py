@@ -0,0 +1,245 @@
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Request instrumentation.  Every database query and every call made to OpenFGA is counted and timed against the
+# request that made it, and queries and calls made outside a request, e.g. by the outbox worker, are still timed.
+# The totals are sent back in a Server-Timing header, so they show up in the browser's network panel, and are
+# recorded in Prometheus histograms per route which /metrics serves in the Prometheus text format.  Metrics are
+# kept per process, so with several gunicorn workers each scrape sees one worker.
+
+# Histogram bucket upper bounds, in seconds for durations
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FGA_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+# Every metric created, in the order they are rendered
+REGISTRY = []
+
+
+class Histogram:
+    # A Prometheus histogram with a series for each combination of label values
+
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS):
+        REGISTRY.append(self)
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [cumulative bucket counts, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index in range(bisect_left(self.buckets, value), len(counts)):
+                counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label_values, list(counts), total, count) for label_values, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in sorted(series):
+            labels = list(zip(self.labels, label_values))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(labels + [('le', repr(float(bound)))])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    # A Prometheus counter with a series for each combination of label values
+
+    def __init__(self, name, help, labels=()):
+        REGISTRY.append(self)
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_values, value in series:
+            lines.append(f"{self.name}{_labels(list(zip(self.labels, label_values)))} {value}")
+        return lines
+
+
+class Gauge:
+    # A Prometheus gauge whose value is read from a function when rendered
+
+    def __init__(self, name, help, read):
+        REGISTRY.append(self)
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+request_duration = Histogram(
+    "app_request_duration_seconds", "Time taken to handle a request.", ("route", "method"))
+request_db_queries = Histogram(
+    "app_request_db_queries", "Database queries made by a request.", ("route",), COUNT_BUCKETS)
+request_db_seconds = Histogram(
+    "app_request_db_seconds", "Time a request spent in database queries.", ("route",))
+request_fga_calls = Histogram(
+    "app_request_fga_calls", "OpenFGA calls made by a request.", ("route",), COUNT_BUCKETS)
+request_fga_seconds = Histogram(
+    "app_request_fga_seconds", "Time a request spent waiting on OpenFGA calls.", ("route",))
+db_query_duration = Histogram(
+    "app_db_query_duration_seconds", "Time taken by a database query.", (), DB_BUCKETS)
+fga_call_duration = Histogram(
+    "app_fga_call_duration_seconds", "Time taken by an OpenFGA call, by API operation.", ("operation",), FGA_BUCKETS)
+
+
+class RequestTimings:
+    # Query and OpenFGA call counts and times for one request.  Concurrent OpenFGA calls from an async view are
+    # timed as the wall clock time during which at least one call was in flight, so fga_seconds never exceeds
+    # the time the request took.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.fga_calls = 0
+        self.fga_seconds = 0.0
+        self._fga_in_flight = 0
+        self._fga_since = 0.0
+
+    def fga_started(self):
+        self.fga_calls += 1
+        if self._fga_in_flight == 0:
+            self._fga_since = time.perf_counter()
+        self._fga_in_flight += 1
+
+    def fga_finished(self):
+        self._fga_in_flight -= 1
+        if self._fga_in_flight == 0:
+            self.fga_seconds += time.perf_counter() - self._fga_since
+
+
+def current_timings():
+    # Returns the RequestTimings of the current request, or None outside a request
+    if not has_request_context():
+        return None
+    return g.get("request_timings")
+
+
+def route_name():
+    return request.endpoint or "unmatched"
+
+
+@contextmanager
+def fga_call(operation):
+    # Time an OpenFGA call.  operation is the client method called, e.g. "check", "list_objects" or "write".
+    # Usable around an await, since the timings of a request are only touched from the thread running it
+    timings = current_timings()
+    if timings is not None:
+        timings.fga_started()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        fga_call_duration.observe(time.perf_counter() - start, operation)
+        if timings is not None:
+            timings.fga_finished()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    db_query_duration.observe(elapsed)
+    timings = current_timings()
+    if timings is not None:
+        timings.db_queries += 1
+        timings.db_seconds += elapsed
+
+
+def _start_request():
+    g.request_timings = RequestTimings()
+
+
+def _add_server_timing(response):
+    timings = g.get("request_timings")
+    if timings is None:
+        return response
+    total = time.perf_counter() - timings.start
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={timings.db_seconds * 1000:.1f};desc="{timings.db_queries} queries", '
+        f'fga;dur={timings.fga_seconds * 1000:.1f};desc="{timings.fga_calls} calls", '
+        f'app;dur={total * 1000:.1f}',
+    )
+    return response
+
+
+def _record_request(error=None):
+    # Runs when the request context is torn down, which for a streamed response is after the body is sent
+    timings = g.pop("request_timings", None)
+    if timings is None:
+        return
+    route = route_name()
+    request_duration.observe(time.perf_counter() - timings.start, route, request.method)
+    request_db_queries.observe(timings.db_queries, route)
+    request_db_seconds.observe(timings.db_seconds, route)
+    request_fga_calls.observe(timings.fga_calls, route)
+    request_fga_seconds.observe(timings.fga_seconds, route)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response():
+    return Response(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    # Time every request of the app.  The Server-Timing header is only sent with SERVER_TIMING=true
+    app.before_request(_start_request)
+    if app.config["SERVER_TIMING"]:
+        app.after_request(_add_server_timing)
+    app.teardown_request(_record_request)
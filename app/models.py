@@ -3,6 +3,13 @@ import datetime
 
 # The classes in this file represent our database table and schemas for SQLAlchemy
 
+# A string column compared byte by byte.  SQLite compares strings that way by default
+BINARY_STRING = (
+    db.String(255)
+    .with_variant(db.String(255, collation="C"), "postgresql")
+    .with_variant(db.String(255, collation="utf8mb4_bin"), "mysql", "mariadb")
+)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     uuid = db.Column(db.Uuid, unique=True, nullable=False)
@@ -13,26 +20,58 @@ class User(db.Model):
 
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(255))
+    name = db.Column(db.String(255), index=True)
     uuid = db.Column(db.Uuid, unique=True, nullable=False)
     creator = db.Column(db.Integer)
 
 class UserGroup(db.Model):
+    # A user can only be a member of a group once.  The unique index also serves lookups by user_id alone
+    __table_args__ = (
+        db.Index('uq_user_group_user_id_group_id', 'user_id', 'group_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, nullable=False)
-    group_id = db.Column(db.Integer, nullable=False)
+    group_id = db.Column(db.Integer, nullable=False, index=True)
 
 class File(db.Model):
+    # Used to page through a folder's files in name or creation order.  They also serve lookups by folder alone
+    __table_args__ = (
+        db.Index('ix_file_folder_name', 'folder', 'name'),
+        db.Index('ix_file_folder_created', 'folder', 'created'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     uuid = db.Column(db.Uuid, unique=True, nullable=False)
     folder = db.Column(db.Uuid, nullable=False)
     name = db.Column(db.String(128), nullable=True)
-    text_content = db.Column(db.Text, nullable=True)
+    # File bodies are only loaded when the attribute is accessed so listings don't read them.  Bodies kept in the
+    # blob store (see FileBlob) leave this empty
+    text_content = db.deferred(db.Column(db.Text, nullable=True))
     creator = db.Column(db.Integer)
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Incremented by every save.  ETags are built from it rather than from updated, which some databases store
+    # to the second
+    version = db.Column(db.Integer, default=1, server_default="1", nullable=False)
+
+class FileBlob(db.Model):
+    # A file body kept in the content addressed blob store instead of in File.text_content.  digest is the
+    # SHA-256 of the UTF-8 encoded body and size its length in bytes
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    file_id = db.Column(db.Integer, unique=True, nullable=False)
+    digest = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
 
 class Folder(db.Model):
+    # Used to find a user's default folder and to page through a folder's subfolders in name or creation order.
+    # The parent indexes also serve lookups by parent alone
+    __table_args__ = (
+        db.Index('ix_folder_creator_default_folder', 'creator', 'default_folder'),
+        db.Index('ix_folder_parent_name', 'parent', 'name'),
+        db.Index('ix_folder_parent_created', 'parent', 'created'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     uuid = db.Column(db.Uuid, unique=True, nullable=False)
     creator = db.Column(db.Integer)
@@ -41,3 +80,90 @@ class Folder(db.Model):
     parent = db.Column(db.Uuid, nullable=True)
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class FolderShare(db.Model):
+    # A folder shared with a user or a group through share_folder.  subject_type is "user" or "group" and
+    # subject_id is the id of the User or Group row
+    __table_args__ = (
+        db.Index('uq_folder_share_folder_subject_relation', 'folder_id', 'subject_type', 'subject_id', 'relation', unique=True),
+        db.Index('ix_folder_share_subject_type_subject_id', 'subject_type', 'subject_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    folder_id = db.Column(db.Integer, nullable=False)
+    subject_type = db.Column(db.String(5), nullable=False)
+    subject_id = db.Column(db.Integer, nullable=False)
+    relation = db.Column(db.String(32), nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class SharedFolder(db.Model):
+    # The materialized "shared with me" index.  One row per user for every FolderShare that grants them access,
+    # directly or through a group they are a member of
+    __table_args__ = (
+        db.Index('uq_shared_folder_user_id_share_id', 'user_id', 'share_id', unique=True),
+        db.Index('ix_shared_folder_share_id', 'share_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    folder_id = db.Column(db.Integer, nullable=False)
+    share_id = db.Column(db.Integer, nullable=False)
+
+class AutocompleteEntry(db.Model):
+    # The prefix index searched by the user and group autocompletes.  key is the user's email or the group's
+    # name normalized by app.autocomplete.normalize_key so lookups are case-insensitive, and ref_id is the id of
+    # the User or Group row.  key is compared and sorted by code point (see prefix_filter), so it uses a binary
+    # collation on databases whose default collation is locale aware.  Tables created before this need the column
+    # altered by hand, for example ALTER TABLE autocomplete_entry ALTER COLUMN key TYPE varchar(255) COLLATE "C"
+    __table_args__ = (
+        db.Index('ix_autocomplete_entry_kind_key_ref_id', 'kind', 'key', 'ref_id'),
+        db.Index('uq_autocomplete_entry_kind_ref_id', 'kind', 'ref_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(5), nullable=False)
+    key = db.Column(BINARY_STRING, nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False)
+
+class Job(db.Model):
+    # Long running work started by a request, such as deleting a large folder tree.  Progress is stored in the
+    # database so any worker process can report it
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    uuid = db.Column(db.Uuid, unique=True, nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), default="pending", nullable=False)
+    done = db.Column(db.Integer, default=0, nullable=False)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    message = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class TupleOutbox(db.Model):
+    # Pending OpenFGA tuple writes and deletes.  Rows are added in the same transaction as the data they
+    # describe and are removed by the outbox worker once they have been written to OpenFGA
+    __table_args__ = (
+        db.Index('ix_tuple_outbox_failed_next_attempt', 'failed', 'next_attempt'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    operation = db.Column(db.String(6), nullable=False)
+    user = db.Column(db.String(255), nullable=False)
+    relation = db.Column(db.String(64), nullable=False)
+    object = db.Column(db.String(255), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    failed = db.Column(db.Boolean, default=False, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+def prefix_filter(column, prefix):
+    # Returns a filter matching values of column that start with prefix.  Unlike LIKE 'prefix%' this is written as
+    # a range so it can use an ordinary index on every database.  The range only holds in code point order, so
+    # column must use a binary collation such as BINARY_STRING.  Under a locale collation, which ignores
+    # punctuation when comparing, it can match or miss the wrong rows
+    if not prefix:
+        return db.true()
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return db.and_(column >= prefix, column < upper)
@@ -0,0 +1,200 @@
+from app import db
+from app.models import TupleOutbox
+from app.fga_resilience import CircuitOpenError
+from app.queries import chunked
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from openfga_sdk.exceptions import FgaValidationException, NotFoundException, ValidationException
+import datetime
+import logging
+import random
+import threading
+
+# Tuple writes are recorded in the tuple_outbox table in the same database transaction as the rows they belong
+# to, instead of being written to OpenFGA from the request thread.  A background worker drains the outbox in
+# coalesced multi-tuple writes and retries failed writes with exponential backoff, so FGA write latency is kept
+# off the request path and a failed write is retried rather than lost.
+
+logger = logging.getLogger(__name__)
+
+# OpenFGA rejects write requests with more than 100 tuples
+MAX_TUPLES_PER_WRITE = 100
+
+# Errors that will fail the same way no matter how many times they are retried
+PERMANENT_ERRORS = (FgaValidationException, ValidationException, NotFoundException)
+
+_wake = threading.Event()
+_worker = None
+
+
+def enqueue_tuple(user, relation, object, operation="write"):
+    # Add a tuple write or delete to the current database session.  It is sent to OpenFGA after the session commits
+    entry = TupleOutbox(operation=operation, user=user, relation=relation, object=object)
+    db.session.add(entry)
+    db.session.info["outbox_pending"] = True
+    return entry
+
+
+def enqueue_tuples(tuples, operation="write"):
+    # Add many (user, relation, object) tuple writes or deletes to the current session with one bulk insert
+    rows = [{"operation": operation, "user": user, "relation": relation, "object": object} for user, relation, object in tuples]
+    if rows:
+        db.session.execute(db.insert(TupleOutbox), rows)
+        db.session.info["outbox_pending"] = True
+    return len(rows)
+
+
+def discard_pending(objects):
+    # Remove queued writes and deletes of tuples that have any of objects as their user or object from the current
+    # session, for objects that are being deleted.  Returns the (user, relation, object) tuples of the writes
+    # removed, since the worker may already be sending them and they then need deleting from OpenFGA as well
+    objects = list(objects)
+    writes = []
+    for chunk in chunked(objects):
+        about = db.or_(TupleOutbox.object.in_(chunk), TupleOutbox.user.in_(chunk))
+        writes.extend(tuple(row) for row in db.session.execute(
+            db.select(TupleOutbox.user, TupleOutbox.relation, TupleOutbox.object)
+            .where(about, TupleOutbox.operation == "write")
+        ))
+        db.session.execute(db.delete(TupleOutbox).where(about))
+    return writes
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_after_commit(session):
+    # Wake the worker as soon as outbox rows are committed rather than waiting for its next poll
+    if session.info.pop("outbox_pending", False):
+        _wake.set()
+
+
+def _coalesce(entries, batch_size):
+    # Take entries in order until the batch is full or a tuple repeats with a different operation, since a write
+    # and a delete of the same tuple can't be sent in one request.  Repeats of the same operation are merged.
+    batch = []
+    operations = {}
+    for entry in entries:
+        key = (entry.user, entry.relation, entry.object)
+        if key in operations:
+            if operations[key] != entry.operation:
+                break
+            batch.append(entry)
+            continue
+        if len(operations) >= batch_size:
+            break
+        operations[key] = entry.operation
+        batch.append(entry)
+    return batch
+
+
+def _send(entries, write_tuples):
+    writes = list(dict.fromkeys((e.user, e.relation, e.object) for e in entries if e.operation == "write"))
+    deletes = list(dict.fromkeys((e.user, e.relation, e.object) for e in entries if e.operation == "delete"))
+    write_tuples(writes, deletes)
+
+
+def _record_failure(entries, error, max_attempts, base_backoff, max_backoff):
+    now = datetime.datetime.utcnow()
+    for entry in entries:
+        entry.attempts += 1
+        entry.last_error = str(error)[:2000]
+        if isinstance(error, PERMANENT_ERRORS) or entry.attempts >= max_attempts:
+            entry.failed = True
+            logger.error("Outbox entry %s (%s %s %s %s) failed permanently: %s", entry.id, entry.operation, entry.user, entry.relation, entry.object, error)
+        else:
+            delay = min(base_backoff * 2 ** (entry.attempts - 1), max_backoff)
+            entry.next_attempt = now + datetime.timedelta(seconds=delay + random.uniform(0, base_backoff))
+
+
+def flush_outbox(write_tuples, batch_size=MAX_TUPLES_PER_WRITE, max_attempts=10, base_backoff=1.0, max_backoff=300.0):
+    # Send one coalesced batch of due outbox entries to OpenFGA.  Must be called inside an app context.
+    # Returns the number of entries written.
+    batch_size = min(batch_size, MAX_TUPLES_PER_WRITE)
+    now = datetime.datetime.utcnow()
+    entries = (
+        TupleOutbox.query
+        .filter(TupleOutbox.failed == False, TupleOutbox.next_attempt <= now)
+        .order_by(TupleOutbox.id)
+        .limit(batch_size * 2)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    batch = _coalesce(entries, batch_size)
+    if not batch:
+        db.session.rollback()
+        return 0
+
+    written = []
+    try:
+        _send(batch, write_tuples)
+        written = batch
+    except CircuitOpenError:
+        # OpenFGA is known to be down, so leave the batch for when the breaker closes without using up an attempt
+        db.session.rollback()
+        return 0
+    except PERMANENT_ERRORS as e:
+        # One bad tuple rejects the whole request, so send each tuple on its own to isolate it
+        if len(batch) == 1:
+            _record_failure(batch, e, max_attempts, base_backoff, max_backoff)
+        else:
+            for entry in batch:
+                try:
+                    _send([entry], write_tuples)
+                    written.append(entry)
+                except Exception as single_error:
+                    _record_failure([entry], single_error, max_attempts, base_backoff, max_backoff)
+    except Exception as e:
+        # Transient errors (timeouts, 5xx, rate limits) back off the whole batch
+        logger.warning("Outbox write of %s tuples failed, will retry: %s", len(batch), e)
+        _record_failure(batch, e, max_attempts, base_backoff, max_backoff)
+
+    for entry in written:
+        db.session.delete(entry)
+    db.session.commit()
+    return len(written)
+
+
+def pending_count():
+    return TupleOutbox.query.filter_by(failed=False).count()
+
+
+class OutboxWorker(threading.Thread):
+    # Drains the outbox from a daemon thread.  It wakes when outbox rows are committed in this process and also
+    # polls so rows committed by other processes and scheduled retries are picked up.
+
+    def __init__(self, app, write_tuples):
+        super().__init__(name="fga-outbox", daemon=True)
+        self.app = app
+        self.write_tuples = write_tuples
+        self.poll_interval = app.config["FGA_OUTBOX_POLL_INTERVAL"]
+        self.options = {
+            "batch_size": app.config["FGA_OUTBOX_BATCH_SIZE"],
+            "max_attempts": app.config["FGA_OUTBOX_MAX_ATTEMPTS"],
+            "base_backoff": app.config["FGA_OUTBOX_BASE_BACKOFF"],
+            "max_backoff": app.config["FGA_OUTBOX_MAX_BACKOFF"],
+        }
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            _wake.wait(self.poll_interval)
+            _wake.clear()
+            try:
+                with self.app.app_context():
+                    # Keep draining while there is a full backlog
+                    while not self._stopped.is_set() and flush_outbox(self.write_tuples, **self.options):
+                        pass
+            except Exception:
+                logger.exception("Outbox worker error")
+
+    def stop(self):
+        self._stopped.set()
+        _wake.set()
+
+
+def start_outbox_worker(app, write_tuples):
+    # Start the outbox worker for this process if it isn't already running
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _worker = OutboxWorker(app, write_tuples)
+        _worker.start()
+    return _worker
@@ -0,0 +1,214 @@
+from app import db
+from app.models import User, Group, File, Folder, UserGroup
+from sqlalchemy import and_, func, or_, select
+import base64
+import datetime
+import json
+
+# Set-based data access used by the route handlers.  Each function fetches everything it needs with a fixed
+# number of queries, using IN (...) lookups and joins instead of one query per item, so the number of SQL
+# statements per request stays constant as users join more groups and receive more shares.
+
+# Keep IN lists well under the bound parameter limits of SQLite and other databases
+IN_CHUNK_SIZE = 500
+
+
+def chunked(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def folders_by_uuid(folder_uuids):
+    # Returns a dict of folder uuid to Folder for the uuids given.  Missing folders are left out
+    folders = {}
+    for chunk in chunked(set(folder_uuids)):
+        for folder in Folder.query.filter(Folder.uuid.in_(chunk)):
+            folders[folder.uuid] = folder
+    return folders
+
+
+def users_by_uuid(user_uuids):
+    # Returns a dict of user uuid to User for the uuids given
+    users = {}
+    for chunk in chunked(set(user_uuids)):
+        for user in User.query.filter(User.uuid.in_(chunk)):
+            users[user.uuid] = user
+    return users
+
+
+def groups_by_uuid(group_uuids):
+    # Returns a dict of group uuid to Group for the uuids given
+    groups = {}
+    for chunk in chunked(set(group_uuids)):
+        for group in Group.query.filter(Group.uuid.in_(chunk)):
+            groups[group.uuid] = group
+    return groups
+
+
+def group_members(group_id):
+    # Returns the User rows of every member of a group in one join
+    return (
+        User.query
+        .join(UserGroup, UserGroup.user_id == User.id)
+        .filter(UserGroup.group_id == group_id)
+        .order_by(User.name)
+        .all()
+    )
+
+
+def user_groups_with_member_counts(user_id):
+    # Returns (Group, member_count) pairs for every group the user belongs to, with the member counts
+    # computed by a single grouped subquery limited to those groups
+    memberships = db.session.query(UserGroup.group_id).filter(UserGroup.user_id == user_id)
+    counts = (
+        db.session.query(UserGroup.group_id, func.count(UserGroup.id).label("member_count"))
+        .filter(UserGroup.group_id.in_(memberships.scalar_subquery()))
+        .group_by(UserGroup.group_id)
+        .subquery()
+    )
+    return (
+        db.session.query(Group, func.coalesce(counts.c.member_count, 0))
+        .join(UserGroup, UserGroup.group_id == Group.id)
+        .outerjoin(counts, counts.c.group_id == Group.id)
+        .filter(UserGroup.user_id == user_id)
+        .order_by(Group.name)
+        .all()
+    )
+
+
+def folder_subtree(folder_id, max_depth=None):
+    # Returns a recursive CTE of (id, uuid, parent, depth) for a folder and every folder beneath it, so a whole
+    # tree can be fetched with one query instead of one query per level.  With max_depth, folders more than
+    # max_depth levels below the folder are left out
+    tree = (
+        select(Folder.id, Folder.uuid, Folder.parent, db.literal(0).label("depth"))
+        .where(Folder.id == folder_id)
+        .cte("folder_tree", recursive=True)
+    )
+    children = select(Folder.id, Folder.uuid, Folder.parent, (tree.c.depth + 1).label("depth")).join(tree, Folder.parent == tree.c.uuid)
+    if max_depth is not None:
+        children = children.where(tree.c.depth < max_depth)
+    return tree.union_all(children)
+
+
+def subtree_size(folder_id, limit):
+    # Returns the number of folders and files in a folder and everything beneath it, counting no further than
+    # limit so a large tree isn't read just to learn that it is large
+    tree = folder_subtree(folder_id)
+    folder_uuids = db.session.scalars(select(tree.c.uuid).limit(limit)).all()
+    if len(folder_uuids) >= limit:
+        return limit
+    files = select(File.id).where(File.folder.in_(folder_uuids)).limit(limit - len(folder_uuids)).subquery()
+    return len(folder_uuids) + db.session.scalar(select(func.count()).select_from(files))
+
+
+def folder_tree(folder_id, max_depth=None, limit=None):
+    # Returns (uuid, parent, name, depth) rows for a folder and the folders beneath it, level by level and by name
+    # within a level, so parents come before their children and a limit drops the deepest folders first
+    tree = folder_subtree(folder_id, max_depth)
+    query = (
+        select(Folder.uuid, Folder.parent, Folder.name, tree.c.depth)
+        .join(tree, Folder.id == tree.c.id)
+        .order_by(tree.c.depth, Folder.name, Folder.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return db.session.execute(query).all()
+
+
+def subtree_contents(folder_id):
+    # Returns (folders, files) for a folder and everything beneath it as lists of (id, uuid) rows
+    tree = folder_subtree(folder_id)
+    folders = db.session.execute(select(tree.c.id, tree.c.uuid)).all()
+    files = db.session.execute(select(File.id, File.uuid).where(File.folder.in_(select(tree.c.uuid)))).all()
+    return folders, files
+
+
+# Directory listings are paged by name or by creation time.  Subfolders come before files, and a cursor records
+# the kind, sort key and id of the last child returned so the next page continues from there with an index range
+# scan rather than an offset.
+LISTING_ORDERS = ("name", "created")
+
+
+def encode_cursor(kind, order, key, id):
+    if isinstance(key, datetime.datetime):
+        key = key.isoformat()
+    data = json.dumps([kind, order, key, id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # Returns (kind, order, key, id).  Raises ValueError for a cursor that wasn't made by encode_cursor
+    try:
+        kind, order, key, id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if kind not in ("folder", "file") or order not in LISTING_ORDERS or not isinstance(id, int):
+        raise ValueError("invalid cursor")
+    if order == "created" and key is not None:
+        key = datetime.datetime.fromisoformat(key)
+    return kind, order, key, id
+
+
+def listing_sort_column(model, order):
+    return model.name if order == "name" else model.created
+
+
+def _children_after(model, parent_column, folder_uuid, order, after, limit):
+    # Children whose sort key is NULL, e.g. rows created before the column was set, come first in id order.  NULL
+    # compares as neither greater than nor equal to a cursor's key, so they are paged as their own IS NULL range
+    # and a cursor with a None key is within that range.  Both ranges are walked in index order, the sort column
+    # isn't wrapped in an expression so the (parent, name/created) indexes can order the rows
+    sort_column = listing_sort_column(model, order)
+    query = model.query.filter(parent_column == folder_uuid)
+    children = []
+    if after is None or after[0] is None:
+        nulls = query.filter(sort_column.is_(None))
+        if after is not None:
+            nulls = nulls.filter(model.id > after[1])
+        children = nulls.order_by(model.id).limit(limit).all()
+        if len(children) >= limit:
+            return children
+        query = query.filter(sort_column.is_not(None))
+    else:
+        key, id = after
+        query = query.filter(or_(sort_column > key, and_(sort_column == key, model.id > id)))
+    return children + query.order_by(sort_column, model.id).limit(limit - len(children)).all()
+
+
+def directory_page(folder_uuid, order="name", cursor=None, limit=200):
+    # Returns (folders, files, next_cursor) for one page of a folder's children.  At most limit children are
+    # returned using at most two queries, or four while the page still covers children with no sort key.
+    # next_cursor is None on the last page
+    kind, after = "folder", None
+    if cursor is not None:
+        kind, order, key, id = decode_cursor(cursor)
+        after = (key, id)
+
+    folders = []
+    if kind == "folder":
+        folders = _children_after(Folder, Folder.parent, folder_uuid, order, after, limit + 1)
+        if len(folders) > limit:
+            folders = folders[:limit]
+            last = folders[-1]
+            return folders, [], encode_cursor("folder", order, getattr(last, order), last.id)
+        after = None
+
+    files = _children_after(File, File.folder, folder_uuid, order, after, limit - len(folders) + 1)
+    if len(files) > limit - len(folders):
+        files = files[:limit - len(folders)]
+        last = files[-1] if files else None
+        if last is None:
+            # The page was filled by folders and files start on the next page
+            last_folder = folders[-1]
+            return folders, files, encode_cursor("folder", order, getattr(last_folder, order), last_folder.id)
+        return folders, files, encode_cursor("file", order, getattr(last, order), last.id)
+    return folders, files, None
+
+
+def directory_counts(folder_uuid):
+    # Returns (folder count, file count) for a folder's children, regardless of permissions
+    folder_count = db.session.scalar(select(func.count(Folder.id)).where(Folder.parent == folder_uuid))
+    file_count = db.session.scalar(select(func.count(File.id)).where(File.folder == folder_uuid))
+    return folder_count, file_count
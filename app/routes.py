@@ -1,37 +1,245 @@
-from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify
+from flask import Blueprint, current_app, g, has_request_context, render_template, stream_template, stream_with_context, Response, make_response, session, redirect, url_for, request, jsonify
 from urllib.parse import quote_plus, urlencode
 from os import environ as env
 import json
 from app import oauth, db
-from app.models import User, Group, File, Folder, UserGroup
+from app.models import User, Group, File, Folder, UserGroup, FolderShare, SharedFolder, Job
+from app.cache import DecisionCache
+from app.queries import users_by_uuid, groups_by_uuid, group_members, user_groups_with_member_counts, subtree_contents, subtree_size, folder_tree, chunked, directory_page, directory_counts, LISTING_ORDERS
+from app.jobs import start_job, job_status, fail_if_interrupted
+from app.outbox import enqueue_tuple, enqueue_tuples, discard_pending, MAX_TUPLES_PER_WRITE
+from app.sharing import record_folder_share, record_folder_shares, add_group_member_shares, shared_folders
+from app.autocomplete import index_user, index_group, search_users, search_groups
+from app.content import blob_digest, file_content, set_file_content, remove_file_content, stream_json
+from app.etags import digest, make_etag, file_version, not_modified, precondition_failed
+from app.sessions import regenerate_session
+from app.importer import ArchiveImport, ArchiveError, archive_members
+from app.export import export_zip, acquire_export_slot, release_export_slot
+from app.search import index_file, remove_files, search_files
+from app import fga_async, fga_resilience, metrics
+from app.fga_resilience import FgaUnavailable
 import uuid
 import os
 from openfga_sdk.client import ClientConfiguration
+from openfga_sdk.configuration import RetryParams
 from openfga_sdk.sync import OpenFgaClient
-from openfga_sdk.client.models import ClientTuple, ClientWriteRequest, ClientCheckRequest, ClientListObjectsRequest
+from openfga_sdk.client.models import ClientTuple, ClientWriteRequest, ClientCheckRequest, ClientListObjectsRequest, ClientBatchCheckItem, ClientBatchCheckRequest
+from openfga_sdk.client.models.list_users_request import ClientListUsersRequest
+from openfga_sdk.models import ReadRequestTupleKey, FgaObject, UserTypeFilter, ConsistencyPreference
+from openfga_sdk.client.models.write_conflict_opts import ConflictOptions, ClientWriteRequestOnDuplicateWrites, ClientWriteRequestOnMissingDeletes
 from functools import wraps
+from urllib3.connection import HTTPConnection
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
+import asyncio
 import datetime
+import hmac
+import inspect
+import logging
+import socket
+import time
 
 
 # This app uses a single Blueprint called "main"
 main = Blueprint('main', __name__)
 
+logger = logging.getLogger(__name__)
+
 # We default fga_client to None until it is initialized
 fga_client = None
 
-def initialize_fga_client():
-    # This function is called to initialize our FGA Client instance if it is not already available
-    print("Initializing OpenFGA Client SDK")
+# Maximum number of checks sent in a single BatchCheck request.  OpenFGA rejects batches larger than its
+# configured limit, which defaults to 50
+FGA_BATCH_CHECK_SIZE = 50
+
+# Maximum number of concurrent requests made to OpenFGA when a helper fans out many independent calls
+FGA_MAX_PARALLEL_REQUESTS = 10
+
+# Group roles from lowest to highest.  A user's role in a group is the highest of these relations they have
+GROUP_ROLES = ("member", "admin", "owner")
+
+# OpenFGA stops ListObjects and ListUsers after this many results by default, so a result this long may be
+# incomplete
+FGA_LIST_MAX_RESULTS = int(os.getenv('FGA_LIST_MAX_RESULTS', 1000))
+
+# Directory listings return at most this many children per page by default, and never more than the maximum
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 200))
+LIST_MAX_PAGE_SIZE = int(os.getenv('LIST_MAX_PAGE_SIZE', 1000))
+
+# Checks and list calls made within this many seconds of the current user's last tuple write ask OpenFGA for
+# HIGHER_CONSISTENCY so the user sees their own writes even when OpenFGA caches decisions.  All other reads ask for
+# MINIMIZE_LATENCY.  The window also covers the time queued writes wait in the outbox.  0 turns this off
+FGA_READ_YOUR_WRITES_WINDOW = float(os.getenv('FGA_READ_YOUR_WRITES_WINDOW', 10))
+
+# Folders containing more than this many folders and files are deleted by a background job
+FOLDER_DELETE_INLINE_LIMIT = int(os.getenv('FOLDER_DELETE_INLINE_LIMIT', 100))
+
+# Relations granted by sharing a folder or file, as (read only, read and write)
+SHARE_RELATIONS = {
+    "folder": ("viewer", "can_create_file"),
+    "file": ("can_read", "can_write"),
+}
+
+# A folder tree holds at most this many folders, and ?depth= is at most TREE_MAX_DEPTH
+TREE_MAX_FOLDERS = int(os.getenv('TREE_MAX_FOLDERS', 5000))
+TREE_MAX_DEPTH = 100
+
+# Searches return this many files by default, and never more than the maximum
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_PAGE_SIZE = 100
+
+# A bulk share request may name at most this many users and groups
+BULK_SHARE_MAX_SUBJECTS = int(os.getenv('BULK_SHARE_MAX_SUBJECTS', 500))
+
+# Recent check and list objects results are cached in process so repeated checks of the same folder or file
+# during a page load don't each require a round trip to OpenFGA.  Writes made through the fga_* helpers
+# below invalidate the cached decisions they affect.
+decision_cache = DecisionCache(
+    max_entries=int(os.getenv('FGA_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('FGA_CACHE_TTL', 30)),
+)
+
+# The last decision seen for each check and list call is kept separately from the cache, and is used when OpenFGA
+# can't be reached because its circuit breaker is open or a call missed its deadline.  Such responses are marked
+# stale.  Writes invalidate these decisions like they do the cached ones, but only in the process that made the
+# write, so another gunicorn worker can serve a permission revoked elsewhere until its entry expires.  Entries
+# therefore expire after FGA_CACHE_TTL by default, the same window the decision cache already has.
+last_known_decisions = DecisionCache(
+    max_entries=int(os.getenv('FGA_STALE_CACHE_SIZE', 50000)),
+    ttl=float(os.getenv('FGA_STALE_MAX_AGE', os.getenv('FGA_CACHE_TTL', 30))),
+)
+
+def fga_configuration():
+    # Client configuration shared by the synchronous and asynchronous FGA clients.  Each client keeps a pool of
+    # up to FGA_POOL_SIZE keep-alive connections, every call times out after FGA_TIMEOUT_MS and rate limited or
+    # failed calls are retried up to FGA_MAX_RETRY times
     configuration = ClientConfiguration(
         api_url = os.getenv('FGA_API_URL'), 
         store_id = os.getenv('FGA_STORE_ID'), 
         authorization_model_id = os.getenv('FGA_MODEL_ID'), 
+        timeout_millisec = int(os.getenv('FGA_TIMEOUT_MS', 10000)),
+        retry_params = RetryParams(
+            max_retry = int(os.getenv('FGA_MAX_RETRY', 3)),
+            min_wait_in_ms = int(os.getenv('FGA_MIN_RETRY_WAIT_MS', 100)),
+        ),
     )
+    configuration.connection_pool_maxsize = int(os.getenv('FGA_POOL_SIZE', 20))
+    if os.getenv('FGA_TCP_KEEPALIVE', 'true').lower() == 'true':
+        # Detect connections dropped by a load balancer or NAT while idle in the pool
+        configuration.socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    return configuration
+
+def initialize_fga_client():
+    # This function is called to initialize our FGA Client instance if it is not already available
+    logger.info("Initializing OpenFGA Client SDK")
+    configuration = fga_configuration()
+
+    global fga_client
+    client = OpenFgaClient(configuration)
+    client.read_authorization_models()
+    fga_client = client
+    logger.info("FGA Client initialized.")
+
+def initialize_fga_clients():
+    # This function builds the synchronous and async FGA clients for this process if they don't exist yet.  It is
+    # called by create_app so the first request doesn't pay for connecting to OpenFGA
+    if fga_client is None:
+        initialize_fga_client()
+    if not fga_async.is_started():
+        initialize_async_fga_client()
 
+def _reset_fga_clients_after_fork():
+    # A forked worker must not share the parent's pooled connections, and the async client's event loop thread
+    # doesn't survive the fork, so the child builds its own clients
     global fga_client
-    fga_client = OpenFgaClient(configuration)
-    fga_client.read_authorization_models()
-    print("FGA Client initialized.")
+    fga_client = None
+    fga_async.reset_after_fork()
+
+os.register_at_fork(after_in_child=_reset_fga_clients_after_fork)
+
+def fga_note_write():
+    # This function records that the current user wrote or queued a tuple, so their reads use higher consistency
+    # for the next FGA_READ_YOUR_WRITES_WINDOW seconds.  Writes made outside a request, e.g. by the outbox worker,
+    # are not recorded
+    if has_request_context() and 'user_id' in session:
+        session["fga_written_at"] = time.time()
+
+def fga_consistency():
+    # This function returns the consistency preference for reads made by the current request
+    if FGA_READ_YOUR_WRITES_WINDOW > 0 and has_request_context():
+        written_at = session.get("fga_written_at")
+        if written_at is not None and time.time() - written_at < FGA_READ_YOUR_WRITES_WINDOW:
+            return ConsistencyPreference.HIGHER_CONSISTENCY
+    return ConsistencyPreference.MINIMIZE_LATENCY
+
+def fga_cache_get(key, consistency):
+    # This function looks up a cached decision.  Reads that must see the user's recent writes skip the cache, since
+    # other processes' caches aren't invalidated by this process's writes
+    if consistency == ConsistencyPreference.HIGHER_CONSISTENCY:
+        return False, None
+    return decision_cache.get(key)
+
+def fga_cache_generation():
+    # This function returns the generations of the decision caches.  Read it before asking OpenFGA and pass it to
+    # fga_remember, so a decision that raced with a write's invalidation isn't cached
+    return decision_cache.generation, last_known_decisions.generation
+
+def fga_remember(key, value, user, object_type, object=None, generation=(None, None)):
+    # This function caches a decision returned by OpenFGA and keeps it as the last known decision for key
+    decision_cache.set(key, value, user, object_type, object, generation=generation[0])
+    last_known_decisions.set(key, value, user, object_type, object, generation=generation[1])
+
+def fga_mark_stale(operation):
+    # This function records that the current response used a last known decision instead of asking OpenFGA
+    fga_resilience.stale_decisions.inc(operation)
+    if has_request_context():
+        g.fga_stale = True
+
+def fga_last_known(operation, key, error):
+    # This function returns the last known decision for key when OpenFGA couldn't answer, or raises error if
+    # there is none
+    hit, value = last_known_decisions.get(key)
+    if not hit:
+        raise error
+    logger.warning("Serving last known %s decision, OpenFGA unavailable: %s", operation, error)
+    fga_mark_stale(operation)
+    return value
+
+def fga_invalidate_tuple(user,object):
+    # This function drops cached decisions that writing or deleting a tuple between user and object could change
+    for cache in (decision_cache, last_known_decisions):
+        if user == "user:*":
+            # Public access changes decisions for every user
+            cache.clear()
+        elif user.startswith("user:"):
+            # A direct grant only changes what this user can do, on the object and on anything inherited from it,
+            # and which users have a relation on the object
+            cache.invalidate_user(user)
+            cache.invalidate_object(object, kind="users")
+        elif user.startswith("folder:") and "#" not in user:
+            # Parent tuples are only written for new folders and files and deleted along with them, so they only
+            # change decisions about that object and which objects of its type a user can list
+            object_type = object.split(":")[0]
+            cache.invalidate_object(object)
+            cache.invalidate_type(object_type, kind="list")
+        elif object.startswith("folder:"):
+            # Group share tuples on a folder change decisions for every user on the folder and all of the folders
+            # and files beneath it
+            cache.invalidate_type("folder")
+            cache.invalidate_type("file")
+        else:
+            object_type = object.split(":")[0]
+            cache.invalidate_object(object)
+            cache.invalidate_type(object_type, kind="list")
+
+def fga_enqueue_unavailable(operation, user, relation, object, error):
+    # This function queues a tuple write or delete in the outbox when OpenFGA can't be reached, so it is sent by the
+    # outbox worker once OpenFGA recovers instead of failing the request.  The tuple is committed right away
+    logger.warning("OpenFGA unavailable, queueing %s of %s %s %s: %s", operation, user, relation, object, error)
+    enqueue_tuple(user, relation, object, operation=operation)
+    db.session.commit()
+    fga_note_write()
+    return None
 
 def fga_relate_user_object(user_uuid,object_uuid,object_type,relation):
     # This function creates a tuple in our OpenFGA store which relates a "user" with an "object" using the provided relation
@@ -48,8 +256,13 @@ def fga_relate_user_object(user_uuid,object_uuid,object_type,relation):
                     ),
             ],
     )
-    response = fga_client.write(body)
-    print(f"Write Success: {response.writes[0].success}")
+    try:
+        response = fga_resilience.call("write", fga_client.write, body, read=False)
+    except FgaUnavailable as e:
+        return fga_enqueue_unavailable("write", f"user:{user_uuid}", relation, f"{object_type}:{object_uuid}", e)
+    fga_invalidate_tuple(f"user:{user_uuid}", f"{object_type}:{object_uuid}")
+    fga_note_write()
+    logger.debug("Write Success: %s", response.writes[0].success)
     return response
 
 def fga_delete_user_tuple(user_uuid,object_uuid,object_type,relation):
@@ -67,7 +280,12 @@ def fga_delete_user_tuple(user_uuid,object_uuid,object_type,relation):
                     ),
             ],
     )
-    response = fga_client.write(body)
+    try:
+        response = fga_resilience.call("write", fga_client.write, body, read=False)
+    except FgaUnavailable as e:
+        return fga_enqueue_unavailable("delete", f"user:{user_uuid}", relation, f"{object_type}:{object_uuid}", e)
+    fga_invalidate_tuple(f"user:{user_uuid}", f"{object_type}:{object_uuid}")
+    fga_note_write()
     return response
 
 def fga_relate_objects(object1_type,object1_uuid,object2_type,object2_uuid,relation):
@@ -85,7 +303,12 @@ def fga_relate_objects(object1_type,object1_uuid,object2_type,object2_uuid,relat
                     ),
             ],
     )
-    response = fga_client.write(body)
+    try:
+        response = fga_resilience.call("write", fga_client.write, body, read=False)
+    except FgaUnavailable as e:
+        return fga_enqueue_unavailable("write", f"{object1_type}:{object1_uuid}", relation, f"{object2_type}:{object2_uuid}", e)
+    fga_invalidate_tuple(f"{object1_type}:{object1_uuid}", f"{object2_type}:{object2_uuid}")
+    fga_note_write()
     return response
 
 def fga_delete_object_tuple(object1_type,object1_uuid,object2_type,object2_uuid,relation):
@@ -103,43 +326,357 @@ def fga_delete_object_tuple(object1_type,object1_uuid,object2_type,object2_uuid,
                     ),
             ],
     )
-    response = fga_client.write(body)
+    try:
+        response = fga_resilience.call("write", fga_client.write, body, read=False)
+    except FgaUnavailable as e:
+        return fga_enqueue_unavailable("delete", f"{object1_type}:{object1_uuid}", relation, f"{object2_type}:{object2_uuid}", e)
+    fga_invalidate_tuple(f"{object1_type}:{object1_uuid}", f"{object2_type}:{object2_uuid}")
+    fga_note_write()
     return response
 
+def fga_write_tuples(writes,deletes):
+    # This function writes and deletes many tuples in a single request.  writes and deletes are lists of
+    # (user, relation, object) tuples using full OpenFGA identifiers, e.g. ("user:<uuid>", "owner", "file:<uuid>").
+    # Duplicate writes and missing deletes are ignored so that retrying a request is always safe.
+    if fga_client is None:
+        initialize_fga_client()
+
+    body = ClientWriteRequest(
+            writes=[ClientTuple(user=user, relation=relation, object=object) for user, relation, object in writes] or None,
+            deletes=[ClientTuple(user=user, relation=relation, object=object) for user, relation, object in deletes] or None,
+    )
+    options = {
+        "conflict": ConflictOptions(
+            on_duplicate_writes=ClientWriteRequestOnDuplicateWrites.IGNORE,
+            on_missing_deletes=ClientWriteRequestOnMissingDeletes.IGNORE,
+        ),
+    }
+    response = fga_resilience.call("write", fga_client.write, body, options, read=False)
+
+    for user, relation, object in list(writes) + list(deletes):
+        fga_invalidate_tuple(user, object)
+
+    logger.debug("Wrote %s and deleted %s tuples", len(writes), len(deletes))
+    return response
+
+def fga_enqueue_user_object(user_uuid,object_uuid,object_type,relation):
+    # This function records a user to object tuple in the outbox as part of the current database transaction.
+    # It is written to OpenFGA by the outbox worker once the transaction commits.
+    fga_note_write()
+    return enqueue_tuple(f"user:{user_uuid}", relation, f"{object_type}:{object_uuid}")
+
+def fga_enqueue_objects(object1_type,object1_uuid,object2_type,object2_uuid,relation):
+    # This function records an object to object tuple in the outbox as part of the current database transaction
+    fga_note_write()
+    return enqueue_tuple(f"{object1_type}:{object1_uuid}", relation, f"{object2_type}:{object2_uuid}")
+
+def fga_read_tuples(object=None, relation=None, user=None):
+    # This function yields every tuple stored in OpenFGA matching the filter as (user, relation, object) strings,
+    # following continuation tokens until all pages are read.  With no filter every tuple in the store is read.
+    if fga_client is None:
+        initialize_fga_client()
+
+    continuation_token = None
+    while True:
+        options = {"page_size": 100}
+        if continuation_token:
+            options["continuation_token"] = continuation_token
+        response = fga_resilience.call("read", fga_client.read, ReadRequestTupleKey(user=user, relation=relation, object=object), options)
+        for tuple in response.tuples:
+            yield tuple.key.user, tuple.key.relation, tuple.key.object
+        continuation_token = response.continuation_token
+        if not continuation_token:
+            break
+
 def fga_check_user_access(user_uuid,action,object_type,object_uuid):
     # This function will check whether a user is authorized to perform the specified action on an object
     # It will return a boolean value
     if fga_client is None:
         initialize_fga_client()
 
-    print(f"Checking user: {user_uuid} for {action} permission on the {object_type} {object_uuid}")
+    user = f"user:{user_uuid}"
+    object = f"{object_type}:{object_uuid}"
+    key = ("check", user, action, object)
+    consistency = fga_consistency()
+
+    hit, allowed = fga_cache_get(key, consistency)
+    if hit:
+        return allowed
+
+    logger.debug("Checking user: %s for %s permission on the %s %s", user_uuid, action, object_type, object_uuid)
 
     body = ClientCheckRequest(
-        user=f"user:{user_uuid}",
+        user=user,
         relation=action,
-        object=f"{object_type}:{object_uuid}",
+        object=object,
     )
 
-    response = fga_client.check(body)
+    generation = fga_cache_generation()
+    try:
+        response = fga_resilience.call("check", fga_client.check, body, {"consistency": consistency})
+    except FgaUnavailable as e:
+        return fga_last_known("check", key, e)
+    fga_remember(key, response.allowed, user, object_type, object, generation=generation)
     return response.allowed
 
+def fga_batch_check_user_access(checks):
+    # This function resolves many permission checks at once using the OpenFGA BatchCheck API instead of one
+    # check request per object.  checks is a list of (user_uuid, action, object_type, object_uuid) tuples and
+    # a list of boolean values is returned in the same order.  Checks that error are treated as denied.
+    if fga_client is None:
+        initialize_fga_client()
+
+    if not checks:
+        return []
+
+    # Normalize the checks so duplicates are only sent to OpenFGA once
+    keys = [(str(user_uuid), action, object_type, str(object_uuid)) for user_uuid, action, object_type, object_uuid in checks]
+
+    # Answer what we can from the decision cache and only send the rest
+    consistency = fga_consistency()
+    decisions = {}
+    unique_keys = []
+    for key in dict.fromkeys(keys):
+        user_uuid, action, object_type, object_uuid = key
+        hit, allowed = fga_cache_get(("check", f"user:{user_uuid}", action, f"{object_type}:{object_uuid}"), consistency)
+        if hit:
+            decisions[key] = allowed
+        else:
+            unique_keys.append(key)
+
+    if not unique_keys:
+        return [decisions[key] for key in keys]
+
+    logger.debug("Batch checking %s permissions in chunks of %s", len(unique_keys), FGA_BATCH_CHECK_SIZE)
+
+    body = ClientBatchCheckRequest(
+        checks=[
+            ClientBatchCheckItem(
+                user=f"user:{user_uuid}",
+                relation=action,
+                object=f"{object_type}:{object_uuid}",
+                correlation_id=str(index),
+            )
+            for index, (user_uuid, action, object_type, object_uuid) in enumerate(unique_keys)
+        ],
+    )
+
+    generation = fga_cache_generation()
+    try:
+        response = fga_resilience.call("batch_check", fga_client.batch_check, body, {"max_batch_size": FGA_BATCH_CHECK_SIZE, "consistency": consistency})
+    except FgaUnavailable as e:
+        # Use the last known decisions, denying checks that have none
+        logger.warning("Serving last known batch check decisions, OpenFGA unavailable: %s", e)
+        fga_mark_stale("batch_check")
+        for user_uuid, action, object_type, object_uuid in unique_keys:
+            hit, allowed = last_known_decisions.get(("check", f"user:{user_uuid}", action, f"{object_type}:{object_uuid}"))
+            decisions[(user_uuid, action, object_type, object_uuid)] = hit and allowed
+        return [decisions[key] for key in keys]
+
+    for result in response.result:
+        key = unique_keys[int(result.correlation_id)]
+        decisions[key] = bool(result.allowed) and result.error is None
+        if result.error is None:
+            user_uuid, action, object_type, object_uuid = key
+            object = f"{object_type}:{object_uuid}"
+            fga_remember(("check", f"user:{user_uuid}", action, object), decisions[key], f"user:{user_uuid}", object_type, object, generation=generation)
+
+    return [decisions.get(key, False) for key in keys]
+
 def fga_list_objects(user_uuid,action,object_type):
     # This function will return a list of objects for which the specified user can perform the specified action
     if fga_client is None:
         initialize_fga_client()
 
-    print(f"Getting objects of type {object_type} where user {user_uuid} has a {action} relationship.")
+    user = f"user:{user_uuid}"
+    key = ("list", user, action, object_type)
+    consistency = fga_consistency()
+
+    hit, objects = fga_cache_get(key, consistency)
+    if hit:
+        return list(objects)
+
+    logger.debug("Getting objects of type %s where user %s has a %s relationship.", object_type, user_uuid, action)
 
     body = ClientListObjectsRequest(
-        user=f"user:{user_uuid}",
+        user=user,
         relation=action,
         type=object_type,
     )
 
-    response = fga_client.list_objects(body)
+    generation = fga_cache_generation()
+    try:
+        response = fga_resilience.call("list_objects", fga_client.list_objects, body, {"consistency": consistency})
+    except FgaUnavailable as e:
+        return list(fga_last_known("list_objects", key, e))
+    fga_remember(key, tuple(response.objects), user, object_type, generation=generation)
 
     return response.objects
 
+def initialize_async_fga_client():
+    # This function starts the async FGA client used by async route handlers if it is not already running
+    logger.info("Initializing async OpenFGA Client SDK")
+    fga_async.start(fga_configuration(), FGA_MAX_PARALLEL_REQUESTS)
+    logger.info("Async FGA Client initialized.")
+
+async def fga_check_user_access_async(user_uuid,action,object_type,object_uuid):
+    # Async counterpart of fga_check_user_access for use in async route handlers.  Independent checks can be
+    # awaited together with asyncio.gather so they are sent to OpenFGA concurrently
+    if not fga_async.is_started():
+        initialize_async_fga_client()
+
+    user = f"user:{user_uuid}"
+    object = f"{object_type}:{object_uuid}"
+    key = ("check", user, action, object)
+    consistency = fga_consistency()
+
+    hit, allowed = fga_cache_get(key, consistency)
+    if hit:
+        return allowed
+
+    logger.debug("Checking user: %s for %s permission on the %s %s", user_uuid, action, object_type, object_uuid)
+
+    body = ClientCheckRequest(
+        user=user,
+        relation=action,
+        object=object,
+    )
+
+    generation = fga_cache_generation()
+    try:
+        response = await fga_async.call("check", body, {"consistency": consistency})
+    except FgaUnavailable as e:
+        return fga_last_known("check", key, e)
+    fga_remember(key, response.allowed, user, object_type, object, generation=generation)
+    return response.allowed
+
+async def fga_check_all_async(checks):
+    # This function runs many independent permission checks concurrently.  checks is a list of
+    # (user_uuid, action, object_type, object_uuid) tuples and a list of boolean values is returned in the same order
+    return await asyncio.gather(*(fga_check_user_access_async(*check) for check in checks))
+
+async def fga_list_objects_async(user_uuid,action,object_type):
+    # Async counterpart of fga_list_objects
+    if not fga_async.is_started():
+        initialize_async_fga_client()
+
+    user = f"user:{user_uuid}"
+    key = ("list", user, action, object_type)
+    consistency = fga_consistency()
+
+    hit, objects = fga_cache_get(key, consistency)
+    if hit:
+        return list(objects)
+
+    logger.debug("Getting objects of type %s where user %s has a %s relationship.", object_type, user_uuid, action)
+
+    body = ClientListObjectsRequest(
+        user=user,
+        relation=action,
+        type=object_type,
+    )
+
+    generation = fga_cache_generation()
+    try:
+        response = await fga_async.call("list_objects", body, {"consistency": consistency})
+    except FgaUnavailable as e:
+        return list(fga_last_known("list_objects", key, e))
+    fga_remember(key, tuple(response.objects), user, object_type, generation=generation)
+
+    return response.objects
+
+async def fga_list_users_async(object_type,object_uuid,relation):
+    # This function returns the uuids of the users that have the relation on an object, using one ListUsers call
+    if not fga_async.is_started():
+        initialize_async_fga_client()
+
+    object = f"{object_type}:{object_uuid}"
+    key = ("users", object, relation)
+    consistency = fga_consistency()
+
+    hit, users = fga_cache_get(key, consistency)
+    if hit:
+        return list(users)
+
+    logger.debug("Getting users with a %s relationship to the %s %s", relation, object_type, object_uuid)
+
+    body = ClientListUsersRequest(
+        object=FgaObject(type=object_type, id=str(object_uuid)),
+        relation=relation,
+        user_filters=[UserTypeFilter(type="user")],
+    )
+
+    generation = fga_cache_generation()
+    try:
+        response = await fga_async.call("list_users", body, {"consistency": consistency})
+    except FgaUnavailable as e:
+        return list(fga_last_known("list_users", key, e))
+    users = tuple(user.object.id for user in response.users if user.object is not None)
+    fga_remember(key, users, None, object_type, object, generation=generation)
+
+    return list(users)
+
+async def fga_group_roles_async(pairs):
+    # This function resolves the highest group role of many users at once.  pairs is a list of
+    # (user_uuid, group_uuid) tuples and a dict of (user_uuid, group_uuid) to "owner", "admin", "member" or None
+    # is returned, with uuids as strings.  Each role is listed once per distinct user or per distinct group,
+    # whichever there are fewer of, so a group page costs three FGA calls however many members or groups it shows.
+    pairs = list(dict.fromkeys((str(user_uuid), str(group_uuid)) for user_uuid, group_uuid in pairs))
+    if not pairs:
+        return {}
+
+    users = sorted({user_uuid for user_uuid, group_uuid in pairs})
+    groups = sorted({group_uuid for user_uuid, group_uuid in pairs})
+
+    # holders[role] is the set of (user_uuid, group_uuid) pairs that have the role
+    holders = {}
+    if len(groups) <= len(users):
+        lists = await asyncio.gather(*(fga_list_users_async("group", group_uuid, role) for role in GROUP_ROLES for group_uuid in groups))
+        results = iter(lists)
+        for role in GROUP_ROLES:
+            holders[role] = set()
+            for group_uuid in groups:
+                holders[role].update((user_uuid, group_uuid) for user_uuid in next(results))
+    else:
+        lists = await asyncio.gather(*(fga_list_objects_async(user_uuid, role, "group") for role in GROUP_ROLES for user_uuid in users))
+        results = iter(lists)
+        for role in GROUP_ROLES:
+            holders[role] = set()
+            for user_uuid in users:
+                holders[role].update((user_uuid, object.split(":", 1)[1]) for object in next(results))
+    truncated = any(len(result) >= FGA_LIST_MAX_RESULTS for result in lists)
+
+    roles = {}
+    for pair in pairs:
+        roles[pair] = None
+        for role in GROUP_ROLES:
+            if pair in holders[role]:
+                roles[pair] = role
+
+    if truncated:
+        # A list hit the server's result limit, so check the pairs it didn't report directly
+        unresolved = [pair for pair in pairs if roles[pair] != GROUP_ROLES[-1]]
+        checks = [(user_uuid, role, "group", group_uuid) for user_uuid, group_uuid in unresolved for role in GROUP_ROLES]
+        results = iter(await fga_check_all_async(checks))
+        for pair in unresolved:
+            for role in GROUP_ROLES:
+                if next(results):
+                    roles[pair] = role
+
+    return roles
+
+def fga_viewable_groups(user_uuid,group_uuids):
+    # This function returns the set of the given group uuids the user can view.  It uses one cached ListObjects
+    # call, unless that list may have been cut short by OpenFGA's result limit, in which case the groups are
+    # checked in a batch
+    objects = fga_list_objects(user_uuid, "can_view", "group")
+    if len(objects) < FGA_LIST_MAX_RESULTS:
+        objects = set(objects)
+        return {group_uuid for group_uuid in group_uuids if f"group:{group_uuid}" in objects}
+
+    results = fga_batch_check_user_access([(user_uuid, "can_view", "group", group_uuid) for group_uuid in group_uuids])
+    return {group_uuid for group_uuid, allowed in zip(group_uuids, results) if allowed}
+
 def relateUserObject(user_uuid,object_uuid,object_type,relation):
     #Wrapper function, can likely be removed
     
@@ -150,22 +687,39 @@ def relateUserObject(user_uuid,object_uuid,object_type,relation):
 
 
 def require_auth(f):
+    if inspect.iscoroutinefunction(f):
+        # Async route handlers need an async wrapper so Flask runs them in an event loop
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            if 'user_id' not in session:
+                return redirect(url_for('main.home'))
+            return await f(*args, **kwargs)
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # This decorated function can be applied to route handers and will ensure that a valid user session is active.
         # If the requestor is not logged in it will redirect their browser to the home page
-        if 'user' not in session:
+        if 'user_id' not in session:
             return redirect(url_for('main.home'))
         return f(*args, **kwargs)
     return decorated_function
 
 def api_require_auth(f):
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            if 'user_id' not in session:
+                return jsonify({"error": "Permission denied - no authenticated user"}), 403
+            return await f(*args, **kwargs)
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # This decorated function provides similar functionality to the one above but is used for API routes.  
         # Instead of redirecting the user it instead returns a 403 with a permission denied message in JSON to 
         # the client if there is not a valid session
-        if 'user' not in session:
+        if 'user_id' not in session:
             return jsonify({"error": "Permission denied - no authenticated user"}), 403
         return f(*args,**kwargs)
     return decorated_function
@@ -173,7 +727,7 @@ def api_require_auth(f):
 def loadSession(email):
     # This function is used after a user has authenticated to set the needed session variables so they can
     # be accessed by other route handlers in the application
-    print(f"Loading User Info from database for {email}")
+    logger.debug("Loading User Info from database for %s", email)
     user = User.query.filter_by(email=email).first()
 
     if user is None:
@@ -200,12 +754,14 @@ def registerUser(user_info):
     image = user_info['picture']
     
     new_uuid = uuid.uuid4()
-    print(f"Registering New User {new_uuid} in Database")
+    logger.info("Registering New User %s in Database", new_uuid)
 
     user = User(email=email, name=name, uuid=new_uuid, image=image)
     db.session.add(user)
+    db.session.flush()
+    index_user(user)
     db.session.commit()
-    print("User Registered in database")
+    logger.debug("User Registered in database")
 
     #Create Default Folder for new user
     folder_id = createDefaultFolder(user.id)
@@ -226,11 +782,9 @@ def createDefaultFolder(user_id):
     new_uuid = uuid.uuid4()
     folder = Folder(uuid=new_uuid, creator=user.id, name=folder_name, default_folder=True)
     db.session.add(folder)
+    fga_enqueue_user_object(user.uuid, new_uuid, "folder", "owner")
     db.session.commit()
 
-    fga_relate_user_object(user.uuid, new_uuid, "folder", "owner")
-    
-
     return folder.id
 
 def createDefaultFile(user_id, folder_id):
@@ -242,16 +796,18 @@ def createDefaultFile(user_id, folder_id):
         return False
     
     file_name = "Readme.txt"
-    file_content = "Welcome to your folder.  You can create and share text files here."
+    default_content = "Welcome to your folder.  You can create and share text files here."
     new_uuid = uuid.uuid4()
 
-    file = File(uuid=new_uuid, folder=folder.uuid, name=file_name, text_content=file_content, creator=user.id)
+    file = File(uuid=new_uuid, folder=folder.uuid, name=file_name, creator=user.id)
     db.session.add(file)
+    db.session.flush()
+    set_file_content(file, default_content)
+    index_file(file, default_content)
+    fga_enqueue_user_object(user.uuid, new_uuid, "file", "owner")
     db.session.commit()
 
-    print("Default file created, updating authorization tuple")
-
-    fga_relate_user_object(user.uuid, new_uuid, "file", "owner")
+    logger.debug("Default file created")
 
     return True
 
@@ -265,15 +821,13 @@ def createNewFolder(parent_uuid,name,user_id):
     new_uuid = uuid.uuid4()
     folder = Folder(uuid=new_uuid, parent=parent_uuid, default_folder=False, creator=user_id, name=name)
     db.session.add(folder)
-    db.session.commit()
-
-    print(f"New folder {name} created, creating new authorization tuples")
-
-    fga_relate_user_object(user.uuid, new_uuid, "folder", "owner")
 
-    print(f"Created ownership.  Now creating parent-child relationship between {parent_uuid} and {new_uuid}")
+    # The ownership and parent-child tuples are committed with the folder and written to OpenFGA by the outbox worker
+    fga_enqueue_user_object(user.uuid, new_uuid, "folder", "owner")
+    fga_enqueue_objects("folder", parent_uuid, "folder", new_uuid, "parent")
+    db.session.commit()
 
-    fga_relate_objects("folder", parent_uuid, "folder", new_uuid, "parent")
+    logger.debug("New folder %s created", name)
 
     return True
 
@@ -286,16 +840,20 @@ def createNewFile(parent_uuid, name, user_id, content):
     
     new_uuid = uuid.uuid4()
 
-    print(f"Creating a new file named {name} in directory {parent_uuid} for user_id {user_id}")
+    logger.debug("Creating a new file named %s in directory %s for user_id %s", name, parent_uuid, user_id)
 
-    file = File(uuid=new_uuid, folder=parent_uuid, creator=user_id, name=name, text_content=content)
+    file = File(uuid=new_uuid, folder=parent_uuid, creator=user_id, name=name)
     db.session.add(file)
-    db.session.commit()
+    db.session.flush()
+    set_file_content(file, content)
+    index_file(file, content)
 
-    print(f"New File {name} created, creating new authorization tuples")
+    # The ownership and parent tuples are committed with the file and written to OpenFGA by the outbox worker
+    fga_enqueue_user_object(user.uuid, new_uuid, "file", "owner")
+    fga_enqueue_objects("folder", parent_uuid, "file", new_uuid, "parent")
+    db.session.commit()
 
-    fga_relate_user_object(user.uuid, new_uuid, "file", "owner")
-    fga_relate_objects("folder", parent_uuid, "file", new_uuid, "parent")
+    logger.debug("New File %s created", name)
 
     return new_uuid
 
@@ -311,16 +869,17 @@ def createNewGroup(name, user_uuid):
     # Create Group db entry
     group = Group(uuid=new_uuid,creator=user.id, name=name)
     db.session.add(group)
-    db.session.commit()
+    db.session.flush()
+    index_group(group)
 
     # Make user creator of group
     assoc = UserGroup(user_id=user.id, group_id=group.id)
     db.session.add(assoc)
-    db.session.commit()
 
-    # Create FGA Tuple
-    fga_relate_user_object(user_uuid,new_uuid,"group","owner")
-    fga_relate_user_object(user_uuid,new_uuid,"group","member")
+    # Queue the FGA tuples in the same transaction as the group
+    fga_enqueue_user_object(user_uuid,new_uuid,"group","owner")
+    fga_enqueue_user_object(user_uuid,new_uuid,"group","member")
+    db.session.commit()
 
     return new_uuid
 
@@ -339,22 +898,23 @@ def callback():
     # The callback function that Auth0 will redirect users to after authentication
     try:
         token = oauth.auth0.authorize_access_token()
-        print(f"TOKEN: {token}\n\n\n")
-        session["user"] = token
-
         user_info = token['userinfo']
-        
+
+        # Only the fields the app reads are kept in the session, not the token, and the session gets a new id now
+        # that the user has authenticated
+        session.clear()
+        regenerate_session()
 
         user = User.query.filter_by(email=user_info['email']).first()
         if user is None:
             registerUser(user_info)
         else:
-            print("User is already registered.")
+            logger.debug("User is already registered.")
 
         loadSession(user_info['email'])
 
     except Exception as e:
-        print(f"Error: {e}\n\n")
+        logger.warning("Login callback failed: %s", e)
         return redirect(url_for("main.home"))
     return redirect(url_for("main.home"))
     
@@ -379,82 +939,80 @@ def logout():
 @api_require_auth
 def list_directory(folder_uuid):
     # This function will return JSON representing the contents of the specified folder and details about it if the requesting user is authorized
+    # Contents are returned a page at a time.  The optional query parameters are:
+    #   limit   number of children per page, up to LIST_MAX_PAGE_SIZE
+    #   order   "name" (the default) or "created"
+    #   cursor  the next_cursor value of the previous page
+    #   count   "true" to include total_hint, the number of children including ones the user can't see
     folder_uuid_u = uuid.UUID(folder_uuid)
-    print(f"Directory List Request uuid: {folder_uuid}")
+    logger.debug("Directory List Request uuid: %s", folder_uuid)
     user_uuid = session['uuid']
+
+    order = request.args.get("order", "name")
+    cursor = request.args.get("cursor") or None
+    try:
+        limit = min(max(int(request.args.get("limit", LIST_PAGE_SIZE)), 1), LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    if order not in LISTING_ORDERS:
+        return jsonify({"error": f"order must be one of {', '.join(LISTING_ORDERS)}"}), 400
+
     pwd = Folder.query.filter_by(uuid=folder_uuid_u).first()
-    print("Got Folder Info")
-    child_folders = Folder.query.filter_by(parent=pwd.uuid).all()
-    print("Got Child Folders")
-    child_files = File.query.filter_by(folder=pwd.uuid).all()
-    print("Got Child Files")
+    logger.debug("Got Folder Info")
+    try:
+        child_folders, child_files, next_cursor = directory_page(pwd.uuid, order, cursor, limit)
+    except ValueError:
+        return jsonify({"error": "invalid cursor"}), 400
+    logger.debug("Got Child Folders and Files")
     folder_objects = []
-    sidebar_objects = []
 
-    if fga_check_user_access(user_uuid,"can_create_file","folder",folder_uuid):
-        pwd_can_write = True
-    else:
-        pwd_can_write = False
+    # The parent folder link is only included on the first page
+    parent_dir = None
+    if pwd.parent is not None and cursor is None:
+        parent_dir = Folder.query.filter_by(uuid=pwd.parent).first()
 
-    if fga_check_user_access(user_uuid,"can_share", "folder", folder_uuid):
-        pwd_can_share = True
-    else:
-        pwd_can_share = False
+    # Resolve every permission needed for this listing in a single batch instead of one check per child
+    checks = [
+        (user_uuid, "can_create_file", "folder", folder_uuid),
+        (user_uuid, "can_share", "folder", folder_uuid),
+        (user_uuid, "owner", "folder", folder_uuid),
+    ]
+    if parent_dir is not None:
+        checks.append((user_uuid, "viewer", "folder", parent_dir.uuid))
+    checks.extend((user_uuid, "viewer", "folder", folder.uuid) for folder in child_folders)
+    checks.extend((user_uuid, "can_read", "file", file.uuid) for file in child_files)
 
-    if fga_check_user_access(user_uuid,"owner","folder",folder_uuid):
-        is_owner = True
-    else:
-        is_owner = False
+    logger.debug("Checking %s permissions for folder listing", len(checks))
+    results = iter(fga_batch_check_user_access(checks))
+
+    pwd_can_write = next(results)
+    pwd_can_share = next(results)
+    is_owner = next(results)
 
     session["pwd"] = folder_uuid_u
 
-    print("Checking for parent folder")
-    if pwd.parent is not None:
-        parent_dir = Folder.query.filter_by(uuid=pwd.parent).first()
-        if fga_check_user_access(user_uuid, "viewer", "folder", parent_dir.uuid):
-            folder_objects.append({
-                "uuid": parent_dir.uuid,
-                "name": "..",
-                "type": "folder"
-            })
-        
+    if parent_dir is not None and next(results):
+        folder_objects.append({
+            "uuid": parent_dir.uuid,
+            "name": "..",
+            "type": "folder"
+        })
 
-    print("Checking child folder permissions")
     for folder in child_folders:
-        if fga_check_user_access(user_uuid, "viewer", "folder", folder.uuid):
+        if next(results):
             folder_objects.append({
                 "uuid": folder.uuid,
                 "name": folder.name,
                 "type": "folder"
             })
-    
-    print("Checking child file permissions")
+
     for file in child_files:
-        print(f"Found File {file.name}")
-        if fga_check_user_access(user_uuid, "can_read", "file", file.uuid):
-            print(f"Access to file {file.name} granted")
+        if next(results):
             folder_objects.append({
                 "uuid": file.uuid,
                 "name": file.name,
                 "type": "file"
             })
-        else:
-            print(f"Access to file {file.name} denied")
-
-    print("Checking for folders shared with this user")
-
-    folders = fga_list_objects(user_uuid,"viewer","folder")
-    print(f"Shared Folders:\n{folders}\n---")
-    for shared_folder in folders:
-        folder_uuid = shared_folder.split("folder:")[1]
-        folder_uuid_u = uuid.UUID(folder_uuid)
-        folder = Folder.query.filter_by(uuid=folder_uuid_u).first()
-        if folder.creator is not session['user_id']:
-            sidebar_objects.append({
-                "uuid": folder_uuid,
-                "name": folder.name,
-                "type": "folder"
-            })
 
     client_response = {
         "folder_uuid": str(pwd.uuid),
@@ -464,30 +1022,167 @@ def list_directory(folder_uuid):
         "is_default": pwd.default_folder,
         "is_owner": is_owner,
         "contents": folder_objects,
-        "sidebar" : sidebar_objects
+        "next_cursor": next_cursor
+    }
+    if request.args.get("count") == "true":
+        folder_count, file_count = directory_counts(pwd.uuid)
+        client_response["total_hint"] = folder_count + file_count
+
+    # The listing only contains what the user is allowed to see, so its digest covers both the folder's contents
+    # and the user's permissions
+    etag = make_etag(digest(json.dumps(client_response, sort_keys=True, default=str)), user_uuid)
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+    response = jsonify(client_response)
+    response.set_etag(etag)
+    return response
+
+@main.route("/api/tree/<folder_uuid>")
+@api_require_auth
+def folder_tree_view(folder_uuid):
+    # This function returns a folder and the folders beneath it that the user can view as one nested structure,
+    # so a whole tree can be expanded with one request instead of one listing per folder.  The optional query
+    # parameter depth limits how many levels below the folder are included.  A folder whose children weren't
+    # included, because of the depth limit or because the tree is larger than TREE_MAX_FOLDERS, has children null
+    user_uuid = session['uuid']
+    try:
+        folder_uuid_u = uuid.UUID(folder_uuid)
+    except ValueError:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+    try:
+        depth = min(max(int(request.args.get("depth", TREE_MAX_DEPTH)), 0), TREE_MAX_DEPTH)
+    except ValueError:
+        return jsonify({"result": "error", "message": "depth must be a number"}), 400
+
+    pwd = Folder.query.filter_by(uuid=folder_uuid_u).first()
+    if pwd is None:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
+    # Check the requested folder before reading the tree, so a user who can't see it can't make the server walk it
+    if not fga_check_user_access(user_uuid, "viewer", "folder", folder_uuid):
+        return jsonify({"result": "error", "message": "Folder access not authorized"}), 403
+
+    # One recursive query for the whole tree, one more row than allowed to tell whether it was cut short
+    rows = folder_tree(pwd.id, depth, TREE_MAX_FOLDERS + 1)
+    truncated = len(rows) > TREE_MAX_FOLDERS
+    if truncated:
+        # The deepest level fetched may be incomplete, so it is left out and the level above it shown unexpanded
+        depth = max(rows[TREE_MAX_FOLDERS].depth - 1, 0)
+        rows = [row for row in rows[:TREE_MAX_FOLDERS] if row.depth <= depth]
+
+    # Resolve viewer for every folder beneath it in batches rather than one check per folder
+    allowed = [True] + fga_batch_check_user_access([(user_uuid, "viewer", "folder", row.uuid) for row in rows[1:]])
+
+    # Rows come parents first, so each folder's parent node exists by the time the folder is reached.  Folders
+    # the user can't view are left out along with everything beneath them
+    nodes = {}
+    for row, viewable in zip(rows, allowed):
+        if not viewable or (row.depth > 0 and row.parent not in nodes):
+            continue
+        node = nodes[row.uuid] = {
+            "uuid": str(row.uuid),
+            "name": row.name,
+            "type": "folder",
+            "children": [] if row.depth < depth else None,
+        }
+        if row.depth > 0:
+            nodes[row.parent]["children"].append(node)
+
+    client_response = {
+        "tree": nodes[pwd.uuid],
+        "truncated": truncated,
+    }
+    etag = make_etag(digest(json.dumps(client_response, sort_keys=True)), user_uuid)
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+    response = jsonify(client_response)
+    response.set_etag(etag)
+    return response
+
+@main.route("/api/shared")
+@api_require_auth
+def list_shared():
+    # This function returns the folders other users have shared with the requesting user, directly or through
+    # a group.  It is served from the shared folder index rather than an OpenFGA list objects call.  The index
+    # lists every share to a group the user is in, including groups where the user holds a role without being a
+    # member, so the entries are checked with one batch check and folders the user can't view are left out
+    user_uuid = session['uuid']
+    folders = shared_folders(session['user_id'])
+    allowed = fga_batch_check_user_access([(user_uuid, "viewer", "folder", folder.uuid) for folder in folders])
+    sidebar_objects = []
+    for folder, viewable in zip(folders, allowed):
+        if not viewable:
+            continue
+        sidebar_objects.append({
+            "uuid": str(folder.uuid),
+            "name": folder.name,
+            "type": "folder"
+        })
+
+    client_response = {
+        "sidebar": sidebar_objects
     }
     return jsonify(client_response)
 
-def folder_delete(folder_id,user_uuid):
-    # NOT YET IMPLEMENTED - For use in delete_folder() for recursive deletions
-    print("Folder Delete initiated")
+def deleteFolderTree(folder_id, progress=None):
+    # This function deletes a folder and everything beneath it.  The subtree is collected with one recursive query,
+    # every tuple stored in OpenFGA for the deleted folders and files is queued for deletion in the outbox, and the
+    # rows are deleted in bulk in the same transaction.  Tuple writes about them still waiting in the outbox are
+    # dropped and queued for deletion too, so grants on files created moments before aren't written after the rows
+    # are gone.  progress is an optional callback taking done and total counts.
+    folders, files = subtree_contents(folder_id)
+    objects = [f"folder:{row.uuid}" for row in folders] + [f"file:{row.uuid}" for row in files]
+    if progress is not None:
+        progress(done=0, total=len(objects))
+
+    # Tuples can reference a folder or file from either side, but every tuple about a deleted object has that
+    # object, or a descendant of it, as its object, so reading by object finds them all
+    tuples = []
+    with ThreadPoolExecutor(max_workers=FGA_MAX_PARALLEL_REQUESTS) as executor:
+        for count, object_tuples in enumerate(executor.map(lambda object: list(fga_read_tuples(object=object)), objects), 1):
+            tuples.extend(object_tuples)
+            if progress is not None:
+                progress(done=count)
+
+    # Missing deletes are ignored, so queuing a delete for a pending write the worker never sends is harmless
+    tuples = list(dict.fromkeys(tuples + discard_pending(objects)))
+
+    folder_ids = [row.id for row in folders]
+    folder_uuids = [row.uuid for row in folders]
+    enqueue_tuples(tuples, operation="delete")
+    fga_note_write()
+    remove_file_content([row.id for row in files])
+    remove_files([row.id for row in files])
+    for chunk in chunked(folder_uuids):
+        db.session.execute(db.delete(File).where(File.folder.in_(chunk)))
+    for chunk in chunked(folder_ids):
+        shares = db.select(FolderShare.id).where(FolderShare.folder_id.in_(chunk))
+        db.session.execute(db.delete(SharedFolder).where(SharedFolder.share_id.in_(shares)))
+        db.session.execute(db.delete(FolderShare).where(FolderShare.folder_id.in_(chunk)))
+        db.session.execute(db.delete(Folder).where(Folder.id.in_(chunk)))
+    db.session.commit()
 
-def file_delete(file_id,user_uuid):
-    # NOT YET IMPLEMENTED
-    # for use in delete_folder() for recursive deletions
-    print("File Delete Initiated")
+    logger.info("Deleted %s folders and %s files, queued %s tuple deletes", len(folders), len(files), len(tuples))
+    return f"{len(folders)} Folders and {len(files)} Files deleted sucessfully"
 
 
 @main.route("/api/delete_folder/<folder_uuid>", methods=["POST"])
 @api_require_auth
 def delete_folder(folder_uuid):
-    # Function to delete a folder.  Currently Incomplete
+    # Function to delete a folder and everything in it if the requesting user owns it.  Small folders are deleted
+    # before responding.  Larger trees are deleted by a background job and a 202 response with the job's progress
+    # url is returned
     folder_uuid_u = uuid.UUID(folder_uuid)
     user_id = session['user_id']
     user_uuid = session['uuid']
 
     folder = Folder.query.filter_by(uuid=folder_uuid_u).first()
 
+    if folder is None:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
     if folder.default_folder:
         client_response = {
             "result": "error",
@@ -496,40 +1191,25 @@ def delete_folder(folder_uuid):
         return jsonify(client_response), 403
 
     if fga_check_user_access(user_uuid,"owner","folder",folder_uuid):
-        print(f"User is owner of folder")
+        logger.debug("User is owner of folder")
 
-        child_folder_queue = [folder.id]
-        delete_folder_queue = [folder.id]
-        delete_file_queue = []
-    
-        while len(child_folder_queue) > 0:
-            f_id = child_folder_queue.pop(0)
-            folders = Folder.query.filter_by(parent=f_id).all()
-            for f in folders:
-                child_folder_queue.append(f.id)
-                delete_folder_queue.append(f.id)
-            
-            files = File.query.filter_by(folder=f_id).all()
-            for fl in files:
-                delete_file_queue.append(fl.id)
-
-        file_delete_count = 0
-        folder_delete_count = 0
-
-        for dir in delete_folder_queue:
-            folder_delete(dir,user_uuid)
-            folder_delete_count += 1
-
-        for fle in delete_file_queue:
-            file_delete(fle,user_uuid)
-            file_delete_count += 1
+        # Only count far enough to choose, the job reports the tree's full size as it runs
+        if subtree_size(folder.id, FOLDER_DELETE_INLINE_LIMIT + 1) <= FOLDER_DELETE_INLINE_LIMIT:
+            message = deleteFolderTree(folder.id)
+            client_response = {
+                "result": "success",
+                "message": message
+            }
+            return jsonify(client_response)
 
+        job = start_job("delete_folder", user_id, deleteFolderTree, folder.id)
         client_response = {
-            "result": "success",
-            "message": f"{folder_delete_count} Folders and {file_delete_count} Files deleted sucessfully"
+            "result": "accepted",
+            "message": f"Deleting more than {FOLDER_DELETE_INLINE_LIMIT} Folders and Files",
+            "job_uuid": str(job.uuid),
+            "progress_url": url_for("main.get_job", job_uuid=str(job.uuid))
         }
-        return jsonify(client_response)
-        
+        return jsonify(client_response), 202
 
     else:
         client_response = {
@@ -538,13 +1218,26 @@ def delete_folder(folder_uuid):
         }
         return jsonify(client_response), 403
 
+@main.route("/api/jobs/<job_uuid>")
+@api_require_auth
+def get_job(job_uuid):
+    # Function to report the progress of a background job started by the requesting user
+    try:
+        job_uuid_u = uuid.UUID(job_uuid)
+    except ValueError:
+        return jsonify({"result": "error", "message": "Job not found"}), 404
+    job = Job.query.filter_by(uuid=job_uuid_u, user_id=session['user_id']).first()
+    if job is None:
+        return jsonify({"result": "error", "message": "Job not found"}), 404
+    return jsonify(job_status(fail_if_interrupted(job)))
+
 @main.route("/api/create_folder/<folder_uuid>", methods=["POST"])
 @api_require_auth
 def create_folder(folder_uuid):
     # Function to create a new folder within the folder specified if the user is authorized
     # Expects a "name" form value
     name = request.form['name']
-    print(f"Creating folder named {name} in uuid: {folder_uuid}")
+    logger.debug("Creating folder named %s in uuid: %s", name, folder_uuid)
     folder_uuid_u = uuid.UUID(folder_uuid)
     user_id = session['user_id']
     user_uuid = session['uuid']
@@ -553,7 +1246,7 @@ def create_folder(folder_uuid):
     if fga_check_user_access(user_uuid, "can_create_file", "folder", folder_uuid):
         createNewFolder(folder_uuid_u,name,user_id)
     else:
-        print("Access Denied to create folder")
+        logger.debug("Access Denied to create folder")
         return jsonify({'result': 'access denied'}), 403
 
     return jsonify({'result': 'success'})
@@ -567,24 +1260,37 @@ def load_file(file_uuid):
     file_uuid_u = uuid.UUID(file_uuid)
 
     if fga_check_user_access(user_uuid, "can_read", "file", file_uuid):
-        print("User allowed to read file")
+        logger.debug("User allowed to read file")
         read_allowed = True
         file = File.query.filter_by(uuid=file_uuid_u).first()
         if fga_check_user_access(user_uuid, "can_write", "file", file_uuid):
-            print("User allowed to write file")
+            logger.debug("User allowed to write file")
             write_allowed = True
 
         else:
             write_allowed = False
         
+        # Clients that already have this version of the file with the same permissions get a 304 without the
+        # body being read
+        etag = make_etag(file_version(file, blob_digest(file)), user_uuid, read_allowed, write_allowed)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        content = file_content(file)
+
         client_response = {
             "authorized": True,
             "read_allowed": read_allowed,
             "write_allowed": write_allowed,
             "file_name": file.name,
-            "file_content": file.text_content
         }
-        return jsonify(client_response)
+        if content.stream:
+            response = Response(stream_with_context(stream_json(client_response, "file_content", content.chunks())), mimetype="application/json")
+        else:
+            client_response["file_content"] = content.read()
+            response = jsonify(client_response)
+        response.set_etag(etag)
+        return response
     else:
         read_allowed = False
         write_allowed = True
@@ -609,11 +1315,29 @@ def save_file(file_uuid):
     file_uuid_u = uuid.UUID(file_uuid)
 
     if fga_check_user_access(user_uuid, "can_write", "file", file_uuid):
-        print("Write authorized")
-        file = File.query.filter_by(uuid=file_uuid_u).first()
+        logger.debug("Write authorized")
+        query = File.query.filter_by(uuid=file_uuid_u)
+        if request.if_match:
+            # Lock the row so a concurrent save can't change it between the version check and the write
+            query = query.with_for_update()
+        file = query.first()
+
+        # A client sending If-Match only overwrites the version of the file it loaded
+        if precondition_failed(file_version(file, blob_digest(file))):
+            db.session.rollback()
+            client_response = {
+                "authorized": True,
+                "write_allowed": True,
+                "result": "conflict",
+                "message": "The file has been changed since it was loaded"
+            }
+            return jsonify(client_response), 412
+
         file.name = name
-        file.text_content = content
+        set_file_content(file, content)
+        index_file(file, content)
         file.updated = datetime.datetime.utcnow()
+        file.version = File.version + 1
         db.session.commit()
         client_response = {
             "authorized": True,
@@ -621,9 +1345,12 @@ def save_file(file_uuid):
             "result": "success",
             "message": "Changes saved to file"
         }
-        return jsonify(client_response)
+        response = jsonify(client_response)
+        read_allowed = fga_check_user_access(user_uuid, "can_read", "file", file_uuid)
+        response.set_etag(make_etag(file_version(file, blob_digest(file)), user_uuid, read_allowed, True))
+        return response
     else:
-        print("User is not authorized to write this file")
+        logger.debug("User is not authorized to write this file")
         client_response = {
             "authorized": False,
             "write_allowed": False,
@@ -639,21 +1366,107 @@ def create_file(folder_uuid):
     # Function to create a new file with the name and content provided in the specified folder if the user is authorized to do so
     name = request.form['name']
     content = request.form['content']
-    print(f"Creating file named {name} in uuid: {folder_uuid}")
+    logger.debug("Creating file named %s in uuid: %s", name, folder_uuid)
     folder_uuid_u = uuid.UUID(folder_uuid)
     user_id = session['user_id']
     user_uuid = session['uuid']
     pwd = Folder.query.filter_by(uuid=folder_uuid_u).first()
 
     if fga_check_user_access(user_uuid, "can_create_file", "folder", pwd.uuid):
-        print(f"User has permission.  Creating new file named {name} in folder {pwd.name}:{folder_uuid}")
+        logger.debug("User has permission.  Creating new file named %s in folder %s:%s", name, pwd.name, folder_uuid)
         file_uuid = createNewFile(folder_uuid_u, name, user_id, content)
     else:
-        print("Access Denied to create a file here"), 403
+        logger.debug("Access Denied to create a file here")
         return jsonify({'result': 'access denied'})
 
     return jsonify({'result': 'success', 'uuid': file_uuid })
 
+@main.route("/api/import/<folder_uuid>", methods=["POST"])
+@api_require_auth
+def import_archive(folder_uuid):
+    # Function to create the folders and files of a zip or tar archive in the specified folder if the user is
+    # authorized to create files there.  The archive is either the request body or an "archive" form upload, and is
+    # read as it arrives.  Files that can't be imported are listed in the response
+    user_uuid = session['uuid']
+    try:
+        folder_uuid_u = uuid.UUID(folder_uuid)
+    except ValueError:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
+    if not fga_check_user_access(user_uuid, "can_create_file", "folder", folder_uuid):
+        logger.debug("Access Denied to import into folder %s", folder_uuid)
+        return jsonify({'result': 'access denied'}), 403
+
+    folder = Folder.query.filter_by(uuid=folder_uuid_u).first()
+    user = User.query.filter_by(id=session['user_id']).first()
+    if folder is None or user is None:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("archive")
+        if upload is None:
+            return jsonify({"result": "error", "message": "Expected an archive upload"}), 400
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    archive = ArchiveImport(folder.uuid, user)
+    try:
+        summary = archive.run(archive_members(stream))
+    except ArchiveError as e:
+        db.session.rollback()
+        client_response = {"result": "error", "message": str(e)}
+        client_response.update(archive.summary())
+        return jsonify(client_response), 400
+    finally:
+        if archive.folder_count or archive.file_count:
+            fga_note_write()
+
+    client_response = {
+        "result": "success",
+        "message": f"Imported {summary['folders']} Folders and {summary['files']} Files",
+    }
+    client_response.update(summary)
+    return jsonify(client_response)
+
+@main.route("/api/export/<folder_uuid>")
+@api_require_auth
+def export_folder(folder_uuid):
+    # Function to download a folder and everything beneath it that the user can read as a zip archive.  The
+    # archive is streamed as it is built, and files the user can't read are left out
+    user_uuid = session['uuid']
+    try:
+        folder_uuid_u = uuid.UUID(folder_uuid)
+    except ValueError:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
+    if not fga_check_user_access(user_uuid, "viewer", "folder", folder_uuid):
+        return jsonify({"result": "error", "message": "Folder access not authorized"}), 403
+
+    folder = Folder.query.filter_by(uuid=folder_uuid_u).first()
+    if folder is None:
+        return jsonify({"result": "error", "message": "Folder not found"}), 404
+
+    if not acquire_export_slot():
+        client_response = {
+            "result": "error",
+            "message": "Too many exports in progress, try again shortly"
+        }
+        return jsonify(client_response), 429, {"Retry-After": "10"}
+
+    def can_read(file_uuids):
+        return fga_batch_check_user_access([(user_uuid, "can_read", "file", file_uuid) for file_uuid in file_uuids])
+
+    try:
+        response = Response(stream_with_context(export_zip(folder, can_read)), mimetype="application/zip")
+    except BaseException:
+        release_export_slot()
+        raise
+    # The slot is freed when the response is closed, whether or not the whole archive was sent
+    response.call_on_close(release_export_slot)
+    response.headers.set("Content-Disposition", "attachment", filename=f"{folder.name or 'folder'}.zip")
+    return response
+
 @main.route("/api/delete_file/<file_uuid>", methods=["POST"])
 @api_require_auth
 def delete_file(file_uuid):
@@ -662,7 +1475,10 @@ def delete_file(file_uuid):
     user_uuid = session['uuid']
 
     if fga_check_user_access(user_uuid, "can_write", "file", file_uuid):
-        print("User authorized with write access can delete file.")
+        logger.debug("User authorized with write access can delete file.")
+        file_ids = db.session.scalars(db.select(File.id).where(File.uuid == file_uuid_u)).all()
+        remove_file_content(file_ids)
+        remove_files(file_ids)
         File.query.filter_by(uuid=file_uuid_u).delete()
         db.session.commit()
         client_response = {
@@ -672,7 +1488,7 @@ def delete_file(file_uuid):
         }
         return jsonify(client_response)
     else:
-        print("User is not authorized to delete file")
+        logger.debug("User is not authorized to delete file")
         client_response = {
             "authorized" : False,
             "success": False,
@@ -705,34 +1521,27 @@ def create_group():
     
 @main.route("/api/group/<group_uuid>")
 @api_require_auth
-def get_group(group_uuid):
+async def get_group(group_uuid):
     # Function to retrieve the details of a specified group if the requesting user is authorized
     user_uuid = session["uuid"]
     group_uuid_u = uuid.UUID(group_uuid)
 
-    if fga_check_user_access(user_uuid,"can_view", "group", group_uuid):
+    if await fga_check_user_access_async(user_uuid,"can_view", "group", group_uuid):
         # User is authorized to view group members
         group = Group.query.filter_by(uuid=group_uuid_u).first()
-        members = UserGroup.query.filter_by(group_id=group.id).all()
-        if fga_check_user_access(user_uuid, "can_invite", "group", group_uuid):
-            can_invite = True
-        else:
-            can_invite = False
+        members = group_members(group.id)
+
+        # The invite check and the role lookup are independent, so send them at the same time
+        can_invite, roles = await asyncio.gather(
+            fga_check_user_access_async(user_uuid, "can_invite", "group", group_uuid),
+            fga_group_roles_async([(group_member.uuid, group_uuid) for group_member in members]),
+        )
 
         member_list = []
         member_count = 0
 
-        for member in members:
-            group_member = User.query.filter_by(id=member.user_id).first()
-
-            #Check member's access level
-            member_level = None
-            if fga_check_user_access(group_member.uuid, "member", "group", group_uuid):
-                member_level = "member"
-            if fga_check_user_access(group_member.uuid, "admin", "group", group_uuid):
-                member_level = "admin"
-            if fga_check_user_access(group_member.uuid, "owner", "group", group_uuid):
-                member_level = "owner"
+        for group_member in members:
+            member_level = roles[(str(group_member.uuid), str(group_uuid))]
 
             if member_level is not None:
                 member_list.append({
@@ -764,7 +1573,7 @@ def get_group(group_uuid):
 @api_require_auth
 def share_folder(folder_uuid):
     # Function to share a folder with a user or group if the requesting user is authorized to do so
-    print("Folder Share Request")
+    logger.debug("Folder Share Request")
     user_id = session["user_id"]
     user_uuid = session["uuid"]
     
@@ -774,23 +1583,20 @@ def share_folder(folder_uuid):
 
     allow_write = request.form["allow_write"]
 
-    print(f"Allow Write: {allow_write}")
+    logger.debug("Allow Write: %s", allow_write)
 
     if fga_check_user_access(user_uuid,"can_share","folder",folder_uuid):
-        print("User is authorized to share folder")
-        if allow_write == "true":
-            relation = "can_create_file"
-        else:
-            relation = "viewer"
+        logger.debug("User is authorized to share folder")
+        relation = SHARE_RELATIONS["folder"][1 if allow_write == "true" else 0]
+
+        logger.debug("Sharing folder %s with %s %s with relation %s", folder_uuid, subject_type, subject_uuid, relation)
 
-        print(f"Sharing folder {folder_uuid} with {subject_type} {subject_uuid} with relation {relation}")
+        folder = Folder.query.filter_by(uuid=uuid.UUID(folder_uuid)).first()
 
         if subject_type == "user":
-            
-            fga_relate_user_object(subject_uuid,folder_uuid,"folder",relation)
+            subject = User.query.filter_by(uuid=uuid.UUID(subject_uuid)).first()
         elif subject_type == "group":
-            fga_relate_objects("group",f"{subject_uuid}#member","folder", folder_uuid, relation)
-            
+            subject = Group.query.filter_by(uuid=uuid.UUID(subject_uuid)).first()
         else:
             client_response = {
             "result": "error",
@@ -798,6 +1604,21 @@ def share_folder(folder_uuid):
             }
             return jsonify(client_response), 500
 
+        if folder is None or subject is None:
+            client_response = {
+                "result": "error",
+                "message": f"Folder or {subject_type} not found"
+            }
+            return jsonify(client_response), 404
+
+        # The share is added to the shared folder index and the tuple is queued in the same transaction
+        record_folder_share(folder, subject_type, subject.id, relation)
+        if subject_type == "user":
+            fga_enqueue_user_object(subject_uuid,folder_uuid,"folder",relation)
+        else:
+            fga_enqueue_objects("group",f"{subject_uuid}#member","folder", folder_uuid, relation)
+        db.session.commit()
+
         client_response = {
             "result": "success",
             "message": "Folder shared"
@@ -817,7 +1638,7 @@ def share_folder(folder_uuid):
 @api_require_auth
 def share_file(file_uuid):
     # Function to share a specified file with a user or group if the requesting user is authorized
-    print("File Share Request")
+    logger.debug("File Share Request")
     user_id = session["user_id"]
     user_uuid = session["uuid"]
     
@@ -827,16 +1648,13 @@ def share_file(file_uuid):
 
     allow_write = request.form["allow_write"]
 
-    print(f"Allow Write: {allow_write}")
+    logger.debug("Allow Write: %s", allow_write)
 
     if fga_check_user_access(user_uuid,"can_share","file",file_uuid):
-        print("User is authorized to share file")
-        if allow_write == "true":
-            relation = "can_write"
-        else:
-            relation = "can_view"
+        logger.debug("User is authorized to share file")
+        relation = SHARE_RELATIONS["file"][1 if allow_write == "true" else 0]
 
-        print(f"Sharing file {file_uuid} with {subject_type} {subject_uuid} with relation {relation}")
+        logger.debug("Sharing file %s with %s %s with relation %s", file_uuid, subject_type, subject_uuid, relation)
 
         if subject_type == "user":
             
@@ -865,11 +1683,122 @@ def share_file(file_uuid):
         }
         return jsonify(client_response), 403
 
+@main.route("/api/share/<object_type>/<object_uuid>/bulk", methods=["POST"])
+@api_require_auth
+def share_bulk(object_type, object_uuid):
+    # Function to share a folder or file with many users and groups at once.  The request body is JSON of the form
+    # {"subjects": [{"subject_type": "user", "subject_uuid": "...", "allow_write": false}, ...]}.  The can_share
+    # check is made once and the grants are written in multi-tuple writes.  A result is returned for each subject
+    logger.debug("Bulk Share Request")
+    user_uuid = session["uuid"]
+
+    if object_type not in SHARE_RELATIONS:
+        return jsonify({"result": "error", "message": "Only folders and files can be shared"}), 404
+
+    body = request.get_json(silent=True)
+    subjects = body.get("subjects") if isinstance(body, dict) else None
+    if not isinstance(subjects, list) or not subjects:
+        return jsonify({"result": "error", "message": "Expected a JSON body with a list of subjects"}), 400
+    if len(subjects) > BULK_SHARE_MAX_SUBJECTS:
+        return jsonify({"result": "error", "message": f"At most {BULK_SHARE_MAX_SUBJECTS} subjects can be shared with at once"}), 400
+
+    if not fga_check_user_access(user_uuid,"can_share",object_type,object_uuid):
+        return jsonify({"result": "error", "message": f"Not authorized to share this {object_type}"}), 403
+
+    try:
+        object_uuid_u = uuid.UUID(object_uuid)
+    except ValueError:
+        object_uuid_u = None
+    model = Folder if object_type == "folder" else File
+    shared_object = model.query.filter_by(uuid=object_uuid_u).first() if object_uuid_u else None
+    if shared_object is None:
+        return jsonify({"result": "error", "message": f"{object_type.capitalize()} not found"}), 404
+
+    # Parse every subject first, so the users and groups can be looked up with one query each
+    results = []
+    parsed = []
+    for subject in subjects:
+        subject = subject if isinstance(subject, dict) else {}
+        result = {"subject_type": subject.get("subject_type"), "subject_uuid": subject.get("subject_uuid")}
+        results.append(result)
+        try:
+            subject_uuid = uuid.UUID(str(subject.get("subject_uuid")))
+        except ValueError:
+            subject_uuid = None
+        if result["subject_type"] not in ("user", "group"):
+            result.update(result="error", message="No valid subject type defined")
+        elif subject_uuid is None:
+            result.update(result="error", message="Invalid subject uuid")
+        else:
+            allow_write = subject.get("allow_write") in (True, "true")
+            result["relation"] = SHARE_RELATIONS[object_type][1 if allow_write else 0]
+            parsed.append((result, subject_uuid))
+
+    found = {
+        "user": users_by_uuid(subject_uuid for result, subject_uuid in parsed if result["subject_type"] == "user"),
+        "group": groups_by_uuid(subject_uuid for result, subject_uuid in parsed if result["subject_type"] == "group"),
+    }
+
+    # The tuple each subject is granted, along with the results it is reported in
+    grants = {}
+    for result, subject_uuid in parsed:
+        subject_type = result["subject_type"]
+        row = found[subject_type].get(subject_uuid)
+        if row is None:
+            result.update(result="error", message=f"{subject_type.capitalize()} not found")
+            continue
+        user = f"user:{subject_uuid}" if subject_type == "user" else f"group:{subject_uuid}#member"
+        grants.setdefault((user, result["relation"], f"{object_type}:{object_uuid_u}"), []).append((result, row))
+
+    logger.debug("Sharing %s %s with %s subjects", object_type, object_uuid, len(grants))
+
+    if object_type == "folder":
+        # Folder shares are added to the shared folder index and their tuples queued in one transaction
+        record_folder_shares(shared_object, [
+            (result["subject_type"], row.id, result["relation"])
+            for entries in grants.values() for result, row in entries
+        ])
+        enqueue_tuples(grants)
+        db.session.commit()
+        succeeded = list(grants)
+    else:
+        # File shares are written straight away in chunks of up to 100 tuples.  A chunk OpenFGA rejects fails only
+        # the subjects in it, and chunks that can't be sent because OpenFGA is unavailable are queued instead
+        succeeded = []
+        for chunk in chunked(grants, MAX_TUPLES_PER_WRITE):
+            try:
+                fga_write_tuples(chunk, [])
+            except FgaUnavailable as e:
+                logger.warning("OpenFGA unavailable, queueing %s file shares: %s", len(chunk), e)
+                enqueue_tuples(chunk)
+                db.session.commit()
+            except Exception as e:
+                logger.warning("Sharing file %s failed for %s subjects: %s", object_uuid, len(chunk), e)
+                for grant in chunk:
+                    for result, row in grants[grant]:
+                        result.update(result="error", message="Share could not be written")
+                continue
+            succeeded.extend(chunk)
+    if succeeded:
+        fga_note_write()
+
+    for grant in succeeded:
+        for result, row in grants[grant]:
+            result["result"] = "success"
+
+    failed = sum(result["result"] != "success" for result in results)
+    client_response = {
+        "result": "success" if not failed else "partial",
+        "message": f"{object_type.capitalize()} shared with {len(results) - failed} of {len(results)} subjects",
+        "results": results,
+    }
+    return jsonify(client_response)
+
 @main.route("/api/group/add/<group_uuid>", methods=["POST"])
 @api_require_auth
 def group_add_user(group_uuid):
     # Function to add a user to a group if the requesting user is authorized to add users to the specified group
-    print("Add user to group request")
+    logger.debug("Add user to group request")
     member_uuid = request.form["user_uuid"]
     member_uuid_u = uuid.UUID(member_uuid)
     group_uuid_u = uuid.UUID(group_uuid)
@@ -877,30 +1806,33 @@ def group_add_user(group_uuid):
     role = request.form['role']
 
     if fga_check_user_access(user_uuid, "can_invite", "group", group_uuid):
-        print("user is authorized to add members to group")
+        logger.debug("user is authorized to add members to group")
         new_user = User.query.filter_by(uuid=member_uuid_u).first()
         group = Group.query.filter_by(uuid=group_uuid_u).first()
         #Check if user is already a member
         if UserGroup.query.filter_by(user_id=new_user.id, group_id=group.id).first() is None:
             membership = UserGroup(user_id=new_user.id,group_id=group.id)
             db.session.add(membership)
-            db.session.commit()
 
-            res = fga_relate_user_object(new_user.uuid,group_uuid,"group",role)
+            # The role tuples are committed with the membership and written to OpenFGA by the outbox worker
+            fga_enqueue_user_object(new_user.uuid,group_uuid,"group",role)
             if role == "admin":
-                fga_relate_user_object(new_user.uuid,group_uuid,"group","member")
-            if res is not None:
-                client_response = {
-                    "result": "success",
-                    "message": f"User added to group as {role}"
-                }
-                return jsonify(client_response)
-            else:
-                client_response = {
-                    "result": "error",
-                    "message": f"Failed to grant user {role} permissions on this group"
-                }
-                return jsonify(client_response),500
+                fga_enqueue_user_object(new_user.uuid,group_uuid,"group","member")
+
+            # Folders already shared with the group now show up as shared with the new member
+            add_group_member_shares(new_user.id, group.id)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent request added the same membership first
+                db.session.rollback()
+                return jsonify({"result": "error", "message": "User is already a member of this group"}), 409
+
+            client_response = {
+                "result": "success",
+                "message": f"User added to group as {role}"
+            }
+            return jsonify(client_response)
         else: 
             # User is already a group member.  
             client_response = {
@@ -914,7 +1846,7 @@ def group_add_user(group_uuid):
 @api_require_auth
 def group_make_user_admin(group_uuid):
     # Function to allow a group owner or admin to grant admin permissions on that group to another user
-    print("Make user group admin")
+    logger.debug("Make user group admin")
     user_uuid = session['uuid']
     group_uuid_u = uuid.UUID(group_uuid)
     subject_uuid = request.forn['subject_uuid']
@@ -936,12 +1868,12 @@ def group_make_user_admin(group_uuid):
 @api_require_auth
 def group_downgrade_user(group_uuid):
     # Function to allow a group owner or admin to revoke admin permissions from a specified group member
-    print("Remove group admin privileges from user")
+    logger.debug("Remove group admin privileges from user")
     user_uuid = session['uuid']
     group_uuid_u = uuid.UUID(group_uuid)
     subject_uuid = request.form['subject_uuid']
     if fga_check_user_access(user_uuid,"admin","group",group_uuid) or fga_check_user_access(user_uuid,"owner","group",group_uuid):
-        print("user is authorized to change group permissions")
+        logger.debug("user is authorized to change group permissions")
         fga_delete_user_tuple(subject_uuid,group_uuid,"group","admin")
         client_response = {
             "result": "success",
@@ -960,25 +1892,49 @@ def group_downgrade_user(group_uuid):
 def group_remove_user(group_uuid):
     # NOT IMPLEMENTED
     # Function to allow a group owner or admin to remove a user from the specified group
-    print("Remove user from group")
+    logger.debug("Remove user from group")
+
+@main.route("/api/search")
+@api_require_auth
+def search():
+    # Function to search the names and contents of the files the user can read.  Takes the search as ?q=, returns
+    # up to ?limit= files and a next_cursor to pass back as ?cursor= for more
+    user_uuid = session['uuid']
+    query = request.args.get("q", "")
+    try:
+        limit = min(max(int(request.args.get("limit", SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get("cursor", 0)), 0)
+    except ValueError:
+        return jsonify({"result": "error", "message": "Invalid limit or cursor"}), 400
+
+    def can_read(file_uuids):
+        return fga_batch_check_user_access([(user_uuid, "can_read", "file", file_uuid) for file_uuid in file_uuids])
+
+    files, next_offset = search_files(query, can_read, limit, offset)
+    client_response = {
+        "files": [
+            {"uuid": str(file.uuid), "name": file.name, "folder": str(file.folder), "snippet": snippet}
+            for file, snippet in files
+        ],
+        "next_cursor": None if next_offset is None else str(next_offset),
+    }
+    return jsonify(client_response)
 
 @main.route("/api/user_autocomplete", methods=["POST"])
 @api_require_auth
 def user_autocomplete():
     # Function used to populate the autocomplete in share UIs for selecting a user
     partial = request.form["partial"]
-    suggestions = User.query.filter(User.email.startswith(partial)).limit(8)
     matches = []
     match_count = 0
-    for user in suggestions:
-        if user.uuid != session['uuid']:
-            matches.append({
-                "name": user.name,
-                "email": user.email,
-                "uuid": user.uuid,
-                "image": user.image
-            })
-            match_count += 1
+    for user in search_users(partial, exclude_user_id=session['user_id']):
+        matches.append({
+            "name": user["name"],
+            "email": user["email"],
+            "uuid": user["uuid"],
+            "image": user["image"]
+        })
+        match_count += 1
     client_response = {
         "matches": match_count,
         "users": matches
@@ -993,18 +1949,9 @@ def group_autocomplete():
     user_uuid = session["uuid"]
     
     partial = request.form["partial"]
-    suggestions = Group.query.filter(Group.name.startswith(partial)).limit(8)
-    matches = []
-    match_count = 0
-    for group in suggestions:
-        if fga_check_user_access(user_uuid,"can_view","group",group.uuid):
-            matches.append({
-                "name": group.name,
-                "uuid": group.uuid
-            })
-            match_count += 1
+    matches = search_groups(partial, user_uuid, lambda group_uuids: fga_viewable_groups(user_uuid, group_uuids))
     client_response = {
-        "matches": match_count,
+        "matches": len(matches),
         "groups": matches
     }
     return jsonify(client_response)
@@ -1012,30 +1959,39 @@ def group_autocomplete():
 
 @main.route("/file/<file_uuid>")
 @require_auth
-def file_view(file_uuid):
+async def file_view(file_uuid):
     # Function to load the contents of the specified file if the requesting user is authorized to view it.
     # Also checks if the user has write or owner permissions and provides other metadata
     file_uuid_u = uuid.UUID(file_uuid)
     user_uuid = session.get('uuid')
 
-    if fga_check_user_access(user_uuid, "can_read", "file", file_uuid):
-        print("File access authorized")
+    # The read, write and share checks are independent so they are sent to OpenFGA concurrently
+    read_allowed, write_allowed, share_allowed = await fga_check_all_async([
+        (user_uuid, "can_read", "file", file_uuid),
+        (user_uuid, "can_write", "file", file_uuid),
+        (user_uuid, "can_share", "file", file_uuid),
+    ])
+
+    if read_allowed:
+        logger.debug("File access authorized")
         file = File.query.filter_by(uuid=file_uuid_u).first()
         creator = User.query.filter_by(id=file.creator).first()
 
-        if fga_check_user_access(user_uuid, "can_write", "file", file_uuid):
-            write_allowed = True
-        else:
-            write_allowed = False
-            print("User does not have write access")
+        if not write_allowed:
+            logger.debug("User does not have write access")
 
-        if fga_check_user_access(user_uuid, "can_share", "file", file_uuid):
-            share_allowed = True
-        else:
-            share_allowed = False
-            print("User cannot share this file")
+        if not share_allowed:
+            logger.debug("User cannot share this file")
 
         
+        version = file_version(file, blob_digest(file))
+        # The page also shows the viewer's and the creator's names and pictures
+        etag = make_etag(version, user_uuid, write_allowed, share_allowed, session.get('name'), session.get('image'), creator.name, creator.image)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        content = file_content(file)
+
         created = datetime.datetime.strftime(file.created, '%d-%b-%Y %H:%M')
         updated = datetime.datetime.strftime(file.updated, '%d-%b-%Y %H:%M')
 
@@ -1045,15 +2001,22 @@ def file_view(file_uuid):
             "share_allowed": share_allowed,
             "uuid": file_uuid,
             "name": file.name,
-            "content": file.text_content,
+            "content": content.chunks() if content.stream else content.read(),
             "created": created,
             "modified": updated,
             "creator_name": creator.name,
-            "creator_image": creator.image
+            "creator_image": creator.image,
+            "etag": f'"{etag}"'
         }
-        return render_template("file.html", user=session, data=client_response)
+        if content.stream:
+            # Large bodies are rendered into the page as they are read
+            response = Response(stream_template("file.html", user=session, data=client_response))
+        else:
+            response = make_response(render_template("file.html", user=session, data=client_response))
+        response.set_etag(etag)
+        return response
     else:
-        print("Not authorized")
+        logger.debug("Not authorized")
         client_response = {
             "authorized": False,
             "message": "Not authorized to view this file"
@@ -1062,36 +2025,26 @@ def file_view(file_uuid):
     
 @main.route("/groups")
 @require_auth
-def groups():
+async def groups():
     # Returns details about the groups the requesting user is owner, admin, or a member of
     user_id = session['user_id']
     user_uuid = session['uuid']
 
-    groups = UserGroup.query.filter_by(user_id=user_id)
-
     users_groups = []
     group_count = 0
 
-    for membership in groups:
-        group_id = membership.group_id
-        group = Group.query.filter_by(id=group_id).first()
-
-        member_count = UserGroup.query.filter_by(group_id=group_id).count()
-
-        access_level = None
-        if fga_check_user_access(user_uuid, "member", "group", group.uuid):
-            access_level = "member"
-
-        if fga_check_user_access(user_uuid, "admin", "group", group.uuid):
-            access_level = "admin"
+    user_groups = user_groups_with_member_counts(user_id)
 
-        if fga_check_user_access(user_uuid, "owner", "group", group.uuid):
-            access_level = "owner"
+    # Roles are resolved with one list per role, and the groups the user can invite to with one more
+    roles, invite_groups = await asyncio.gather(
+        fga_group_roles_async([(user_uuid, group.uuid) for group, member_count in user_groups]),
+        fga_list_objects_async(user_uuid, "can_invite", "group"),
+    )
+    invite_groups = set(invite_groups)
 
-        if fga_check_user_access(user_uuid, "can_invite", "group", group.uuid):
-            can_invite = True 
-        else:
-            can_invite = False
+    for group, member_count in user_groups:
+        access_level = roles[(str(user_uuid), str(group.uuid))]
+        can_invite = f"group:{group.uuid}" in invite_groups
 
         if access_level is not None:
             users_groups.append({
@@ -1120,7 +2073,7 @@ def home():
     # the last directory they viewed.
     #
     # If there is no "pwd" value specifying a current directory we default to the user's default_folder
-    if session:
+    if 'user_id' in session:
         user_id = session.get('user_id')
         user_uuid = session.get('uuid')
         if not session.get('pwd'):
@@ -1131,7 +2084,7 @@ def home():
         else:
             current_directory = session.get('pwd')
             u_type = type(current_directory)
-            print(f"Current Folder: {current_directory} Type: {u_type}")
+            logger.debug("Current Folder: %s Type: %s", current_directory, u_type)
             
             if fga_check_user_access(user_uuid,"viewer","folder", current_directory):
                 user_folder = Folder.query.filter_by(uuid=current_directory).first()
@@ -1144,4 +2097,35 @@ def home():
     else:
         user_folder = None
 
-    return render_template("main.html", session=session.get('user'),pwd=user_folder, user=session, pretty=json.dumps(session.get("user"), indent=4))
\ No newline at end of file
+    return render_template("main.html", session=session.get('user_id'),pwd=user_folder, user=session, pretty=json.dumps(dict(session), indent=4, default=str))
+
+@main.app_errorhandler(FgaUnavailable)
+def fga_unavailable(error):
+    # OpenFGA couldn't be reached and there was no last known decision to fall back on
+    logger.warning("OpenFGA unavailable: %s", error)
+    retry_after = str(int(fga_resilience.breaker.open_for))
+    if request.path.startswith("/api/"):
+        client_response = {
+            "result": "error",
+            "message": "Authorization service unavailable, try again shortly"
+        }
+        return jsonify(client_response), 503, {"Retry-After": retry_after}
+    return Response("Authorization service unavailable, try again shortly", status=503, headers={"Retry-After": retry_after})
+
+@main.after_app_request
+def mark_stale_response(response):
+    # Responses built from last known decisions are flagged so clients and monitoring can tell
+    if g.get("fga_stale"):
+        response.headers["X-Authorization-Stale"] = "true"
+    return response
+
+@main.route("/metrics")
+def prometheus_metrics():
+    # Request, database and OpenFGA call metrics of this process in the Prometheus text format.  Only served with
+    # METRICS_ENABLED=true, and to callers presenting METRICS_TOKEN when one is set
+    if not current_app.config["METRICS_ENABLED"]:
+        return Response(status=404)
+    token = current_app.config["METRICS_TOKEN"]
+    if token and not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return metrics.metrics_response()
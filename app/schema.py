@@ -0,0 +1,222 @@
+from app import db
+from app.models import UserGroup, File, Folder, TupleOutbox, SharedFolder, FolderShare, AutocompleteEntry, prefix_filter
+from sqlalchemy import and_, delete, func, inspect, or_, select
+from sqlalchemy.schema import CreateColumn
+import click
+import datetime
+import logging
+import re
+import uuid
+
+# db.create_all() only creates missing tables, so columns and indexes added to existing tables in app/models.py
+# are not created on databases that already exist.  upgrade_schema() creates any missing columns and indexes, and
+# explain_hot_queries() checks that each of the app's hot lookups is answered from its index, in index order,
+# rather than by a full table scan or a sort.
+# Both are available as flask commands:
+#
+#   flask --app run upgrade-db
+#   flask --app run check-indexes
+
+logger = logging.getLogger(__name__)
+
+
+def _remove_duplicate_memberships():
+    # The unique index on UserGroup(user_id, group_id) can't be created while duplicate rows exist, so keep the
+    # oldest membership row for each pair and delete the rest
+    keep = select(func.min(UserGroup.id)).group_by(UserGroup.user_id, UserGroup.group_id)
+    result = db.session.execute(delete(UserGroup).where(UserGroup.id.not_in(keep)))
+    db.session.commit()
+    return result.rowcount
+
+
+# Indexes earlier versions created that are now covered by a wider composite index, as (table, index name)
+RETIRED_INDEXES = [
+    ("folder", "ix_folder_parent"),
+    ("file", "ix_file_folder"),
+    ("autocomplete_entry", "ix_autocomplete_entry_kind_key"),
+]
+
+
+def _add_missing_columns(inspector):
+    # Add columns declared in app/models.py to existing tables that don't have them.  New columns must be nullable
+    # or have a server default.  Returns the names of the columns added as "table.column"
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {definition}")
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def upgrade_schema():
+    # Create missing tables, columns and any indexes declared in app/models.py that don't exist yet, and drop
+    # retired indexes.  Returns (names of the indexes created, names of the indexes dropped, columns added).
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    columns = _add_missing_columns(inspector)
+    created = []
+    dropped = []
+    for table_name, index_name in RETIRED_INDEXES:
+        if index_name in {index["name"] for index in inspector.get_indexes(table_name)}:
+            on_table = f" ON {table_name}" if db.engine.dialect.name in ("mysql", "mariadb") else ""
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql(f"DROP INDEX {index_name}{on_table}")
+            dropped.append(index_name)
+
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name in existing:
+                continue
+            if index.unique and table.name == UserGroup.__tablename__:
+                removed = _remove_duplicate_memberships()
+                if removed:
+                    logger.info("Removed %s duplicate group memberships", removed)
+            index.create(db.engine)
+            created.append(index.name)
+    return created, dropped, columns
+
+
+def hot_queries():
+    # The lookups made on every listing, login, group page and autocomplete request, each with the names of the
+    # indexes that should answer it
+    sample_uuid = uuid.uuid4()
+    sample_time = datetime.datetime(2024, 1, 1)
+    folder_parent = ("ix_folder_parent_name", "ix_folder_parent_created")
+    file_folder = ("ix_file_folder_name", "ix_file_folder_created")
+    return {
+        "child folders (Folder.parent)": (select(Folder.id).where(Folder.parent == sample_uuid), folder_parent),
+        "child files (File.folder)": (select(File.id).where(File.folder == sample_uuid), file_folder),
+        "child folders by name (Folder.parent, name)": (
+            select(Folder.id).where(Folder.parent == sample_uuid, or_(Folder.name > "m", and_(Folder.name == "m", Folder.id > 1))).order_by(Folder.name, Folder.id).limit(200),
+            ("ix_folder_parent_name",)),
+        "child files by created (File.folder, created)": (
+            select(File.id).where(File.folder == sample_uuid, or_(File.created > sample_time, and_(File.created == sample_time, File.id > 1))).order_by(File.created, File.id).limit(200),
+            ("ix_file_folder_created",)),
+        "unnamed child folders (Folder.parent, name)": (
+            select(Folder.id).where(Folder.parent == sample_uuid, Folder.name.is_(None), Folder.id > 1).order_by(Folder.id).limit(200),
+            ("ix_folder_parent_name",)),
+        "default folder (Folder.creator, default_folder)": (
+            select(Folder.id).where(Folder.creator == 1, Folder.default_folder == True),
+            ("ix_folder_creator_default_folder",)),
+        "membership (UserGroup.user_id, group_id)": (
+            select(UserGroup.id).where(UserGroup.user_id == 1, UserGroup.group_id == 1),
+            ("uq_user_group_user_id_group_id",)),
+        "user's groups (UserGroup.user_id)": (
+            select(UserGroup.id).where(UserGroup.user_id == 1),
+            ("uq_user_group_user_id_group_id",)),
+        "group members (UserGroup.group_id)": (
+            select(UserGroup.id).where(UserGroup.group_id == 1),
+            ("ix_user_group_group_id",)),
+        "autocomplete prefix (AutocompleteEntry.kind, key)": (
+            select(AutocompleteEntry.ref_id).where(AutocompleteEntry.kind == "group", prefix_filter(AutocompleteEntry.key, "eng")).order_by(AutocompleteEntry.key, AutocompleteEntry.ref_id).limit(50),
+            ("ix_autocomplete_entry_kind_key_ref_id",)),
+        "shared with me (SharedFolder.user_id)": (
+            select(SharedFolder.folder_id).where(SharedFolder.user_id == 1),
+            ("uq_shared_folder_user_id_share_id",)),
+        "group shares (FolderShare.subject_type, subject_id)": (
+            select(FolderShare.id).where(FolderShare.subject_type == "group", FolderShare.subject_id == 1),
+            ("ix_folder_share_subject_type_subject_id",)),
+        "due outbox entries (TupleOutbox.failed, next_attempt)": (
+            select(TupleOutbox.id).where(TupleOutbox.failed == False, TupleOutbox.next_attempt <= func.current_timestamp()),
+            ("ix_tuple_outbox_failed_next_attempt",)),
+    }
+
+
+def _driver_params(compiled):
+    # Parameters are passed straight to the driver, so convert values the driver doesn't understand
+    def convert(value):
+        if isinstance(value, uuid.UUID):
+            return value.hex
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    params = compiled.params
+    if compiled.positional:
+        return tuple(convert(params[name]) for name in compiled.positiontup)
+    return {name: convert(value) for name, value in params.items()}
+
+
+def explain(statement, indexes=()):
+    # Returns (problems, plan lines) for a statement on the current database.  problems is empty if the statement
+    # is answered from one of the named indexes, or any index if none are named, without scanning a table or
+    # sorting rows the index should have returned in order
+    dialect = db.engine.dialect.name
+    compiled = statement.compile(dialect=db.engine.dialect)
+    params = _driver_params(compiled)
+
+    with db.engine.connect() as connection:
+        if dialect == "sqlite":
+            rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+            plan = [row[-1] for row in rows]
+            scans = not any(line.startswith("SEARCH") for line in plan) or any(
+                line.startswith("SCAN") and "INDEX" not in line for line in plan
+            )
+            sorts = any("TEMP B-TREE" in line for line in plan)
+        elif dialect == "postgresql":
+            # Small tables are cheaper to scan and sort than to search, so tell the planner to avoid sequential
+            # scans and sorts when possible.  Either in the plan then means no usable index exists.
+            with connection.begin():
+                connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+                connection.exec_driver_sql("SET LOCAL enable_sort = off")
+                rows = connection.exec_driver_sql(f"EXPLAIN {compiled}", params).all()
+            plan = [row[0] for row in rows]
+            scans = any("Seq Scan" in line for line in plan)
+            sorts = any(line.strip().lstrip("-> ").startswith(("Sort", "Incremental Sort")) for line in plan)
+        elif dialect in ("mysql", "mariadb"):
+            result = connection.exec_driver_sql(f"EXPLAIN {compiled}", params)
+            rows = [dict(zip(result.keys(), row)) for row in result]
+            plan = [f"{row.get('table')}: type={row.get('type')} key={row.get('key')} extra={row.get('Extra')}" for row in rows]
+            scans = any(row.get("type") == "ALL" for row in rows)
+            sorts = any("filesort" in (row.get("Extra") or "") for row in rows)
+        else:
+            raise click.ClickException(f"EXPLAIN checks are not supported on {dialect}")
+
+    problems = []
+    if scans:
+        problems.append("scans a table")
+    if sorts:
+        problems.append("sorts rows instead of reading them in index order")
+    if indexes and not any(re.search(rf"\b{name}\b", line) for line in plan for name in indexes):
+        problems.append(f"doesn't use {' or '.join(indexes)}")
+    return problems, plan
+
+
+def explain_hot_queries():
+    # Returns a list of (name, problems, plan lines) for every hot query
+    return [(name, *explain(statement, indexes)) for name, (statement, indexes) in hot_queries().items()]
+
+
+def register_commands(app):
+    @app.cli.command("upgrade-db")
+    def upgrade_db_command():
+        """Create missing tables, columns and indexes on an existing database."""
+        created, dropped, columns = upgrade_schema()
+        if columns:
+            click.echo(f"Added columns: {', '.join(columns)}")
+        if created:
+            click.echo(f"Created indexes: {', '.join(created)}")
+        if dropped:
+            click.echo(f"Dropped retired indexes: {', '.join(dropped)}")
+        if not created and not dropped and not columns:
+            click.echo("Database schema is up to date")
+
+    @app.cli.command("check-indexes")
+    def check_indexes_command():
+        """Verify with EXPLAIN that every hot query uses its index."""
+        failures = 0
+        for name, problems, plan in explain_hot_queries():
+            click.echo(f"{'FAIL' if problems else 'ok  '} {name}{': ' + ', '.join(problems) if problems else ''}")
+            for line in plan:
+                click.echo(f"       {line}")
+            if problems:
+                failures += 1
+        if failures:
+            raise click.ClickException(f"{failures} hot queries do not use their index.  Run 'flask upgrade-db'")
@@ -0,0 +1,197 @@
+from app import db
+from app.content import file_content
+from app.models import File
+from app.queries import chunked
+from flask import current_app
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.exc import OperationalError
+import click
+import logging
+import re
+
+# /api/search finds files by name and body.  Files are indexed by a SearchIndex: on SQLite an FTS5 table,
+# file_search, written in the same transaction as the file, and on other databases a LIKE scan of the file table.
+# SEARCH_BACKEND picks one, and further backends only need add(), remove(), search() and clear().  Hits come back
+# in rank order and are checked for can_read a page at a time, so only files the caller may read are returned
+# and a search for a common word doesn't check every file that contains it.
+
+logger = logging.getLogger(__name__)
+
+# Hits are fetched and permission checked this many at a time, for at most this many pages per request
+CANDIDATE_PAGE_SIZE = 100
+MAX_CANDIDATE_PAGES = 10
+
+# Searches use at most this many words
+MAX_QUERY_TERMS = 10
+
+
+def query_terms(query):
+    # The words of a search, ignoring punctuation and FTS5 operators
+    return re.findall(r"\w+", query or "")[:MAX_QUERY_TERMS]
+
+
+class Fts5SearchIndex:
+    # An FTS5 table holding each file's name and body under the file's id.  Names are weighted above bodies
+    # when ranking, and the last word of a search matches as a prefix so results appear while typing
+
+    name = "fts5"
+
+    def create(self):
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(name, content, tokenize='unicode61 remove_diacritics 2')"
+        ))
+        db.session.commit()
+
+    def add(self, files):
+        # Index or re-index files, given as (file id, name, body) tuples, in the current session
+        files = list(files)
+        self.remove([file_id for file_id, name, content in files])
+        if files:
+            db.session.execute(
+                text("INSERT INTO file_search (rowid, name, content) VALUES (:id, :name, :content)"),
+                [{"id": file_id, "name": name or "", "content": content or ""} for file_id, name, content in files],
+            )
+
+    def remove(self, file_ids):
+        for chunk in chunked(file_ids):
+            db.session.execute(
+                text("DELETE FROM file_search WHERE rowid IN :ids").bindparams(bindparam("ids", expanding=True)),
+                {"ids": chunk},
+            )
+
+    def search(self, query, offset, limit):
+        # Returns up to limit (file id, snippet) hits in rank order, skipping the first offset
+        terms = query_terms(query)
+        if not terms:
+            return []
+        match = " ".join(f'"{term}"' for term in terms) + "*"
+        return db.session.execute(
+            text(
+                "SELECT rowid, snippet(file_search, 1, '', '', '...', 16) FROM file_search "
+                "WHERE file_search MATCH :match ORDER BY bm25(file_search, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        ).all()
+
+    def clear(self):
+        db.session.execute(text("DELETE FROM file_search"))
+
+
+class LikeSearchIndex:
+    # Matches every word of a search against file names and bodies kept in the database with LIKE, newest files
+    # first.  It keeps no index of its own, so it works on any database, but it scans the file table and doesn't
+    # see bodies kept in the blob store
+
+    name = "like"
+
+    def create(self):
+        pass
+
+    def add(self, files):
+        pass
+
+    def remove(self, file_ids):
+        pass
+
+    def search(self, query, offset, limit):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        statement = select(File.id, db.literal(None))
+        for term in terms:
+            pattern = f"%{term}%"
+            statement = statement.where(db.or_(File.name.ilike(pattern), File.text_content.ilike(pattern)))
+        return db.session.execute(statement.order_by(File.id.desc()).limit(limit).offset(offset)).all()
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {
+    "fts5": Fts5SearchIndex,
+    "like": LikeSearchIndex,
+}
+
+
+def search_index():
+    return current_app.extensions["search_index"]
+
+
+def index_file(file, content):
+    # Index a new or changed file in the current session.  The file must have been flushed
+    search_index().add([(file.id, file.name, content)])
+
+
+def index_files(files):
+    # Index many new files in the current session.  files is a list of (file id, name, body) tuples
+    search_index().add(files)
+
+
+def remove_files(file_ids):
+    # Remove deleted files from the index in the current session
+    search_index().remove(file_ids)
+
+
+def search_files(query, can_read, limit, offset=0):
+    # Returns (files, next_offset) for the first limit hits from offset on that the caller may read.  files is a
+    # list of (File, snippet) and next_offset is None when there are no more hits.  can_read is called with a
+    # list of file uuids and returns a list of booleans
+    index = search_index()
+    results = []
+    for page in range(MAX_CANDIDATE_PAGES):
+        hits = index.search(query, offset, CANDIDATE_PAGE_SIZE)
+        rows = {file.id: file for file in File.query.filter(File.id.in_([file_id for file_id, snippet in hits]))}
+        # Hits whose file has since been deleted by another process are skipped
+        candidates = [rows[file_id] for file_id, snippet in hits if file_id in rows]
+        readable = {file.id for file, allowed in zip(candidates, can_read([file.uuid for file in candidates])) if allowed}
+        for position, (file_id, snippet) in enumerate(hits, 1):
+            if file_id in readable:
+                results.append((rows[file_id], snippet))
+                if len(results) == limit:
+                    return results, offset + position
+        offset += len(hits)
+        if len(hits) < CANDIDATE_PAGE_SIZE:
+            return results, None
+    return results, offset
+
+
+def rebuild_search_index(batch_size=500):
+    # Index every file again.  Returns the number of files indexed
+    index = search_index()
+    index.clear()
+    count = 0
+    after = 0
+    while True:
+        files = File.query.filter(File.id > after).order_by(File.id).limit(batch_size).all()
+        if not files:
+            break
+        index.add([(file.id, file.name, file_content(file).read()) for file in files])
+        db.session.commit()
+        count += len(files)
+        after = files[-1].id
+    return count
+
+
+def init_app(app):
+    # Pick the search backend and create its index.  SQLite databases default to FTS5, falling back to LIKE if
+    # the SQLite library was built without it, and other databases to LIKE
+    with app.app_context():
+        backend = app.config["SEARCH_BACKEND"] or ("fts5" if db.engine.dialect.name == "sqlite" else "like")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown SEARCH_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
+        index = BACKENDS[backend]()
+        try:
+            index.create()
+        except OperationalError as e:
+            db.session.rollback()
+            logger.warning("Search backend %s unavailable, using like: %s", backend, e)
+            index = LikeSearchIndex()
+        app.extensions["search_index"] = index
+
+
+def register_commands(app):
+    @app.cli.command("rebuild-search-index")
+    def rebuild_search_index_command():
+        """Index the name and body of every file for search."""
+        count = rebuild_search_index()
+        click.echo(f"Indexed {count} files with the {search_index().name} backend")
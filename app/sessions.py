@@ -0,0 +1,349 @@
+from flask import session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from werkzeug.datastructures import CallbackDict
+from collections import OrderedDict
+from contextlib import closing
+import click
+import copy
+import json
+import os
+import re
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Sessions are kept on the server and the session cookie only holds an opaque, random session id, so requests
+# don't carry and re-verify a large signed cookie.  Session data is kept by a SessionStore, either one file per
+# session in a directory or a table in a local SQLite database, behind an in-process LRU cache of recently used
+# sessions.  Other processes share the store, so every load checks a cheap stamp of the stored session (the file's
+# stat, or the row's expiry time) and only serves the cached copy if the session is unchanged.  Saves only write
+# the keys the request changed over the stored session, so two workers saving the same session don't undo each
+# other's changes.  Only the keys the routes read are stored.  SESSION_BACKEND=cookie keeps Flask's signed cookie
+# sessions.
+
+# Session keys that are stored.  Keys starting with an underscore are kept too, since Flask and authlib use them
+# for the permanent flag and OAuth state
+SESSION_KEYS = ("user_id", "uuid", "name", "image", "pwd", "home_folder", "home_folder_name", "fga_written_at")
+
+# Session ids are 43 URL safe characters
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{43}")
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    # Session data kept on the server under sid.  expires is when the stored copy expires, or None for a new session
+
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.modified = False
+        self.accessed = False
+        # The id the session was stored under before regenerate() was called
+        self.previous_sid = None
+        # The data as it was loaded, to find the keys a request changed
+        self.loaded = copy.deepcopy(dict(initial or {}))
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def regenerate(self):
+        # Move the session to a new id
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class FileSessionStore:
+    # One JSON file per session, named by its id
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, sid):
+        return os.path.join(self.directory, sid[:2], sid)
+
+    def load(self, sid):
+        # Returns (payload, expires) for an unexpired session, otherwise None
+        try:
+            with open(self.path(sid), encoding="utf-8") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if stored["expires"] <= time.time():
+            self.delete(sid)
+            return None
+        return stored["data"], stored["expires"]
+
+    def stamp(self, sid):
+        # Returns a value that changes whenever the session is saved, or None if it doesn't exist.  Saves replace
+        # the file, so its inode changes
+        try:
+            stat = os.stat(self.path(sid))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def save(self, sid, payload, expires):
+        path = self.path(sid)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file and rename it so a session is never read partly written
+        fd, temporary = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"data": payload, "expires": expires}, f)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def delete(self, sid):
+        try:
+            os.unlink(self.path(sid))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        # Remove expired sessions.  Returns the number removed
+        removed = 0
+        now = time.time()
+        for directory, subdirectories, names in os.walk(self.directory):
+            for name in names:
+                if not SESSION_ID.fullmatch(name):
+                    continue
+                try:
+                    with open(os.path.join(directory, name), encoding="utf-8") as f:
+                        expired = json.load(f)["expires"] <= now
+                except (FileNotFoundError, ValueError):
+                    continue
+                if expired:
+                    self.delete(name)
+                    removed += 1
+        return removed
+
+
+class SqliteSessionStore:
+    # Sessions in a table of a local SQLite database.  A connection is opened per operation so the store can be
+    # used from any thread and survives forking
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS session (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, sid):
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT data, expires FROM session WHERE id = ? AND expires > ?", (sid, time.time())).fetchone()
+
+    def stamp(self, sid):
+        # Every save sets a new expiry time, so it identifies the saved version of a session
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT expires FROM session WHERE id = ?", (sid,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, sid, payload, expires):
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT INTO session (id, data, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+                (sid, payload, expires),
+            )
+
+    def delete(self, sid):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM session WHERE id = ?", (sid,))
+
+    def prune(self):
+        with closing(self._connect()) as connection, connection:
+            return connection.execute("DELETE FROM session WHERE expires <= ?", (time.time(),)).rowcount
+
+
+class CachedSessionStore:
+    # An LRU cache of recently used sessions in front of another store.  Writes go through to the store.  Other
+    # processes sharing the store may change or delete a session, so a cached session is only served while the
+    # store's stamp for it is unchanged, and is reloaded after ttl seconds regardless
+
+    def __init__(self, store, max_entries=10000, ttl=5):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        # The stamp is read before the session, so a save in between makes the cached stamp stale rather than
+        # the cached data
+        stamp = self.store.stamp(sid)
+        with self._lock:
+            entry = self._entries.get(sid)
+            if stamp is None:
+                self._entries.pop(sid, None)
+                return None
+            if entry is not None and entry[3] == stamp and entry[2] > time.monotonic() and entry[1] > time.time():
+                self._entries.move_to_end(sid)
+                return entry[0], entry[1]
+        stored = self.store.load(sid)
+        if stored is None:
+            with self._lock:
+                self._entries.pop(sid, None)
+            return None
+        self._remember(sid, *stored, stamp)
+        return stored
+
+    def save(self, sid, payload, expires):
+        self.store.save(sid, payload, expires)
+        self._remember(sid, payload, expires, self.store.stamp(sid))
+
+    def delete(self, sid):
+        self.store.delete(sid)
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def prune(self):
+        return self.store.prune()
+
+    def _remember(self, sid, payload, expires, stamp):
+        if self.max_entries <= 0 or self.ttl <= 0 or stamp is None:
+            return
+        with self._lock:
+            self._entries[sid] = (payload, expires, time.monotonic() + self.ttl, stamp)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SESSION_ID.fullmatch(sid):
+            stored = self.store.load(sid)
+            if stored is not None:
+                payload, expires = stored
+                return ServerSession(self.serializer.loads(payload), sid, expires=expires)
+        return ServerSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            # An emptied session, e.g. after logout, is removed along with its cookie.  Empty new sessions are
+            # never stored
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # Unchanged sessions are only written again once half their lifetime has passed, to extend it
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        if not session.modified and session.expires is not None and session.expires - now > lifetime / 2:
+            return
+
+        data = {key: value for key, value in session.items() if key in SESSION_KEYS or key.startswith("_")}
+        if not session.new and session.previous_sid is None:
+            data = self._merge(session, data)
+        self.store.save(session.sid, self.serializer.dumps(data), now + lifetime)
+        if session.new or session.modified or session.permanent:
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+    def _merge(self, session, data):
+        # Apply the keys this request changed or removed to the session as it is stored now, which another
+        # worker may have saved since this request loaded it
+        stored = self.store.load(session.sid)
+        if stored is None:
+            return data
+        merged = self.serializer.loads(stored[0])
+        for key in session.loaded:
+            if key not in data:
+                merged.pop(key, None)
+        for key, value in data.items():
+            if session.loaded.get(key, object()) != value:
+                merged[key] = value
+        return {key: value for key, value in merged.items() if key in SESSION_KEYS or key.startswith("_")}
+
+
+def session_store(app):
+    # Returns the SessionStore configured by SESSION_BACKEND, or None for cookie sessions
+    backend = app.config["SESSION_BACKEND"]
+    if backend == "cookie":
+        return None
+    if backend == "filesystem":
+        store = FileSessionStore(app.config["SESSION_PATH"] or os.path.join(app.instance_path, "sessions"))
+    elif backend == "sqlite":
+        store = SqliteSessionStore(app.config["SESSION_PATH"] or os.path.join(app.instance_path, "sessions.sqlite3"))
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND {backend!r}, expected filesystem, sqlite or cookie")
+    return CachedSessionStore(store, app.config["SESSION_CACHE_SIZE"], app.config["SESSION_CACHE_TTL"])
+
+
+def init_app(app):
+    store = session_store(app)
+    app.session_interface = SecureCookieSessionInterface() if store is None else ServerSessionInterface(store)
+
+
+def regenerate_session():
+    # Give the current session a new id.  Called at login so a session id handed out before the user
+    # authenticated can't be used to take over their session.  Cookie sessions have no id
+    if isinstance(session._get_current_object(), ServerSession):
+        session.regenerate()
+
+
+def register_commands(app):
+    @app.cli.command("prune-sessions")
+    def prune_sessions_command():
+        """Remove expired server-side sessions."""
+        if not isinstance(app.session_interface, ServerSessionInterface):
+            raise click.ClickException("SESSION_BACKEND is cookie")
+        click.echo(f"Removed {app.session_interface.store.prune()} expired sessions")
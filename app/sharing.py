@@ -0,0 +1,138 @@
+from app import db
+from app.models import Folder, UserGroup, FolderShare, SharedFolder
+from app.queries import folders_by_uuid, groups_by_uuid, users_by_uuid
+from sqlalchemy import and_, delete, exists, insert, literal, select
+import click
+import uuid
+
+# The "shared with me" sidebar is served from the shared_folder table instead of asking OpenFGA to list every
+# folder the user can view.  FolderShare records each grant made by share_folder, and SharedFolder materializes
+# those grants per user, including grants made to groups the user belongs to.  Both are kept up to date when
+# folders are shared and when users join groups.
+
+# Folder relations granted by share_folder
+SHARE_RELATIONS = ("viewer", "can_create_file")
+
+
+def record_folder_share(folder, subject_type, subject_id, relation):
+    # Record a share of folder with a user or group in the current session and add it to the shared index of
+    # every user it grants access to.  Returns the FolderShare, which may already have existed
+    share = FolderShare.query.filter_by(
+        folder_id=folder.id, subject_type=subject_type, subject_id=subject_id, relation=relation
+    ).first()
+    if share is not None:
+        return share
+
+    share = FolderShare(folder_id=folder.id, subject_type=subject_type, subject_id=subject_id, relation=relation)
+    db.session.add(share)
+    db.session.flush()
+
+    if subject_type == "user":
+        db.session.add(SharedFolder(user_id=subject_id, folder_id=folder.id, share_id=share.id))
+    else:
+        members = select(UserGroup.user_id, literal(folder.id), literal(share.id)).where(UserGroup.group_id == subject_id)
+        db.session.execute(insert(SharedFolder).from_select(["user_id", "folder_id", "share_id"], members))
+    return share
+
+
+def record_folder_shares(folder, grants):
+    # Bulk counterpart of record_folder_share.  grants is a list of (subject_type, subject_id, relation) tuples.
+    # Existing shares are found with one query, and the new shares and their shared index rows are added with a
+    # few bulk inserts however many grants there are.  Returns the FolderShares that were added
+    existing = {
+        (share.subject_type, share.subject_id, share.relation)
+        for share in FolderShare.query.filter_by(folder_id=folder.id)
+    }
+    shares = [
+        FolderShare(folder_id=folder.id, subject_type=subject_type, subject_id=subject_id, relation=relation)
+        for subject_type, subject_id, relation in dict.fromkeys(grants)
+        if (subject_type, subject_id, relation) not in existing
+    ]
+    if not shares:
+        return []
+    db.session.add_all(shares)
+    db.session.flush()
+
+    user_rows = [
+        {"user_id": share.subject_id, "folder_id": folder.id, "share_id": share.id}
+        for share in shares if share.subject_type == "user"
+    ]
+    if user_rows:
+        db.session.execute(insert(SharedFolder), user_rows)
+
+    group_share_ids = [share.id for share in shares if share.subject_type == "group"]
+    if group_share_ids:
+        members = (
+            select(UserGroup.user_id, literal(folder.id), FolderShare.id)
+            .join(FolderShare, and_(FolderShare.subject_type == "group", FolderShare.subject_id == UserGroup.group_id))
+            .where(FolderShare.id.in_(group_share_ids))
+        )
+        db.session.execute(insert(SharedFolder).from_select(["user_id", "folder_id", "share_id"], members))
+    return shares
+
+
+def add_group_member_shares(user_id, group_id):
+    # Add every folder shared with a group to the shared index of a user who has just joined it
+    group_shares = (
+        select(literal(user_id), FolderShare.folder_id, FolderShare.id)
+        .where(FolderShare.subject_type == "group", FolderShare.subject_id == group_id)
+        .where(~exists().where(and_(SharedFolder.user_id == user_id, SharedFolder.share_id == FolderShare.id)))
+    )
+    db.session.execute(insert(SharedFolder).from_select(["user_id", "folder_id", "share_id"], group_shares))
+
+
+def shared_folders(user_id):
+    # Returns the folders shared with a user, excluding folders the user created
+    return (
+        Folder.query
+        .filter(Folder.id.in_(select(SharedFolder.folder_id).where(SharedFolder.user_id == user_id)))
+        .filter(Folder.creator != user_id)
+        .order_by(Folder.name)
+        .all()
+    )
+
+
+def rebuild_shared_index(tuples):
+    # Rebuild FolderShare and SharedFolder from the folder tuples stored in OpenFGA.  tuples is an iterable of
+    # (user, relation, object) strings.  Public shares (user:*) are not indexed.
+    db.session.execute(delete(SharedFolder))
+    db.session.execute(delete(FolderShare))
+
+    grants = set()
+    for user, relation, object in tuples:
+        if not object.startswith("folder:") or relation not in SHARE_RELATIONS:
+            continue
+        if user.startswith("user:") and user != "user:*":
+            grants.add(("user", uuid.UUID(user[5:]), relation, uuid.UUID(object[7:])))
+        elif user.startswith("group:") and user.endswith("#member"):
+            grants.add(("group", uuid.UUID(user[6:-7]), relation, uuid.UUID(object[7:])))
+
+    folders = folders_by_uuid(grant[3] for grant in grants)
+    subjects = {
+        "user": users_by_uuid(grant[1] for grant in grants if grant[0] == "user"),
+        "group": groups_by_uuid(grant[1] for grant in grants if grant[0] == "group"),
+    }
+
+    count = 0
+    for subject_type, subject_uuid, relation, folder_uuid in sorted(grants, key=str):
+        subject = subjects[subject_type].get(subject_uuid)
+        folder = folders.get(folder_uuid)
+        if subject is None or folder is None:
+            continue
+        subject_id = subject.id
+        # Owners' grants on their own folders are not shares
+        if subject_type == "user" and folder.creator == subject_id:
+            continue
+        record_folder_share(folder, subject_type, subject_id, relation)
+        count += 1
+    db.session.commit()
+    return count
+
+
+def register_commands(app):
+    @app.cli.command("rebuild-shared-index")
+    def rebuild_shared_index_command():
+        """Rebuild the shared folder index from the tuples stored in OpenFGA."""
+        from app.routes import fga_read_tuples
+        count = rebuild_shared_index(fga_read_tuples())
+        click.echo(f"Indexed {count} folder shares")
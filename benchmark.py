@@ -0,0 +1,455 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import fga_local
+
+# A reproducible benchmark of the app's hot routes.  It seeds a database with a synthetic dataset of a configurable
+# shape (users, folder tree depth and fan-out, files per folder, groups, group size and share density), writes the
+# matching tuples to OpenFGA, then drives the real Flask routes through the test client and reports latency
+# percentiles and the number of OpenFGA calls and SQL statements each request made.  The same --seed always builds
+# the same dataset and request sequence, and the results are saved as JSON so runs on different commits can be
+# compared:
+#
+#   python benchmark.py --users 10000 --depth 1 --output before.json
+#   python benchmark.py --users 10000 --depth 1 --baseline before.json
+#
+# By default the database is a temporary SQLite file and OpenFGA is the in-process stand-in from fga_local.py,
+# with --latency-ms of latency injected into every call.  Use --database and --fga-url to benchmark against real
+# servers; both must be empty, and --fga-url uses the FGA_STORE_ID and FGA_MODEL_ID environment variables.
+
+ROUTES = ("home", "list_directory", "load_file", "get_group", "groups", "user_autocomplete", "group_autocomplete")
+
+# Group names start with one of these words so group autocomplete prefixes match several groups
+GROUP_WORDS = ("engineering", "design", "marketing", "sales", "support", "finance", "research", "operations")
+
+# Version of the results format
+RESULTS_VERSION = 1
+
+
+class Dataset:
+    # The rows and tuples of a synthetic dataset, plus the lookups used to pick realistic requests
+
+    def __init__(self):
+        self.users = []
+        self.folders = []
+        self.files = []
+        self.groups = []
+        self.memberships = []
+        self.tuples = []
+        self.shares = 0
+        # user id -> folder uuids and file uuids the user owns, and group uuids the user is a member of
+        self.user_folders = {}
+        self.user_files = {}
+        self.user_groups = {}
+
+    def counts(self):
+        return {
+            "users": len(self.users),
+            "folders": len(self.folders),
+            "files": len(self.files),
+            "groups": len(self.groups),
+            "memberships": len(self.memberships),
+            "shares": self.shares,
+            "tuples": len(self.tuples),
+        }
+
+
+def random_uuid(rng):
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def build_dataset(args, rng):
+    # Generate the rows each model would have if the users had built the dataset through the app, and the tuples
+    # the app would have written for them
+    data = Dataset()
+    epoch = datetime.datetime(2024, 1, 1)
+    ticks = iter(range(10 ** 9))
+
+    def timestamp():
+        return epoch + datetime.timedelta(seconds=next(ticks))
+
+    content = ("Lorem ipsum dolor sit amet. " * (args.file_size // 28 + 1))[:args.file_size]
+    shareable = []
+
+    for user_id in range(1, args.users + 1):
+        user_uuid = random_uuid(rng)
+        name = f"User {user_id}"
+        data.users.append({"id": user_id, "uuid": user_uuid, "email": f"user{user_id:06}@example.com", "name": name, "image": "", "created": timestamp()})
+        data.user_folders[user_id] = []
+        data.user_files[user_id] = []
+        data.user_groups[user_id] = []
+
+        # The user's default folder is the root of a tree depth levels deep with fan_out subfolders per folder
+        level = [None]
+        for depth in range(args.depth + 1):
+            next_level = []
+            for parent in level:
+                for index in range(1 if parent is None else args.fan_out):
+                    folder_id = len(data.folders) + 1
+                    folder_uuid = random_uuid(rng)
+                    created = timestamp()
+                    data.folders.append({
+                        "id": folder_id,
+                        "uuid": folder_uuid,
+                        "creator": user_id,
+                        "name": f"{name}'s Folder" if parent is None else f"Folder {depth}.{index}",
+                        "default_folder": parent is None,
+                        "parent": parent,
+                        "created": created,
+                        "updated": created,
+                    })
+                    data.user_folders[user_id].append(folder_uuid)
+                    data.tuples.append((f"user:{user_uuid}", "owner", f"folder:{folder_uuid}"))
+                    if parent is not None:
+                        data.tuples.append((f"folder:{parent}", "parent", f"folder:{folder_uuid}"))
+                        shareable.append((user_id, folder_uuid))
+
+                    for number in range(args.files):
+                        file_uuid = random_uuid(rng)
+                        created = timestamp()
+                        data.files.append({
+                            "id": len(data.files) + 1,
+                            "uuid": file_uuid,
+                            "folder": folder_uuid,
+                            "name": f"file-{number}.txt",
+                            "text_content": content,
+                            "creator": user_id,
+                            "created": created,
+                            "updated": created,
+                        })
+                        data.user_files[user_id].append(file_uuid)
+                        data.tuples.append((f"user:{user_uuid}", "owner", f"file:{file_uuid}"))
+                        data.tuples.append((f"folder:{folder_uuid}", "parent", f"file:{file_uuid}"))
+                    next_level.append(folder_uuid)
+            level = next_level
+
+    users = {user["id"]: user for user in data.users}
+    for index in range(args.groups):
+        group_id = index + 1
+        group_uuid = random_uuid(rng)
+        members = rng.sample(range(1, args.users + 1), min(args.group_size, args.users))
+        data.groups.append({"id": group_id, "uuid": group_uuid, "name": f"{rng.choice(GROUP_WORDS)} {index}", "creator": members[0]})
+        for position, user_id in enumerate(members):
+            user = f"user:{users[user_id]['uuid']}"
+            data.memberships.append({"user_id": user_id, "group_id": group_id})
+            data.user_groups[user_id].append(group_uuid)
+            data.tuples.append((user, "member", f"group:{group_uuid}"))
+            if position == 0:
+                data.tuples.append((user, "owner", f"group:{group_uuid}"))
+            elif position == 1:
+                data.tuples.append((user, "admin", f"group:{group_uuid}"))
+
+    # Share a share_density fraction of the folders below the default folders with a group or another user
+    for creator, folder_uuid in shareable:
+        if rng.random() >= args.share_density:
+            continue
+        relation = "can_create_file" if rng.random() < 0.25 else "viewer"
+        if data.groups and rng.random() < 0.5:
+            subject = f"group:{rng.choice(data.groups)['uuid']}#member"
+        else:
+            user_id = rng.randint(1, args.users)
+            if user_id == creator:
+                continue
+            subject = f"user:{users[user_id]['uuid']}"
+        data.tuples.append((subject, relation, f"folder:{folder_uuid}"))
+        data.shares += 1
+
+    return data
+
+
+def seed_database(app, data):
+    from sqlalchemy import insert
+    from app import db
+    from app.models import User, Group, UserGroup, Folder, File
+    from app.autocomplete import rebuild_autocomplete_index
+    from app.sharing import rebuild_shared_index
+
+    with app.app_context():
+        if db.session.query(User.id).first() is not None:
+            sys.exit("The benchmark database must be empty")
+        for model, rows in ((User, data.users), (Group, data.groups), (UserGroup, data.memberships), (Folder, data.folders), (File, data.files)):
+            for start in range(0, len(rows), 1000):
+                db.session.execute(insert(model), rows[start:start + 1000])
+        db.session.commit()
+        rebuild_shared_index(data.tuples)
+        rebuild_autocomplete_index()
+
+
+def seed_tuples(data, server):
+    # Write the dataset's tuples straight into the local stand-in's store, or to OpenFGA 100 at a time
+    if server is not None:
+        server.store.write(writes=[{"user": user, "relation": relation, "object": object} for user, relation, object in data.tuples])
+        return
+
+    from app.routes import fga_write_tuples
+    for start in range(0, len(data.tuples), 100):
+        fga_write_tuples(data.tuples[start:start + 100], [])
+
+
+class Driver:
+    # Picks requests for each benchmarked route and sends them through the Flask test client, recording the
+    # latency, OpenFGA calls and SQL statements of each
+
+    def __init__(self, app, data, rng):
+        from flask import g
+
+        self.app = app
+        self.data = data
+        self.rng = rng
+        self.client = app.test_client()
+        self.users = {user["id"]: user for user in data.users}
+        self.group_members = [membership["user_id"] for membership in data.memberships]
+        self._timings = []
+
+        @app.teardown_request
+        def capture_timings(error=None):
+            # Teardown functions run in the reverse of the order they were registered, so this sees the request's
+            # timings before app.metrics records and removes them
+            timings = g.get("request_timings")
+            if timings is not None:
+                self._timings.append(timings)
+
+    def login(self, user_id):
+        user = self.users[user_id]
+        folders = self.data.user_folders[user_id]
+        with self.client.session_transaction() as session:
+            session.clear()
+            session["user_id"] = user_id
+            session["uuid"] = user["uuid"]
+            session["name"] = user["name"]
+            session["image"] = user["image"]
+            session["home_folder"] = folders[0]
+            session["home_folder_name"] = f"{user['name']}'s Folder"
+            session["pwd"] = self.rng.choice(folders)
+
+    def pick(self, route):
+        # Returns (user id, method, path, form data) for a request to route
+        rng = self.rng
+        user_id = rng.choice(self.group_members) if route == "get_group" and self.group_members else rng.randint(1, len(self.users))
+        if route == "home":
+            return user_id, "GET", "/", None
+        if route == "list_directory":
+            return user_id, "GET", f"/api/list/{rng.choice(self.data.user_folders[user_id])}", None
+        if route == "load_file":
+            files = self.data.user_files[user_id]
+            return user_id, "GET", f"/api/load_file/{rng.choice(files) if files else uuid.uuid4()}", None
+        if route == "get_group":
+            groups = self.data.user_groups[user_id]
+            return user_id, "GET", f"/api/group/{rng.choice(groups) if groups else uuid.uuid4()}", None
+        if route == "groups":
+            return user_id, "GET", "/groups", None
+        if route == "user_autocomplete":
+            email = self.users[rng.randint(1, len(self.users))]["email"]
+            return user_id, "POST", "/api/user_autocomplete", {"partial": email[:rng.randint(1, 10)]}
+        if route == "group_autocomplete":
+            name = rng.choice(self.data.groups)["name"] if self.data.groups else "group"
+            return user_id, "POST", "/api/group_autocomplete", {"partial": name[:rng.randint(1, 6)]}
+        raise ValueError(f"unknown route {route}")
+
+    def request(self, route):
+        # Send one request and return (latency in seconds, status, FGA calls, SQL statements)
+        user_id, method, path, form = self.pick(route)
+        self.login(user_id)
+        self._timings.clear()
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, data=form)
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+        timings = self._timings[-1] if self._timings else None
+        return (
+            elapsed,
+            response.status_code,
+            timings.fga_calls if timings else 0,
+            timings.db_queries if timings else 0,
+        )
+
+
+def percentile(values, p):
+    # Nearest rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values, scale=1, digits=3):
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values) * scale, digits),
+        "p50": round(percentile(values, 50) * scale, digits),
+        "p90": round(percentile(values, 90) * scale, digits),
+        "p99": round(percentile(values, 99) * scale, digits),
+        "max": round(max(values) * scale, digits),
+    }
+
+
+def run_route(driver, route, requests, warmup):
+    for _ in range(warmup):
+        driver.request(route)
+
+    latencies, fga_calls, queries, statuses = [], [], [], {}
+    for _ in range(requests):
+        elapsed, status, calls, statements = driver.request(route)
+        latencies.append(elapsed)
+        fga_calls.append(calls)
+        queries.append(statements)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": requests,
+        "statuses": statuses,
+        "latency_ms": summarize(latencies, scale=1000),
+        "fga_calls": summarize(fga_calls, digits=2),
+        "sql_statements": summarize(queries, digits=2),
+    }
+
+
+def git_revision():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def print_results(results, baseline=None):
+    baseline_routes = (baseline or {}).get("routes", {})
+    print(f"{'route':<20} {'p50 ms':>9} {'p99 ms':>9} {'fga/req':>8} {'sql/req':>8}  statuses")
+    for route, result in results["routes"].items():
+        print(
+            f"{route:<20} {result['latency_ms']['p50']:>9.2f} {result['latency_ms']['p99']:>9.2f} "
+            f"{result['fga_calls']['mean']:>8.2f} {result['sql_statements']['mean']:>8.2f}  "
+            + " ".join(f"{status}x{count}" for status, count in sorted(result["statuses"].items()))
+        )
+        previous = baseline_routes.get(route)
+        if previous:
+            print(
+                f"{'  vs baseline':<20} {change(previous['latency_ms']['p50'], result['latency_ms']['p50']):>9} "
+                f"{change(previous['latency_ms']['p99'], result['latency_ms']['p99']):>9} "
+                f"{change(previous['fga_calls']['mean'], result['fga_calls']['mean']):>8} "
+                f"{change(previous['sql_statements']['mean'], result['sql_statements']['mean']):>8}"
+            )
+
+
+def change(old, new):
+    if old == new:
+        return "="
+    if not old:
+        return "new"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a synthetic dataset and benchmark the app's routes")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=2, help="levels of folders below each user's default folder")
+    parser.add_argument("--fan-out", type=int, default=3, help="subfolders in each folder")
+    parser.add_argument("--files", type=int, default=5, help="files in each folder")
+    parser.add_argument("--file-size", type=int, default=1024, help="size of each file body in bytes")
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--group-size", type=int, default=50, help="members in each group")
+    parser.add_argument("--share-density", type=float, default=0.1, help="fraction of folders shared with a group or user")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per route sent first")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"comma separated routes to benchmark, from {', '.join(ROUTES)}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="latency the local OpenFGA stand-in adds to every call")
+    parser.add_argument("--no-cache", action="store_true", help="turn off the FGA decision and autocomplete caches")
+    parser.add_argument("--database", help="SQLAlchemy URI of an empty database to use instead of a temporary SQLite file")
+    parser.add_argument("--fga-url", help="URL of an OpenFGA server with an empty store to use instead of the local stand-in")
+    parser.add_argument("--output", help="file to save the results to, by default benchmark-results/<date>-<commit>.json")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        if args.fga_url:
+            os.environ["FGA_API_URL"] = args.fga_url
+        else:
+            model = fga_local.AuthorizationModel.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model.fga"))
+            server = fga_local.LocalFGAServer(("127.0.0.1", 0), model, args.latency_ms / 1000)
+            server.start()
+            os.environ.update(FGA_API_URL=server.url, FGA_STORE_ID=fga_local.LOCAL_STORE_ID, FGA_MODEL_ID=fga_local.LOCAL_MODEL_ID)
+
+        # The app reads its configuration from the environment when it is imported
+        os.environ["SQLALCHEMY_DATABASE_URI"] = args.database or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        os.environ["FGA_OUTBOX_WORKER"] = "false"
+        os.environ["FILE_BLOB_DIR"] = ""
+        os.environ["SESSION_PATH"] = os.path.join(directory, "sessions")
+        os.environ.setdefault("APP_SECRET_KEY", "benchmark")
+        os.environ.setdefault("AUTH0_DOMAIN", "localhost")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        if args.no_cache:
+            os.environ["FGA_CACHE_SIZE"] = "0"
+            os.environ["AUTOCOMPLETE_CACHE_SIZE"] = "0"
+
+        from app import create_app, db
+
+        rng = random.Random(args.seed)
+        app = create_app()
+
+        start = time.perf_counter()
+        data = build_dataset(args, rng)
+        seed_database(app, data)
+        seed_tuples(data, server)
+        seed_seconds = time.perf_counter() - start
+        print(f"Seeded {', '.join(f'{count} {name}' for name, count in data.counts().items())} in {seed_seconds:.1f}s")
+
+        driver = Driver(app, data, random.Random(args.seed))
+        commit, dirty = git_revision()
+        with app.app_context():
+            dialect = db.engine.dialect.name
+        results = {
+            "version": RESULTS_VERSION,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": commit,
+            "dirty": dirty,
+            "python": platform.python_version(),
+            "database": dialect,
+            "fga": "local" if server is not None else args.fga_url,
+            "shape": {
+                name: getattr(args, name)
+                for name in ("users", "depth", "fan_out", "files", "file_size", "groups", "group_size", "share_density",
+                             "requests", "warmup", "seed", "latency_ms", "no_cache")
+            },
+            "dataset": data.counts(),
+            "seed_seconds": round(seed_seconds, 3),
+            "routes": {},
+        }
+        for route in routes:
+            results["routes"][route] = run_route(driver, route, args.requests, args.warmup)
+
+        with app.app_context():
+            db.engine.dispose()
+
+    output = args.output or os.path.join("benchmark-results", f"{datetime.date.today().isoformat()}-{(commit or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
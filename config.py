@@ -3,4 +3,45 @@ import os
 class Config:
     SECRET_KEY = os.getenv("APP_SECRET_KEY")
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
-    SQLALCHEMY_TRACK_MODIFICATIONS= False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS= False
+
+    # Where sessions are kept: "filesystem" or "sqlite" keep them on the server under SESSION_PATH, which defaults
+    # to the instance folder, and "cookie" keeps them in Flask's signed cookie
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'filesystem').lower()
+    SESSION_PATH = os.getenv('SESSION_PATH', '')
+    # Recently used server-side sessions are cached in process for up to SESSION_CACHE_TTL seconds
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+    SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 5))
+
+    # Build the OpenFGA clients when the app is created instead of on the first request that needs them
+    FGA_EAGER_INIT = os.getenv('FGA_EAGER_INIT', 'true').lower() == 'true'
+    # Leave connecting to OpenFGA and starting the outbox worker to each forked worker rather than create_app().
+    # Set by gunicorn.conf.py when the app is preloaded
+    FGA_START_AFTER_FORK = os.getenv('FGA_START_AFTER_FORK', 'false').lower() == 'true'
+
+    # Log level of the app's loggers, e.g. DEBUG to log every permission check
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    # Serve Prometheus metrics at /metrics, and time each request in a Server-Timing response header.  Both expose
+    # traffic and timing details, so they are off unless turned on.  When METRICS_TOKEN is set /metrics also
+    # requires an "Authorization: Bearer <token>" header
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() == 'true'
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+    SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+
+    # File bodies are stored in this directory, named by their SHA-256, instead of in the database when it is set
+    FILE_BLOB_DIR = os.getenv('FILE_BLOB_DIR', '')
+    # File bodies larger than this many bytes are streamed to the client
+    FILE_STREAM_THRESHOLD = int(os.getenv('FILE_STREAM_THRESHOLD', 1024 * 1024))
+    # File search backend, "fts5" or "like".  By default SQLite databases use fts5 and others like
+    SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', '').lower()
+
+    # Requests with larger bodies, e.g. archive uploads to /api/import, are refused with a 413
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
+
+    # Tuple outbox worker settings
+    FGA_OUTBOX_WORKER = os.getenv('FGA_OUTBOX_WORKER', 'true').lower() == 'true'
+    FGA_OUTBOX_POLL_INTERVAL = float(os.getenv('FGA_OUTBOX_POLL_INTERVAL', 1.0))
+    FGA_OUTBOX_BATCH_SIZE = int(os.getenv('FGA_OUTBOX_BATCH_SIZE', 100))
+    FGA_OUTBOX_MAX_ATTEMPTS = int(os.getenv('FGA_OUTBOX_MAX_ATTEMPTS', 10))
+    FGA_OUTBOX_BASE_BACKOFF = float(os.getenv('FGA_OUTBOX_BASE_BACKOFF', 1.0))
+    FGA_OUTBOX_MAX_BACKOFF = float(os.getenv('FGA_OUTBOX_MAX_BACKOFF', 300))
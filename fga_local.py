@@ -0,0 +1,478 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A self-contained stand-in for an OpenFGA server, intended for local load testing, profiling and benchmarks.
+# It parses model.fga, keeps tuples in indexed in-memory structures and serves the subset of the OpenFGA HTTP
+# API used by this app (write, check, batch-check, list-objects, list-users, read and read-authorization-models).
+# A fixed latency can be injected into every call so the cost of the app's FGA call patterns can be measured
+# deterministically without a network.
+#
+# Run it with:
+#
+#   python fga_local.py --port 8080 --latency-ms 5
+#
+# and point the app at it with FGA_API_URL=http://localhost:8080, FGA_STORE_ID=LOCAL_STORE_ID and
+# FGA_MODEL_ID=LOCAL_MODEL_ID using the values below.
+
+# The SDK requires store and model ids to be well formed ULIDs.  The stand-in accepts any store id.
+LOCAL_STORE_ID = "01HVMMBCMGZNT3SED4Z17ECXCA"
+LOCAL_MODEL_ID = "01HVMMBCMGZNT3SED4Z17ECXCB"
+
+
+class ModelError(Exception):
+    pass
+
+
+class FGAError(Exception):
+    # Raised for requests OpenFGA would reject.  Rendered as a 400 validation error.
+    def __init__(self, message, code="validation_error"):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+class AuthorizationModel:
+    # A parsed OpenFGA DSL model.  Each relation is stored as a list of terms joined with "or", where a term is
+    # one of ("direct", [allowed subject types]), ("computed", relation) or ("ttu", tupleset, relation).
+    # Only union ("or") is supported, which is all model.fga uses.
+
+    def __init__(self, types):
+        self.types = types
+
+    @classmethod
+    def parse(cls, text):
+        types = {}
+        current = None
+        for line_number, raw_line in enumerate(text.splitlines(), 1):
+            line = raw_line.strip()
+            if not line or line.startswith("#") or line in ("model", "relations") or line.startswith("schema "):
+                continue
+            if line.startswith("type "):
+                current = line[5:].strip()
+                types[current] = {}
+            elif line.startswith("define "):
+                if current is None:
+                    raise ModelError(f"line {line_number}: relation defined outside of a type")
+                name, _, expression = line[7:].partition(":")
+                types[current][name.strip()] = cls._parse_expression(expression.strip(), line_number)
+            else:
+                raise ModelError(f"line {line_number}: unable to parse '{line}'")
+        return cls(types)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as model_file:
+            return cls.parse(model_file.read())
+
+    @staticmethod
+    def _parse_expression(expression, line_number):
+        if re.search(r"\s(and|but not)\s", expression):
+            raise ModelError(f"line {line_number}: only 'or' is supported by the local stand-in")
+        terms = []
+        for term in re.split(r"\s+or\s+", expression):
+            term = term.strip()
+            if term.startswith("["):
+                allowed = [subject.strip() for subject in term.strip("[]").split(",") if subject.strip()]
+                terms.append(("direct", allowed))
+            elif " from " in term:
+                relation, _, tupleset = term.partition(" from ")
+                terms.append(("ttu", tupleset.strip(), relation.strip()))
+            else:
+                terms.append(("computed", term))
+        return terms
+
+    def relation(self, object_type, relation):
+        return self.types.get(object_type, {}).get(relation)
+
+    def allows_direct(self, object_type, relation, user):
+        # Whether a tuple with this user may be written directly against object_type#relation
+        terms = self.relation(object_type, relation)
+        if terms is None:
+            return False
+        user_type, user_id, user_relation = split_user(user)
+        for term in terms:
+            if term[0] != "direct":
+                continue
+            for allowed in term[1]:
+                if allowed == f"{user_type}:*" and user_id == "*":
+                    return True
+                if user_relation is not None and allowed == f"{user_type}#{user_relation}":
+                    return True
+                if user_relation is None and user_id != "*" and allowed == user_type:
+                    return True
+        return False
+
+    def to_json(self):
+        # The authorization model in the JSON shape returned by the OpenFGA API
+        type_definitions = []
+        for object_type, relations in self.types.items():
+            definition = {"type": object_type, "relations": {}, "metadata": None}
+            if relations:
+                metadata = {}
+                for name, terms in relations.items():
+                    children = []
+                    directly_related = []
+                    for term in terms:
+                        if term[0] == "direct":
+                            children.append({"this": {}})
+                            for allowed in term[1]:
+                                if allowed.endswith(":*"):
+                                    directly_related.append({"type": allowed[:-2], "wildcard": {}})
+                                elif "#" in allowed:
+                                    subject_type, subject_relation = allowed.split("#")
+                                    directly_related.append({"type": subject_type, "relation": subject_relation})
+                                else:
+                                    directly_related.append({"type": allowed})
+                        elif term[0] == "computed":
+                            children.append({"computedUserset": {"relation": term[1]}})
+                        else:
+                            children.append({
+                                "tupleToUserset": {
+                                    "tupleset": {"relation": term[1]},
+                                    "computedUserset": {"relation": term[2]},
+                                }
+                            })
+                    definition["relations"][name] = children[0] if len(children) == 1 else {"union": {"child": children}}
+                    metadata[name] = {"directly_related_user_types": directly_related}
+                definition["metadata"] = {"relations": metadata}
+            type_definitions.append(definition)
+        return {"id": LOCAL_MODEL_ID, "schema_version": "1.1", "type_definitions": type_definitions}
+
+
+def split_user(user):
+    # Split "type:id" or "type:id#relation" into its parts
+    object_part, _, relation = user.partition("#")
+    user_type, _, user_id = object_part.partition(":")
+    return user_type, user_id, relation or None
+
+
+class TupleStore:
+    # Tuples are indexed by (object, relation) for check and by object type for list objects
+
+    def __init__(self, model):
+        self.model = model
+        self._users = {}
+        self._objects_by_type = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(users) for users in self._users.values())
+
+    def write(self, writes=(), deletes=(), on_duplicate="error", on_missing="error"):
+        # Apply a write request atomically, as OpenFGA does
+        with self._lock:
+            for key in deletes:
+                if key["user"] not in self._users.get((key["object"], key["relation"]), ()) and on_missing != "ignore":
+                    raise FGAError(f"cannot delete a tuple which does not exist: {format_key(key)}", "write_failed_due_to_invalid_input")
+            for key in writes:
+                self._validate(key)
+                if key["user"] in self._users.get((key["object"], key["relation"]), ()) and on_duplicate != "ignore":
+                    raise FGAError(f"cannot write a tuple which already exists: {format_key(key)}", "write_failed_due_to_invalid_input")
+
+            for key in deletes:
+                users = self._users.get((key["object"], key["relation"]))
+                if users is not None:
+                    users.discard(key["user"])
+                    if not users:
+                        del self._users[(key["object"], key["relation"])]
+            for key in writes:
+                self._users.setdefault((key["object"], key["relation"]), set()).add(key["user"])
+                object_type = key["object"].split(":", 1)[0]
+                self._objects_by_type.setdefault(object_type, set()).add(key["object"])
+
+    def _validate(self, key):
+        object_type = key["object"].split(":", 1)[0]
+        if self.model.relation(object_type, key["relation"]) is None:
+            raise FGAError(f"relation '{object_type}#{key['relation']}' not found")
+        if not self.model.allows_direct(object_type, key["relation"], key["user"]):
+            raise FGAError(f"type '{key['user']}' is not an allowed type restriction for '{object_type}#{key['relation']}'")
+
+    def check(self, user, relation, object, memo=None):
+        with self._lock:
+            return self._check(user, relation, object, {} if memo is None else memo)
+
+    def _check(self, user, relation, object, memo):
+        key = (user, relation, object)
+        if key in memo:
+            return memo[key]
+        # Mark the check as in progress so cycles in the graph resolve to False instead of recursing forever
+        memo[key] = False
+
+        object_type = object.split(":", 1)[0]
+        terms = self.model.relation(object_type, relation)
+        if terms is None:
+            raise FGAError(f"relation '{object_type}#{relation}' not found")
+
+        user_type = user.split(":", 1)[0]
+        allowed = False
+        for term in terms:
+            if term[0] == "direct":
+                for subject in self._users.get((object, relation), ()):
+                    if subject == user or subject == f"{user_type}:*":
+                        allowed = True
+                    elif "#" in subject:
+                        subject_object, subject_relation = subject.split("#", 1)
+                        allowed = self._check(user, subject_relation, subject_object, memo)
+                    if allowed:
+                        break
+            elif term[0] == "computed":
+                allowed = self._check(user, term[1], object, memo)
+            else:
+                for parent in self._users.get((object, term[1]), ()):
+                    parent_type = parent.split(":", 1)[0]
+                    if self.model.relation(parent_type, term[2]) is not None:
+                        allowed = self._check(user, term[2], parent, memo)
+                    if allowed:
+                        break
+            if allowed:
+                break
+
+        memo[key] = allowed
+        return allowed
+
+    def read(self, user=None, relation=None, object=None):
+        # Returns stored tuples matching the filter, sorted so pages are stable.  object may be a full object or
+        # just a type ("folder:")
+        with self._lock:
+            keys = []
+            for (tuple_object, tuple_relation), users in self._users.items():
+                if object is not None and tuple_object != object and not (object.endswith(":") and tuple_object.startswith(object)):
+                    continue
+                if relation is not None and tuple_relation != relation:
+                    continue
+                keys.extend(
+                    {"user": tuple_user, "relation": tuple_relation, "object": tuple_object}
+                    for tuple_user in users if user is None or tuple_user == user
+                )
+            return sorted(keys, key=lambda key: (key["object"], key["relation"], key["user"]))
+
+    def list_objects(self, user, relation, object_type):
+        # Evaluates a check against every object of the type, sharing one memo across the checks.  Like the real
+        # ListObjects its cost grows with the size of the object graph rather than the size of the result.
+        with self._lock:
+            memo = {}
+            return sorted(
+                object for object in self._objects_by_type.get(object_type, ())
+                if self._check(user, relation, object, memo)
+            )
+
+    def list_users(self, object, relation, user_type):
+        # Evaluates a check for every user of the type named in any stored tuple.  Returns (users, wildcard) where
+        # wildcard is True if every user of the type has the relation through a type:* tuple
+        with self._lock:
+            memo = {}
+            candidates = {
+                subject for users in self._users.values() for subject in users
+                if subject.startswith(f"{user_type}:") and "#" not in subject and subject != f"{user_type}:*"
+            }
+            users = sorted(user for user in candidates if self._check(user, relation, object, memo))
+            return users, self._check(f"{user_type}:*", relation, object, memo)
+
+
+def format_key(key):
+    return f"{key['user']} {key['relation']} {key['object']}"
+
+
+class LocalFGAServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model, latency=0.0, endpoint_latency=None):
+        super().__init__(address, LocalFGARequestHandler)
+        self.model = model
+        self.store = TupleStore(model)
+        self.latency = latency
+        self.endpoint_latency = endpoint_latency or {}
+        self.call_counts = {}
+        self._counts_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_call(self, endpoint):
+        with self._counts_lock:
+            self.call_counts[endpoint] = self.call_counts.get(endpoint, 0) + 1
+
+    def reset_stats(self):
+        with self._counts_lock:
+            self.call_counts = {}
+
+    def start(self):
+        # Serve from a background thread, for use from benchmarks and scripts
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class LocalFGARequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so without TCP_NODELAY the body waits on the client's delayed ACK
+    # and every call takes tens of milliseconds
+    disable_nagle_algorithm = True
+
+    routes = {
+        ("GET", "authorization-models"): "read_authorization_models",
+        ("POST", "write"): "write",
+        ("POST", "check"): "check",
+        ("POST", "batch-check"): "batch_check",
+        ("POST", "list-objects"): "list_objects",
+        ("POST", "list-users"): "list_users",
+        ("POST", "read"): "read",
+    }
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        # Keep request logging quiet so it doesn't skew timings
+        pass
+
+    def _dispatch(self, method):
+        path = self.path.split("?", 1)[0].strip("/").split("/")
+
+        if method == "GET" and path == ["_stats"]:
+            return self._respond(200, {"calls": dict(self.server.call_counts), "tuples": len(self.server.store)})
+        if method == "POST" and path == ["_reset"]:
+            self.server.reset_stats()
+            return self._respond(200, {})
+
+        if len(path) != 3 or path[0] != "stores" or (method, path[2]) not in self.routes:
+            return self._respond(404, {"code": "undefined_endpoint", "message": "Not Found"})
+
+        endpoint = path[2]
+        self.server.record_call(endpoint)
+        delay = self.server.endpoint_latency.get(endpoint, self.server.latency)
+        if delay:
+            time.sleep(delay)
+
+        try:
+            body = self._read_body()
+            response = getattr(self, self.routes[(method, endpoint)])(body)
+        except FGAError as e:
+            return self._respond(400, {"code": e.code, "message": e.message})
+        except (KeyError, TypeError, ValueError) as e:
+            return self._respond(400, {"code": "validation_error", "message": f"invalid request: {e}"})
+        self._respond(200, response)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _respond(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _reject_contextual_tuples(body):
+        if (body.get("contextual_tuples") or {}).get("tuple_keys"):
+            raise FGAError("contextual tuples are not supported by the local stand-in")
+
+    def read_authorization_models(self, body):
+        return {"authorization_models": [self.server.model.to_json()], "continuation_token": ""}
+
+    def write(self, body):
+        writes = body.get("writes") or {}
+        deletes = body.get("deletes") or {}
+        self.server.store.write(
+            writes=writes.get("tuple_keys") or [],
+            deletes=deletes.get("tuple_keys") or [],
+            on_duplicate=writes.get("on_duplicate", "error"),
+            on_missing=deletes.get("on_missing", "error"),
+        )
+        return {}
+
+    def check(self, body):
+        self._reject_contextual_tuples(body)
+        key = body["tuple_key"]
+        return {"allowed": self.server.store.check(key["user"], key["relation"], key["object"]), "resolution": ""}
+
+    def batch_check(self, body):
+        result = {}
+        memo = {}
+        for item in body["checks"]:
+            self._reject_contextual_tuples(item)
+            key = item["tuple_key"]
+            try:
+                result[item["correlation_id"]] = {"allowed": self.server.store.check(key["user"], key["relation"], key["object"], memo)}
+            except FGAError as e:
+                result[item["correlation_id"]] = {"allowed": False, "error": {"input_error": e.code, "message": e.message}}
+        return {"result": result}
+
+    def read(self, body):
+        key = body.get("tuple_key") or {}
+        page_size = int(body.get("page_size") or 50)
+        offset = int(body.get("continuation_token") or 0)
+        keys = self.server.store.read(key.get("user"), key.get("relation"), key.get("object"))
+        page = keys[offset:offset + page_size]
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        more = offset + page_size < len(keys)
+        return {
+            "tuples": [{"key": tuple_key, "timestamp": timestamp} for tuple_key in page],
+            "continuation_token": str(offset + page_size) if more else "",
+        }
+
+    def list_objects(self, body):
+        self._reject_contextual_tuples(body)
+        return {"objects": self.server.store.list_objects(body["user"], body["relation"], body["type"])}
+
+    def list_users(self, body):
+        self._reject_contextual_tuples(body)
+        object = f"{body['object']['type']}:{body['object']['id']}"
+        users = []
+        for user_filter in body["user_filters"]:
+            if user_filter.get("relation"):
+                raise FGAError("userset filters are not supported by the local stand-in")
+            matches, wildcard = self.server.store.list_users(object, body["relation"], user_filter["type"])
+            users.extend({"object": {"type": user_filter["type"], "id": user.split(":", 1)[1]}} for user in matches)
+            if wildcard:
+                users.append({"wildcard": {"type": user_filter["type"]}})
+        return {"users": users}
+
+
+def parse_endpoint_latency(values):
+    # Parses --endpoint-latency-ms values of the form endpoint=milliseconds
+    latency = {}
+    for value in values or []:
+        endpoint, _, milliseconds = value.partition("=")
+        latency[endpoint.strip()] = float(milliseconds) / 1000
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenFGA stand-in that evaluates model.fga in memory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", default="model.fga", help="path to the OpenFGA DSL model")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency injected into every API call")
+    parser.add_argument("--endpoint-latency-ms", action="append", metavar="ENDPOINT=MS",
+                        help="per endpoint latency override, e.g. check=5 or write=20.  May be repeated")
+    args = parser.parse_args()
+
+    model = AuthorizationModel.from_file(args.model)
+    server = LocalFGAServer((args.host, args.port), model, args.latency_ms / 1000, parse_endpoint_latency(args.endpoint_latency_ms))
+    print(f"Local OpenFGA stand-in listening on {server.url}")
+    print(f"FGA_STORE_ID={LOCAL_STORE_ID}")
+    print(f"FGA_MODEL_ID={LOCAL_MODEL_ID}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# gunicorn settings for running the app, e.g.
+#
+#   gunicorn -c gunicorn.conf.py run:app
+#
+# Each worker builds its own OpenFGA clients and connection pools.  With preload_app the app is created once in
+# the master before the workers are forked.  Connections, the async client's event loop and the outbox worker
+# thread don't carry over into a forked process, and a thread left running in the master could hold locks the
+# workers inherit, so create_app() doesn't start them in the master and post_fork starts them in every worker.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 3000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+# This file is read before the app is loaded, so create_app() sees this when it runs in the master
+if preload_app:
+    os.environ['FGA_START_AFTER_FORK'] = 'true'
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import db, start_fga
+        app = server.app.wsgi()
+        # Drop the database connections inherited from the master without closing them, since the master and the
+        # other workers share the same sockets
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+        start_fga(app)
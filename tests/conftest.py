@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# config.Config reads the environment when it is imported, so point the app at an in-memory SQLite database and
+# keep it from connecting to OpenFGA before anything imports it
+os.environ.setdefault("APP_SECRET_KEY", "test")
+os.environ["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+os.environ["SESSION_BACKEND"] = "cookie"
+os.environ["FGA_EAGER_INIT"] = "false"
+os.environ["FGA_OUTBOX_WORKER"] = "false"
+os.environ["METRICS_ENABLED"] = "false"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+
+
+@pytest.fixture
+def app():
+    app = create_app()
+    with app.app_context():
+        yield app
@@ -0,0 +1,29 @@
+from app.models import Folder
+from app.schema import explain, hot_queries
+from sqlalchemy import select
+import pytest
+import uuid
+
+
+@pytest.mark.parametrize("name", sorted(hot_queries()))
+def test_hot_query_uses_its_index(app, name):
+    statement, indexes = hot_queries()[name]
+    problems, plan = explain(statement, indexes)
+    assert problems == [], plan
+
+
+def test_explain_reports_sorts(app):
+    statement = select(Folder.id).where(Folder.parent == uuid.uuid4()).order_by(Folder.updated).limit(10)
+    problems, plan = explain(statement)
+    assert "sorts rows instead of reading them in index order" in problems
+
+
+def test_explain_reports_the_wrong_index(app):
+    statement = select(Folder.id).where(Folder.parent == uuid.uuid4()).order_by(Folder.created, Folder.id)
+    problems, plan = explain(statement, ("ix_folder_parent_name",))
+    assert problems == ["doesn't use ix_folder_parent_name"]
+
+
+def test_explain_reports_table_scans(app):
+    problems, plan = explain(select(Folder.id).where(Folder.updated.is_(None)))
+    assert "scans a table" in problems